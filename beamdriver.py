@@ -1,20 +1,232 @@
 from pcaspy import Driver, SimpleServer
-from cheetah.particles import ParticleBeam
-from cheetah.accelerator import Segment, Screen
+from pcaspy.driver import manager, Data
+from cheetah.particles import ParticleBeam, ParameterBeam
+from cheetah.accelerator import Segment, Screen, Quadrupole, TransverseDeflectingCavity
 import numpy as np
 import torch
-from lcls_tools.common.data.model_general_calcs import bdes_to_kmod, kmod_to_bdes
-from scipy.stats import cauchy
-import pprint
 import math
+from p4p.server import DynamicProvider
 from p4p.server.thread import SharedPV
 from p4p.nt import NTScalar, NTNDArray, NTEnum
+from p4p.nt.ndarray import ntndarray
 import p4p
 from typing import Dict, Callable, Any
+import copy
+import functools
+import logging
+import queue
+import threading
+import time
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from utils.cache import TrackingCache
+from utils.codec import CODECS, SCALAR_TYPES, compress, image_dtype, quantize
+from utils.metrics import Metrics
+from utils.noise import NoiseModel
+from utils.recorder import GET, PUT, Recorder
+from utils.stream import FrameRing
+
+logger = logging.getLogger(__name__)
+
+# Elementary charge in C, as scipy.constants has it, so that scipy need not be imported at startup
+ELEMENTARY_CHARGE = 1.602176634e-19
+
+
+def bdes_to_kmod(*args, **kwargs):
+    """lcls_tools' bdes_to_kmod, imported on first use as lcls_tools is slow to import"""
+    from lcls_tools.common.data.model_general_calcs import bdes_to_kmod
+    return bdes_to_kmod(*args, **kwargs)
+
+
+def kmod_to_bdes(*args, **kwargs):
+    """lcls_tools' kmod_to_bdes, imported on first use as lcls_tools is slow to import"""
+    from lcls_tools.common.data.model_general_calcs import kmod_to_bdes
+    return kmod_to_bdes(*args, **kwargs)
+
+
+class ImageNT(NTNDArray):
+    """NTNDArray that also accepts a ready made Value, such as a frame with compressed data"""
+
+    def wrap(self, value, **kws):
+        if isinstance(value, p4p.Value):
+            return self._annotate(value, **kws)
+        return super().wrap(value, **kws)
+
+
+def track_linearized(element, incoming: ParameterBeam) -> ParameterBeam:
+    """
+    Tracks a ParameterBeam through an element that only supports ParticleBeam tracking (such as a Bmad-X TCAV),
+    using the element's linear map around the beam centroid. The map is found by finite differences on
+    13 particles, the centroid and a +/- offset along each phase space coordinate.
+
+    Parameters
+    ----------
+    element : Element
+        Element to track through
+    incoming : ParameterBeam
+        Beam entering the element
+
+    Returns
+    -------
+    ParameterBeam
+        Beam exiting the element
+    """
+    mu, cov = incoming.mu, incoming.cov
+    # Offsets of 1 % of the beam size keep the map linear without losing float32 precision
+    steps = 1e-2 * torch.sqrt(torch.clamp_min(torch.diagonal(cov)[:6], 1e-24))
+    offsets = torch.zeros(13, 7, dtype=mu.dtype, device=mu.device)
+    offsets[1::2, :6] = torch.diag(steps)
+    offsets[2::2, :6] = -torch.diag(steps)
+    particles = ParticleBeam(particles=mu + offsets, energy=incoming.energy, s=incoming.s,
+                             species=incoming.species)
+    outgoing = element.track(particles)
+
+    out = outgoing.particles
+    jacobian = torch.eye(7, dtype=mu.dtype, device=mu.device)
+    jacobian[:6, :6] = ((out[1::2, :6] - out[2::2, :6]) / (2 * steps[:, None])).T
+    return ParameterBeam(mu=out[0], cov=jacobian @ cov @ jacobian.T, energy=outgoing.energy,
+                         total_charge=incoming.total_charge, s=outgoing.s, species=outgoing.species)
+
+
+def render_roi(screen: Screen, min_x: int, size_x: int, min_y: int, size_y: int,
+               bin_x: int = 1, bin_y: int = 1) -> torch.Tensor:
+    """
+    Renders the reading of a screen over a region of interest only, with the screen's method, 'histogram',
+    'cloud-in-cell' or 'kde'. Binned pixels hold the sum of the pixels they bin. Histogram and cloud-in-cell
+    readings are crops of the full frame reading, KDE readings are scaled so that the region holds the same
+    intensity as in the full frame reading.
+
+    Parameters
+    ----------
+    screen : Screen
+        Screen holding the beam it read
+    min_x, size_x, min_y, size_y : int
+        Region of interest in pixels of the full frame
+    bin_x, bin_y : int
+        Number of pixels summed into one along X and Y
+
+    Returns
+    -------
+    torch.Tensor
+        Image of shape (size_y // bin_y, size_x // bin_x)
+    """
+    width, height = screen.effective_resolution
+    pixel_size = screen.effective_pixel_size
+    n_x, n_y = size_x // bin_x, size_y // bin_y
+    read_beam = screen.get_read_beam()
+    if read_beam is None:
+        return torch.zeros((n_y, n_x), dtype=pixel_size.dtype, device=pixel_size.device)
+    if not isinstance(read_beam, ParticleBeam):
+        raise TypeError(f'Cannot render a region of interest of a {type(read_beam).__name__}')
+
+    edges_x = (min_x + bin_x * torch.arange(n_x + 1, dtype=pixel_size.dtype) - width / 2) * pixel_size[0]
+    edges_y = (min_y + bin_y * torch.arange(n_y + 1, dtype=pixel_size.dtype) - height / 2) * pixel_size[1]
+    x, y = read_beam.x, read_beam.y
+    weights = read_beam.particle_charges.abs() * read_beam.survival_probabilities
+
+    if screen.method == 'histogram':
+        image, _ = torch.histogramdd(torch.stack((x, y)).T, bins=(edges_x, edges_y), weight=weights)
+    elif screen.method == 'cloud-in-cell':
+        x, y, weights = torch.broadcast_tensors(x, y, weights)
+        image = _cloud_in_cell_roi(x, y, weights, screen.extent, pixel_size, min_x, n_x * bin_x, min_y, n_y * bin_y)
+        image = image.unflatten(-2, (n_x, bin_x)).sum(-2).unflatten(-1, (n_y, bin_y)).sum(-1)
+    elif screen.method == 'kde':
+        # kde_histogram_2d split into its kernel and joint steps, so that binning can sum the kernels in between.
+        # They are private to cheetah, so only a KDE screen with a region of interest depends on them.
+        from cheetah.utils.kde import _kde_marginal_pdf, _kde_joint_pdf_2d
+
+        x, y, weights = torch.broadcast_tensors(x, y, weights)
+        # Kernels at the centers of the unbinned pixels, summed per bin before the joint product
+        centers_x = (min_x + torch.arange(n_x * bin_x, dtype=pixel_size.dtype) + 0.5 - width / 2) * pixel_size[0]
+        centers_y = (min_y + torch.arange(n_y * bin_y, dtype=pixel_size.dtype) + 0.5 - height / 2) * pixel_size[1]
+        _, kernel_x = _kde_marginal_pdf(values=x, bins=centers_x, sigma=screen.kde_bandwidth, weights=weights)
+        _, kernel_y = _kde_marginal_pdf(values=y, bins=centers_y, sigma=screen.kde_bandwidth)
+        image = _kde_joint_pdf_2d(kernel_x.unflatten(-1, (n_x, bin_x)).sum(-1),
+                                  kernel_y.unflatten(-1, (n_y, bin_y)).sum(-1))
+        # The KDE is normalized over the bins it is computed on, the full frame holds (nearly) every particle
+        inside = (x >= edges_x[0]) & (x < edges_x[-1]) & (y >= edges_y[0]) & (y < edges_y[-1])
+        image = image * (weights * inside).sum(-1) / weights.sum(-1)
+    else:
+        raise ValueError(f'Cannot render a region of interest with the {screen.method!r} method')
+    return torch.transpose(image, -2, -1)
+
+
+def _cloud_in_cell_roi(x: torch.Tensor, y: torch.Tensor, weights: torch.Tensor, extent: torch.Tensor,
+                       pixel_size: torch.Tensor, min_x: int, n_x: int, min_y: int, n_y: int) -> torch.Tensor:
+    """
+    Deposits particles onto the pixels of a region of interest as cheetah's cloud-in-cell deposition does onto
+    the full frame: every particle inside the screen spreads its weight bilinearly over the 4 nearest pixel
+    centers. Pixels outside the region are dropped, so the result is a crop of the full frame deposition.
+
+    Parameters
+    ----------
+    x, y, weights : torch.Tensor
+        Particle positions and weights, broadcast to the same shape
+    extent : torch.Tensor
+        Screen extent (left, right, bottom, top), particles outside of it are not deposited
+    pixel_size : torch.Tensor
+        Size of a pixel along X and Y
+    min_x, n_x, min_y, n_y : int
+        Region of interest in pixels
+
+    Returns
+    -------
+    torch.Tensor
+        Deposited weights of shape (..., n_x, n_y)
+    """
+    inside = (x >= extent[0]) & (x <= extent[1]) & (y >= extent[2]) & (y <= extent[3])
+    weights = weights * inside
+    # Pixel coordinates relative to the region, integers at the pixel centers
+    u = (x - extent[0]) / pixel_size[0] - 0.5 - min_x
+    v = (y - extent[2]) / pixel_size[1] - 0.5 - min_y
+    i, j = u.floor().long(), v.floor().long()
+    fu, fv = u - i, v - j
+
+    grid = x.new_zeros((*x.shape[:-1], n_x * n_y))
+    for di, wu in ((0, 1 - fu), (1, fu)):
+        for dj, wv in ((0, 1 - fv), (1, fv)):
+            ci, cj = i + di, j + dj
+            valid = (ci >= 0) & (ci < n_x) & (cj >= 0) & (cj < n_y)
+            index = ci.clamp(0, n_x - 1) * n_y + cj.clamp(0, n_y - 1)
+            grid.scatter_add_(-1, index, weights * wu * wv * valid)
+    return grid.unflatten(-1, (n_x, n_y))
+
+
+@functools.lru_cache(maxsize=None)
+def _normative_type(kind: str, code: str = ''):
+    """
+    Returns a shared normative type instance, they only describe the structure so every PV of a kind can use the same.
+    Building the Type of each of thousands of PVs anew is a noticeable part of the startup.
+
+    Parameters
+    ----------
+    kind : str
+        'image', 'enum', 'scalar' (with control, display and valueAlarm) or 'plain' (a bare NTScalar)
+    code : str
+        Type code of a scalar, see SimServer._type_desc
+
+    Returns
+    -------
+    NTScalar | NTEnum | ImageNT
+    """
+    match kind:
+        case 'image':
+            return ImageNT()
+        case 'enum':
+            return NTEnum(control=True, display=True, valueAlarm=True)
+        case 'scalar':
+            return NTScalar(code, control=True, display=True, valueAlarm=True)
+        case _:
+            return NTScalar(code)
+
 
 class SimServer(SimpleServer):
     """
-    Subclass of pcaspy.SimpleServer that also serves PVs via PVA
+    Subclass of pcaspy.SimpleServer that also serves PVs via PVA.
+    Value PVs are created up front. Field PVs (.HOPR, .PREC, ...) only exist as their description until a client
+    searches for one, and a PVA field PV is freed again once its last client disconnects. A CA field PV is kept
+    once created: pcaspy neither reports when a PV's last channel closes nor lets a PV be removed safely.
     """
 
     PV_ASSOC = {
@@ -33,34 +245,76 @@ class SimServer(SimpleServer):
         'hopr': 'HOPR',
         'prec': 'PREC',
         'drvh': 'DRVH',
-        'drvl': 'DRVL'
+        'drvl': 'DRVL',
+        'mdel': 'MDEL',
+        'adel': 'ADEL',
     }
 
+    # Deadband fields of the numeric PVs, applied by SimDriver rather than pcaspy
+    DEADBAND_FIELDS = ('mdel', 'adel')
+
     class UpdateHandler:
         """
         Handler for PV writes. Invokes the update callback to update the model outputs.
         This also maintains an association between a PV and a subfield in the parent PV. For example,
         if we have a .LOPR pv, that also needs to update the display.limitLow field in the parent.
         """
-        def __init__(self, server, parent: SharedPV|None=None, subfield: str|None=None):
+        def __init__(self, server, parent: SharedPV|None=None, subfield: str|None=None, name: str|None=None,
+                     field: str|None=None):
             self.server = server
             self._parent = parent
             self._subfield = subfield
+            # Name of a value PV, whose clients are tracked
+            self._name = name
+            # Name of a field PV, freed once it has no clients
+            self._field = field
+
+        def onFirstConnect(self, pv):
+            if self._name:
+                self.server._on_watch(self._name, True)
+
+        def onLastDisconnect(self, pv):
+            if self._name:
+                self.server._on_watch(self._name, False)
+            if self._field:
+                self.server._release_field(self._field, pv)
 
         def put(self, pv, op):
-            pv.post(op.value())
-            op.done()
+            if self.server.recorder:
+                self.server.record(PUT, op.name(), op.value())
+            # A field put is posted once, by the driver applying it through set_pv
+            if not (self._field and self.server._callback):
+                pv.post(op.value())
 
-            # Update the parent PV's subfield too
+            # Update the parent PV's subfield too, posting only that field and only if it changed
             if self._parent:
+                value = op.value()
+                if isinstance(value, p4p.Value) and 'value' in value:
+                    value = value['value']
                 val = self._parent._wrap(self._parent.current())
-                val[self._subfield] = op.value()
-                self._parent.post(val)
+                if val[self._subfield] != value:
+                    val.unmark()
+                    val[self._subfield] = value
+                    self._parent.post(val)
 
+            # The put completes once the callback has published its effect
             if self.server._callback:
-                self.server._callback(op.name(), op.value())
+                self.server._callback(self.server._reason(op.name()), op.value(), op.done)
+            else:
+                op.done()
+
+    class FieldProvider:
+        """Handler of the DynamicProvider that creates the PVA field PVs on first access"""
+        def __init__(self, server):
+            self.server = server
+
+        def testChannel(self, name, *args):
+            return name.startswith(self.server._prefix) and self.server._reason(name) in self.server._pva_fields
 
-    def __init__(self, pvdb: dict, prefix: str = ''):
+        def makeChannel(self, name, *args):
+            return self.server._field_pv(self.server._reason(name))
+
+    def __init__(self, pvdb: dict, prefix: str = '', ca: bool = True, recorder: Recorder | None = None):
         """
         Parameters
         ----------
@@ -68,47 +322,163 @@ class SimServer(SimpleServer):
             Dict describing all records and their fields
         prefix : str
             PV name prefix
+        ca : bool
+            Whether to start the CA server. Without it the records still hold the driver's parameters,
+            as for an area served through a router, see multiarea.py
+        recorder : Recorder | None
+            Log to record the PVA puts, and the CA puts and gets of the driver, to
         """
+        self.recorder = recorder
         self._pva: Dict[str, SharedPV] = {}
         self._callback = None
+        self._watch_callback = None
+        # PVA value PVs that have at least one client channel
+        self._watched = set()
+        self._prefix = prefix
+        # Image PV -> NTNDArray codec name its frames are compressed with
+        self._codecs: Dict[str, str] = {}
         self._db = pvdb
+        # Field PVs that are created on first access: name -> {'value', 'parent', 'subfield'} for PVA,
+        # name -> pvdb entry for CA. The description holds the value while no PV exists.
+        self._pva_fields: Dict[str, dict] = {}
+        self._ca_fields: Dict[str, dict] = {f'{prefix}{k}': v for k, v in pvdb.items() if '.' in k}
+        self._field_pvs: Dict[str, SharedPV] = {}
+        self._field_lock = threading.Lock()
 
         # Create CA PVs
-        self.createPV(prefix, pvdb)
+        self.createPV(prefix, {k: {f: x for f, x in v.items() if f not in self.DEADBAND_FIELDS}
+                               for k, v in pvdb.items() if '.' not in k})
 
-        # Create PVA PVs
+        # Create PVA PVs, keyed on the name without the prefix as for the driver
         for k, v in pvdb.items():
             if k.rfind('.') != -1:
                 continue
-            self._pva.update(self._build_pv(f'{prefix}{k}', v))
+            self._pva.update(self._build_pv(k, v))
+
+        if ca:
+            super().__init__()
+
+    def pvExistTest(self, context, *args):
+        # Create a CA field PV once a client searches for it. The arguments are (addr, fullname) or (fullname).
+        fullname = args[-1]
+        if fullname in self._ca_fields and fullname not in manager.pvf:
+            self._create_ca_field(fullname)
+        return super().pvExistTest(context, *args)
+
+    def _create_ca_field(self, fullname: str):
+        """Creates a CA field PV from its description, along with its parameter in the driver"""
+        reason = fullname[len(self._prefix):]
+        desc = self._ca_fields[fullname]
+        self.createPV(self._prefix, {reason: desc})
+        driver = manager.driver.get(manager.pvf[fullname].info.port)
+        if driver is not None and reason not in driver.pvDB:
+            data = Data()
+            data.value = manager.pvf[fullname].info.value
+            driver.pvDB[reason] = data
+        logger.debug('Created CA field PV %s', fullname)
+
+    def set_update_callback(self, callable: Callable[[str, Any, Callable[[], None]], None]):
+        """
+        Sets the callback to be called when a PV is written to over PVA. The callback receives the PV name,
+        the new value and a function it must call once the put has been processed.
 
-        super().__init__()
+        Parameters
+        ----------
+        callable : Callable
+            Method to use, or none to clear
+        """
+        self._callback = callable
 
-    def set_update_callback(self, callable: Callable[[str, Any], None]):
+    def set_watch_callback(self, callable: Callable[[str, bool], None]):
         """
-        Sets the callback to be called every 0.1s in the processing loop (corresponds to fastest EPICS processing time)
+        Sets the callback to be called when the first PVA client connects to a PV, or the last one disconnects.
+        The callback receives the PV name and whether it now has clients.
 
         Parameters
         ----------
         callable : Callable
             Method to use, or none to clear
         """
-        self._callback = callable
+        self._watch_callback = callable
+
+    def is_watched(self, name: str) -> bool:
+        """Returns whether a PV has PVA clients or CA monitors"""
+        if name in self._watched:
+            return True
+        pv = manager.pvf.get(f'{self._prefix}{name}')
+        return pv is not None and pv.interest
+
+    def record(self, kind: int, name: str, value=None):
+        """Records a put or get, if recording. PVA values are recorded as plain values."""
+        if not self.recorder:
+            return
+        if isinstance(value, p4p.Value):
+            value = value['value'] if 'value' in value else value.todict()
+            if isinstance(value, p4p.Value):
+                # NTEnum
+                value = value['index']
+        try:
+            self.recorder.record(kind, self._reason(name), value)
+        except Exception:
+            logger.exception('Failed to record %s', name)
+
+    def _reason(self, name: str) -> str:
+        """Returns the name of a served PV without the prefix"""
+        return name[len(self._prefix):] if name.startswith(self._prefix) else name
+
+    def _on_watch(self, name: str, watched: bool):
+        if watched:
+            self._watched.add(name)
+        else:
+            self._watched.discard(name)
+        if self._watch_callback:
+            self._watch_callback(name, watched)
 
     def run(self):
-        self._server = p4p.server.Server(providers=[self._pva])
+        pvs = {f'{self._prefix}{k}': pv for k, pv in self._pva.items()}
+        self._server = p4p.server.Server(providers=[pvs, DynamicProvider('fields', SimServer.FieldProvider(self))])
         while True:
             self.process(0.1)
 
     @property
     def pva_pvs(self) -> Dict[str, SharedPV]:
-        """Returns list of PVs served by PVA"""
+        """Returns list of PVs served by PVA, keyed without the prefix and without the field PVs created on access"""
         return self._pva
 
+    def set_field_value(self, name: str, value):
+        """Sets the value a CA field PV that does not exist yet is created with"""
+        desc = self._ca_fields.get(f'{self._prefix}{name}')
+        if desc is not None:
+            desc['value'] = value
+
+    def _field_pv(self, name: str) -> SharedPV:
+        """Returns the PVA field PV, creating it from its description if it has no clients yet"""
+        with self._field_lock:
+            pv = self._field_pvs.get(name)
+            if pv is None:
+                field = self._pva_fields[name]
+                pv = SharedPV(
+                    nt=_normative_type('plain', self._type_desc(field['value'])),
+                    initial=field['value'],
+                    handler=SimServer.UpdateHandler(self, parent=field['parent'], subfield=field['subfield'],
+                                                    field=name)
+                )
+                self._field_pvs[name] = pv
+                logger.debug('Created PVA field PV %s', name)
+            return pv
+
+    def _release_field(self, name: str, pv: SharedPV):
+        """Frees a PVA field PV without clients, keeping its value in the description"""
+        with self._field_lock:
+            if self._field_pvs.get(name) is pv:
+                self._pva_fields[name]['value'] = pv.current()
+                del self._field_pvs[name]
+                logger.debug('Freed PVA field PV %s', name)
+
     @property
     def pvdb(self) -> dict:
         """Returns the PV database"""
-        return self.pvdb
+        return self._db
 
     def _type_desc(self, t) -> str:
         """
@@ -156,7 +526,7 @@ class SimServer(SimpleServer):
         Parameters
         ----------
         name : str
-            PV base name
+            PV base name, without the prefix
         desc : dict
             Description ordinarily passed to pcaspy
 
@@ -171,35 +541,46 @@ class SimServer(SimpleServer):
 
         is_image = False
         match desc['type']:
+            case _ if 'count' in desc and 'n_col' in desc:
+                # Image, integer camera counts if the bit depth is known
+                dtype = image_dtype(desc['n_bits']) if 'n_bits' in desc else float
+                default = np.zeros((desc['n_col'], desc['n_row']), dtype=dtype)
+                nt = _normative_type('image')
+                is_image = True
             case 'enum':
-                nt = NTEnum(control=True, display=True, valueAlarm=True)
+                nt = _normative_type('enum')
                 default = {
                     'index': desc['value'] if 'value' in desc else 0,
                     'choices': desc['enums']
                 }
             case 'int':
-                nt = NTScalar('i', control=True, display=True, valueAlarm=True)
+                nt = _normative_type('scalar', 'i')
                 default = desc['value'] if 'value' in desc else 0
+            case 'string':
+                nt = _normative_type('plain', 's')
+                default = desc['value'] if 'value' in desc else ''
+            case 'char':
+                # Long string, a char waveform over CA
+                nt = _normative_type('plain', 's')
+                default = desc['value'] if 'value' in desc else ''
             case 'float':
-                # If we have count, it's actually an array (image)
-                if 'count' in desc and 'n_col' in desc:
-                    default = np.zeros((desc['n_col'], desc['n_row']), dtype=float)
-                    nt = NTNDArray()
-                    is_image=True
+                if 'count' in desc and desc['count'] > 1:
+                    nt = _normative_type('scalar', 'ad')
+                    default = desc['value'] if 'value' in desc else [0.0] * desc['count']
                 else:
-                    nt = NTScalar('d', control=True, display=True, valueAlarm=True)
+                    nt = _normative_type('scalar', 'd')
                     default = float(desc['value']) if 'value' in desc else 0.0
             case _:
                 raise Exception(f'Unhandled type "{desc["type"]}"')
 
         # Special control fields
-        controls = ['enums', 'type', 'value', 'count', 'n_col', 'n_row']
+        controls = ['enums', 'type', 'value', 'count', 'n_col', 'n_row', 'n_bits', 'asyn', *self.DEADBAND_FIELDS]
 
         # Add value field
         val_pv = SharedPV(
             nt=nt,
             initial=default,
-            handler=SimServer.UpdateHandler(self),
+            handler=SimServer.UpdateHandler(self, name=name),
         )
         r[f'{name}.VAL'] = val_pv
         r[f'{name}'] = val_pv
@@ -221,23 +602,27 @@ class SimServer(SimpleServer):
             sub = self._pv_assoc(k)
             par_pv = val_pv if sub else None
 
-            # Build a PV for each field
-            r[f'{name}.{k.upper()}'] = SharedPV(
-                nt=NTScalar(self._type_desc(v)),
-                initial=v,
-                handler=SimServer.UpdateHandler(self, parent=par_pv, subfield=sub)
-            )
+            # Describe a PV for each field, it is created on first access
+            self._pva_fields[f'{name}.{k.upper()}'] = {'value': v, 'parent': par_pv, 'subfield': sub}
 
             if sub and cur:
                 cur[sub] = v
 
+        # Every numeric PV gets MDEL/ADEL field PVs, created on first access like the others
+        if desc['type'] in ('float', 'int') and not is_image:
+            for k in self.DEADBAND_FIELDS:
+                field = f'{name}.{self._db_to_pv(k)}'
+                value = float(desc.get(k, 0.0))
+                self._pva_fields[field] = {'value': value, 'parent': None, 'subfield': None}
+                self._ca_fields.setdefault(f'{self._prefix}{field}', {'type': 'float', 'value': value})
+
         # Post the "real" value to the value PV, including all fields
         if cur:
             val_pv.post(cur)
 
         return r
 
-    def set_pv(self, name: str, value):
+    def set_pv(self, name: str, value, timestamp: float | None = None, unique_id: int | None = None):
         """
         Update a PVA PV with a new value
         
@@ -247,12 +632,138 @@ class SimServer(SimpleServer):
             Full name of PV including field
         value : Any
             Value to set
+        timestamp : float | None
+            Time of the value in seconds since the epoch, the current time if None
+        unique_id : int | None
+            Frame number of an image, its NTNDArray uniqueId
+        """
+        if name in self._pva_fields:
+            with self._field_lock:
+                pv = self._field_pvs.get(name)
+                if pv is None:
+                    self._pva_fields[name]['value'] = value
+                    return
+            pv.post(value)
+            return
+        codec = self._codecs.get(name)
+        if codec and isinstance(value, np.ndarray):
+            value = self._compressed(name, value, codec)
+        if unique_id is not None:
+            if not isinstance(value, p4p.Value):
+                value = self._pva[name]._wrap(value)
+            value['uniqueId'] = unique_id
+            if timestamp is not None:
+                sec, ns = divmod(timestamp, 1.0)
+                value['dataTimeStamp'] = {'secondsPastEpoch': int(sec), 'nanoseconds': int(ns * 1e9)}
+        if timestamp is not None:
+            self._pva[name].post(value, timestamp=timestamp)
+        else:
+            self._pva[name].post(value)
+
+    def set_codec(self, name: str, codec: str):
         """
-        self._pva[name].post(value)
+        Sets the compression of an image PV, applied from its next update
+
+        Parameters
+        ----------
+        name : str
+            Image PV name
+        codec : str
+            NTNDArray codec name, or '' for no compression
+        """
+        if codec:
+            self._codecs[name] = codec
+        else:
+            self._codecs.pop(name, None)
+
+    def _compressed(self, name: str, image: np.ndarray, codec: str):
+        """
+        Builds the NTNDArray of an image whose value holds the compressed bytes, as areaDetector's codec plugin does.
+        The raw frame is never wrapped, wrapping copies it.
+        """
+        data = compress(image, codec)
+        value = p4p.Value(_normative_type('image').type, {
+            'value': ('ubyteValue', np.frombuffer(data, dtype=np.uint8)),
+            'compressedSize': len(data),
+            'uncompressedSize': image.nbytes,
+            'uniqueId': 0,
+            # Monochrome, as NTNDArray.wrap infers for a 2D array
+            'attribute': [{'name': 'ColorMode', 'value': 0}] if image.ndim == 2 else [],
+            'dimension': [{'size': n, 'offset': 0, 'fullSize': n, 'binning': 1, 'reverse': False}
+                          for n in reversed(image.shape)],
+        })
+        value['codec.name'] = codec
+        value['codec.parameters'] = SCALAR_TYPES[image.dtype]
+        return value
 
 # TODO: set defaults for all tcav enum pvs
 #  
 class SimDriver(Driver):
+    # Derived PVs that are computed from the tracking result
+    TRACKED_PREFIXES = ('VIRT:BEAM:', 'VIRT:CACHE:', 'VIRT:OPTICS:', 'VIRT:GRAD:', 'BPMS:')
+
+    # VIRT:SIM:FIDELITY values. Fast serves the scalar beam PVs from a tracked ParameterBeam and never
+    # renders images, full tracks particles for everything and renders the images that have clients,
+    # adaptive is fast but renders an image from the particles when it is read.
+    FIDELITY_FAST, FIDELITY_FULL, FIDELITY_ADAPTIVE = range(3)
+
+    # Region of interest and binning PVs of a screen, {screen}:{field}
+    ROI_FIELDS = ('MinX', 'SizeX', 'MinY', 'SizeY', 'BinX', 'BinY')
+
+    # Elements tracked with track_linearized by the fast path
+    LINEARIZED_ELEMENTS = (TransverseDeflectingCavity,)
+
+    # VIRT:NOISE PV field -> NoiseModel parameter
+    NOISE_FIELDS = {'ENABLE': 'enabled', 'SEED': 'seed', 'SHOT': 'shot', 'BACKGROUND': 'background',
+                    'DARK': 'dark', 'HOT_PIXELS': 'hot_pixels'}
+
+    # Seconds over which the achieved frame rate of a stream is averaged, and between its reports
+    STREAM_RATE_WINDOW = 2.0
+    STREAM_REPORT_INTERVAL = 1.0
+
+    # Seconds an image or gradient PV stays refreshed with every batch after a CA read, like a watched one
+    READ_INTEREST_WINDOW = 10.0
+
+    # Pseudo PV of the queued requests that replace the incoming beam, see set_incoming_beam
+    INCOMING_BEAM = 'VIRT:BEAM:INCOMING'
+
+    # VIRT:PERF stage -> timing histogram in SimDriver.metrics
+    PERF_STAGES = {'TRACK': 'track', 'RENDER': 'render', 'POST': 'post', 'PUT': 'put'}
+
+    # Waveforms along the segment, one point at the exit of every element -> column of the optics table
+    OPTICS_OUTPUTS = {
+        'VIRT:OPTICS:S': 's',
+        'VIRT:OPTICS:MU:X': 'mu_x',
+        'VIRT:OPTICS:MU:Y': 'mu_y',
+        'VIRT:OPTICS:SIGMA:X': 'sigma_x',
+        'VIRT:OPTICS:SIGMA:Y': 'sigma_y',
+        'VIRT:OPTICS:BETA:X': 'beta_x',
+        'VIRT:OPTICS:BETA:Y': 'beta_y',
+        'VIRT:OPTICS:ALPHA:X': 'alpha_x',
+        'VIRT:OPTICS:ALPHA:Y': 'alpha_y',
+    }
+
+    # Scan result PVs -> key in the result of run_scan
+    SCAN_OUTPUTS = {
+        'VIRT:SCAN:SIGMA:X': 'sigma_x',
+        'VIRT:SCAN:SIGMA:Y': 'sigma_y',
+        'VIRT:SCAN:MU:X': 'mu_x',
+        'VIRT:SCAN:MU:Y': 'mu_y',
+        'VIRT:SCAN:EMIT:X': 'emittance_x',
+        'VIRT:SCAN:EMIT:Y': 'emittance_y',
+        'VIRT:SCAN:IMAGES': 'images',
+    }
+
+    # Gradient PVs -> beam moment at the end of the segment, differentiated with respect to every setting
+    GRADIENT_OUTPUTS = {
+        'VIRT:GRAD:SIGMA:X': 'sigma_x',
+        'VIRT:GRAD:SIGMA:Y': 'sigma_y',
+        'VIRT:GRAD:MU:X': 'mu_x',
+        'VIRT:GRAD:MU:Y': 'mu_y',
+        'VIRT:GRAD:EMIT:X': 'emittance_x',
+        'VIRT:GRAD:EMIT:Y': 'emittance_y',
+    }
+
     def __init__(self,
                  server: SimServer,
                  screen: str,
@@ -261,7 +772,13 @@ class SimDriver(Driver):
                  particle_beam: ParticleBeam = None,
                  lattice_file: str = None,
                  beamline: Segment = None,
-                 enum_init_values: dict = None):
+                 enum_init_values: dict = None,
+                 cache_size_mb: float = 512,
+                 cache_dir: str = None,
+                 coalesce_window: float = 0.02,
+                 metrics_file: str = None,
+                 fidelity: int = FIDELITY_FULL,
+                 cache_context: str = None):
         super().__init__()
 
         self.server = server
@@ -311,38 +828,880 @@ class SimDriver(Driver):
                            'phase_set': 'TCAV:DIAG0:11:PREQ',
                            'rf_enable': 'TCAV:DIAG0:11:RF_ENABLE'}}}
         '''
+        # Screen whose images a scan returns, every screen in the segment is served live
         self.screen = screen
 
+        # Name lookups: control name <-> madname, and madname -> element of the segment
+        self._madname_of = {name: device['madname'] for name, device in devices.items()}
+        self._control_of = {madname: name for name, madname in self._madname_of.items()}
+        self._elements = None
+        self._settable = []
+
         self._particle_beam = particle_beam
         self._design_incoming_beam = design_incoming_beam
         self._beamline = beamline
         self._lattice_file = lattice_file
 
+        # Outputs for the current settings, only valid while the model is not dirty
+        self._result = None
+        self._result_key = None
+        # Settings key the elements of the segment were last tracked with
+        self._tracked_key = None
+        # Digest of the lattice and incoming beam, precomputed when they come from a snapshot
+        self._initial_context = cache_context
+        self._context = cache_context
+        self._dirty = True
+        # Sections of the segment, each starting at a controllable element, and the beam entering each
+        self._sections = None
+        self._checkpoints = []
+        # Beam moments along the segment: per section the moments at the exit of each of its elements,
+        # the transfer maps from the exit of its first element on, and the BPM -> element lookup
+        self._optics_sections = []
+        self._section_maps = {}
+        # Per section the transfer map of its linear elements fused into one, and the energy it was computed at
+        self._fused_maps = {}
+        self._element_s = None
+        self._bpm_rows = None
+        self._s_offset = 0.0
+        self._fast_optics = None
+        self._fast_optics_key = None
+        self._section_of = {}
+        self._stale_from = 0
+        # Beam at the end of the segment from the last track, and the handover of it to a downstream area
+        self._exit_beam = None
+        self._exit_beam_callback = None
+        self._handed_over_key = None
+        self._cache = TrackingCache(max_bytes=int(cache_size_mb * 2**20), cache_dir=cache_dir)
+        # Preallocated pair of frame buffers for each image PV
+        self._frame_buffers: Dict[str, list] = {}
+        # Result of the last scan run through the VIRT:SCAN PVs
+        self._scan_result = {}
+        # Fast path state: incoming beam moments, tracking plan, and the moments of the last settings tracked
+        self.fidelity = fidelity
+        self._parameter_beam = None
+        self._fast_plan = None
+        self._fast_key = None
+        self._fast_moments = None
+        # Image PVs not re-rendered since the settings changed, and those a reader asked for
+        self._stale_images = set()
+        self._image_requests = set()
+        # Guards _image_requests, which PVA and CA threads add to while the worker takes it
+        self._image_lock = threading.Lock()
+        # Image and gradient PV -> time of its last CA read, see READ_INTEREST_WINDOW
+        self._reads: Dict[str, float] = {}
+        # Gradients of the last settings they were computed for, and the gradient PVs not refreshed since
+        self._gradients = None
+        self._gradient_key = None
+        self._stale_gradients = set()
+        # Camera noise added to the images, configured from the VIRT:NOISE PVs when they are served
+        self.noise = NoiseModel()
+        self.noise.configure(**{param: self.getParam(f'VIRT:NOISE:{field}')
+                                for field, param in self.NOISE_FIELDS.items()
+                                if f'VIRT:NOISE:{field}' in self.server.pva_pvs})
+        # Camera gains of the screens without a Gain PV, see _camera_gain
+        self._gains: Dict[str, float] = {}
+        # Incremented on every change of the noise parameters, so that the streams pick it up
+        self._noise_version = 0
+        # Free-running screens, image PV -> stream state, see _start_stream
+        self._streams: Dict[str, dict] = {}
+
+        # Puts are queued and applied by a worker thread, so the CA/PVA service threads never run the simulation.
+        # Puts arriving within coalesce_window seconds of each other are applied as one batch,
+        # followed by a single refresh of the derived PVs they affect.
+        self.coalesce_window = coalesce_window
+        self._requests = queue.Queue()
+        self._lock = threading.RLock()
+        # Serializes publication between the worker and the stream publishers
+        self._post_lock = threading.Lock()
+        # Timings of the hot paths, published on the VIRT:PERF PVs and optionally dumped to metrics_file
+        self.metrics = Metrics()
+        self.metrics_file = metrics_file
+        # Last published value of every derived PV, replaced as a whole once per batch
+        self._snapshot: Dict[str, Any] = {}
+        # Per PV the value last posted to monitors (last monitored and archived for numbers, a digest for images),
+        # and the MDEL/ADEL deadbands of the PVs that have them, see _changed
+        self._posted: Dict[str, Any] = {}
+        self._deadbands = {k: [float(desc.get('mdel', 0.0)), float(desc.get('adel', 0.0))]
+                           for k, desc in self.server.pvdb.items() if 'mdel' in desc or 'adel' in desc}
+        self._dependents = self._build_dependency_graph()
+        self._derived = set().union(*self._dependents.values())
+        self._perf_pvs = {k for k in self.server.pva_pvs if k.startswith('VIRT:PERF:') and '.' not in k}
+        self._derived |= self._perf_pvs
+        # The optics are only extracted while tracking when something publishes them
+        self._optics_enabled = any(k.startswith(('VIRT:OPTICS:', 'BPMS:')) for k in self._derived)
+
         self.set_defaults_for_ctrl(0)
         self.set_defaults_for_pneumatic()
+        self.set_defaults_for_roi()
+        if 'VIRT:SIM:FIDELITY' in self.server.pva_pvs:
+            self.set_param('VIRT:SIM:FIDELITY', fidelity)
 
         # Do an initial evaluation with default values
         self._update_all_outputs()
         self.server.set_update_callback(self._on_update)
+        self.server.set_watch_callback(self._on_watch)
 
-    def _update_all_outputs(self):
-        """Updates all model outputs after an input was written to"""
-        for k in self.server.pva_pvs.keys():
-            # Skip PVs that have a field suffix, we only care about the 'main' PV
-            if '.' in k:
+        self._worker = threading.Thread(target=self._run_worker, name='SimDriver worker', daemon=True)
+        self._worker.start()
+
+    def _build_dependency_graph(self) -> Dict[str, set]:
+        """
+        Builds the dependency graph between input PVs and the derived PVs computed from them
+
+        Returns
+        -------
+        Dict[str, set]
+            Dict mapping an input PV -> set of derived PVs that must be refreshed when it is written to
+        """
+        names = [k for k in self.server.pva_pvs.keys() if '.' not in k]
+
+        # Outputs computed from the tracked beam depend on every machine setting
+        tracked = {k for k in names if 'Image:ArrayData' in k
+                   or (k.startswith(self.TRACKED_PREFIXES) and k != 'VIRT:BEAM:RESET_SIM')}
+
+        graph = {}
+        for control_name, device in self.devices.items():
+            pvs = device.get('pvs', {})
+            if 'QUAD' in control_name:
+                inputs, readbacks = ['bctrl'], ['bctrl', 'bact']
+            elif 'TCAV' in control_name:
+                inputs, readbacks = ['amp_set', 'phase_set'], []
+            elif 'OTRS' in control_name:
+                inputs, readbacks = ['pneumatic'], []
+            else:
                 continue
+            outputs = {pvs[r] for r in readbacks if r in pvs}
+            for i in inputs:
+                if i in pvs:
+                    graph[pvs[i]] = outputs | {pvs[i]} | tracked
+            # A new region of interest or camera gain only re-renders the screen's image
+            if 'OTRS' in control_name and 'image' in pvs:
+                for field in (*self.ROI_FIELDS, 'Gain'):
+                    if f'{control_name}:{field}' in names:
+                        graph[f'{control_name}:{field}'] = {pvs['image']}
+                if f'{control_name}:Image:Compressor' in names:
+                    graph[f'{control_name}:Image:Compressor'] = {pvs['image']}
+                # Once a stream stops, the image is published by the worker again
+                if f'{control_name}:Acquire' in names:
+                    graph[f'{control_name}:Acquire'] = {pvs['image']}
+
+        # The noise only changes the images
+        images = {k for k in names if 'Image:ArrayData' in k}
+        for field in self.NOISE_FIELDS:
+            graph[f'VIRT:NOISE:{field}'] = images
+
+        # Switching the fidelity refreshes everything computed from the beam, as does a new incoming beam
+        graph['VIRT:SIM:FIDELITY'] = set(tracked)
+        graph[self.INCOMING_BEAM] = set(tracked)
+
+        # Starting a scan refreshes its results
+        graph['VIRT:SCAN:START'] = {k for k in names if k in self.SCAN_OUTPUTS or k == 'VIRT:SCAN:STATUS'}
+
+        # Resetting the simulation invalidates every derived PV
+        graph['VIRT:BEAM:RESET_SIM'] = set().union(*graph.values()) - {'VIRT:BEAM:RESET_SIM'} - graph['VIRT:SCAN:START']
+        return graph
+
+    def _update_all_outputs(self):
+        """Updates all model outputs, used for the initial evaluation. Images are rendered once they have clients."""
+        self._update_outputs(self._defer_images(set(self._derived)))
+
+    def _update_outputs(self, reasons):
+        """
+        Recomputes the given derived PVs and publishes them as a new snapshot. The beam is tracked at most once,
+        by the first PV that needs it. Only the values that changed beyond their deadband are posted.
+
+        Parameters
+        ----------
+        reasons : Iterable[str]
+            PV names to refresh
+        """
+        # Build the new snapshot aside, readers keep using the published one meanwhile
+        snapshot = dict(self._snapshot)
+        for k in reasons:
             try:
-                self.read(k)
-            except:
-                pass
+                snapshot[k] = self._evaluate(k)
+            except Exception:
+                logger.exception('Failed to evaluate %s', k)
+
+        with self.metrics.timer('post'), self._post_lock:
+            for k, value in snapshot.items():
+                if self._snapshot.get(k) is value:
+                    continue
+                changed = self._changed(k, value)
+                if not changed and isinstance(value, np.ndarray) and value.ndim > 1:
+                    # Same frame, keep the published buffer so the next frame is rendered to the other one
+                    snapshot[k] = self._snapshot[k]
+                    continue
+                # CA waveforms are flat, hand pcaspy a view rather than a copy. CA reads see every value,
+                # a value within the deadband is not posted to the CA monitors.
+                try:
+                    self.setParam(k, value.ravel() if isinstance(value, np.ndarray) else value)
+                    if changed:
+                        self.server.set_pv(k, value)
+                    else:
+                        self.pvDB[k].flag = False
+                except Exception:
+                    logger.exception('Failed to publish %s', k)
+            self._snapshot = snapshot
+            self.updatePVs()
+
+    def _changed(self, reason: str, value) -> bool:
+        """
+        Returns whether a new value of a derived PV is posted to monitors, as an EPICS record would: numbers once
+        they moved by more than MDEL or ADEL since they were last posted for that deadband, anything else once it
+        differs. Images are compared by a digest of their content. A deadband of -1 posts every value.
 
-    def _on_update(self, reason: str | None, value):
-        """Updates the model outputs with new values, and updates PVA PVs"""
-        self.write(reason, value)
-        self._update_all_outputs()
+        Parameters
+        ----------
+        reason : str
+            PV name
+        value : Any
+            New value
+
+        Returns
+        -------
+        bool
+            Whether to post the value, which is then recorded as posted
+        """
+        mdel, adel = self._deadbands.get(reason, (0.0, 0.0))
+        last = self._posted.get(reason)
+        if isinstance(value, np.ndarray) and value.ndim > 1:
+            digest = (value.shape, value.dtype.str, zlib.crc32(np.ascontiguousarray(value).view(np.uint8)))
+            if digest == last and mdel >= 0:
+                return False
+            self._posted[reason] = digest
+            return True
+
+        try:
+            new = np.array(value, dtype=float)
+        except (TypeError, ValueError):
+            new = None
+        if new is None or not isinstance(last, tuple) or np.shape(last[0]) != new.shape:
+            if new is None and reason in self._posted and last == value and mdel >= 0:
+                return False
+            self._posted[reason] = (new, new) if new is not None else value
+            return True
+
+        mlst, alst = last
+        post_monitor = mdel < 0 or bool(np.any((np.abs(new - mlst) > mdel) | (np.isnan(new) != np.isnan(mlst))))
+        post_archive = adel < 0 or bool(np.any((np.abs(new - alst) > adel) | (np.isnan(new) != np.isnan(alst))))
+        if post_monitor or post_archive:
+            self._posted[reason] = (new if post_monitor else mlst, new if post_archive else alst)
+        return post_monitor or post_archive
+
+    def _run_worker(self):
+        """Applies queued puts in batches and publishes the derived PVs they affect"""
+        while True:
+            batch = [self._requests.get()]
+
+            # Coalesce puts that arrive within the window, and anything already queued, into the same batch
+            deadline = time.monotonic() + self.coalesce_window
+            while True:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        batch.append(self._requests.get(timeout=remaining))
+                    else:
+                        batch.append(self._requests.get_nowait())
+                except queue.Empty:
+                    break
+
+            self.metrics.set_gauge('batch_size', len(batch))
+            self.metrics.set_gauge('queue_depth', self._requests.qsize())
+            with self._lock:
+                # The timings of this batch show up in the VIRT:PERF PVs of the next one
+                pending = set(self._perf_pvs)
+                for reason, value, _, _ in batch:
+                    if reason is None:
+                        # Render request queued by read
+                        continue
+                    try:
+                        self._apply(reason, value)
+                    except Exception:
+                        logger.exception('Failed to apply put to %s', reason)
+                    pending.update(self._dependents.get(reason, ()))
+                self._update_outputs(self._defer_images(pending))
+                self._hand_over()
+
+            now = time.perf_counter()
+            for _, _, done, queued in batch:
+                if done:
+                    done()
+                self.metrics.observe('put', now - queued)
+
+            if self.metrics_file:
+                self._write_metrics()
+
+    def _defer_images(self, pending: set) -> set:
+        """
+        Drops the image PVs that are not rendered now from a refresh, and adds those that were requested.
+        At full fidelity the images of watched screens are rendered, at adaptive fidelity only those that were read.
+        Images read over CA recently are rendered at both. The gradient PVs are likewise only computed while watched
+        or recently read, or once requested, at every fidelity.
+
+        Parameters
+        ----------
+        pending : set
+            PV names to refresh
+
+        Returns
+        -------
+        set
+            PV names to refresh now
+        """
+        with self._image_lock:
+            requested, self._image_requests = self._image_requests, set()
+        images = {k for k in pending if 'Image:ArrayData' in k}
+        if self.fidelity == self.FIDELITY_FULL:
+            images = {k for k in images if not self.server.is_watched(k)}
+        if self.fidelity != self.FIDELITY_FAST:
+            # Rendered with the batch, so a read after a completed put sees its effect
+            images = {k for k in images if not self._recently_read(k)}
+        self._stale_images |= images
+        if self.fidelity != self.FIDELITY_FAST:
+            images -= requested
+            pending |= requested & self._stale_images
+        self._stale_images -= pending - images
+
+        gradients = {k for k in pending if k in self.GRADIENT_OUTPUTS
+                     and not self.server.is_watched(k) and not self._recently_read(k)}
+        self._stale_gradients |= gradients
+        gradients -= requested
+        pending |= requested & self._stale_gradients
+        self._stale_gradients -= pending - gradients
+        # Streamed images are published by their stream
+        return pending - images - gradients - self._streams.keys()
+
+    def _on_watch(self, reason: str, watched: bool):
+        """Renders a stale image, or computes stale gradients, once a PVA client connects to it"""
+        if watched:
+            self._request_image(reason)
+
+    def _request_image(self, reason: str):
+        """
+        Queues the rendering of a stale image, unless the fidelity renders no images, or the computation of
+        stale gradients, unless it is already queued
+        """
+        stale = reason in self._stale_images and self.fidelity != self.FIDELITY_FAST \
+            or reason in self._stale_gradients
+        if not stale:
+            return
+        with self._image_lock:
+            if reason in self._image_requests:
+                return
+            self._image_requests.add(reason)
+        self._requests.put((None, reason, None, time.perf_counter()))
+
+    def refresh(self, reason: str, done: Callable[[], None]):
+        """
+        Calls done once a stale image or gradient PV was refreshed and posted, or right away if it is not stale.
+        Counts as a read, see READ_INTEREST_WINDOW.
+
+        Parameters
+        ----------
+        reason : str
+            PV name
+        done : Callable
+            Called without arguments, from the worker if the PV is stale
+        """
+        self._reads[reason] = time.monotonic()
+        stale = reason in self._stale_images and self.fidelity != self.FIDELITY_FAST \
+            or reason in self._stale_gradients
+        if not stale:
+            done()
+            return
+        self._request_image(reason)
+        # Completed with the batch that renders the request queued before it, or a later one
+        self._requests.put((None, None, done, time.perf_counter()))
+
+    def _recently_read(self, reason: str) -> bool:
+        """Returns whether a PV was read over CA within READ_INTEREST_WINDOW"""
+        return time.monotonic() - self._reads.get(reason, -np.inf) < self.READ_INTEREST_WINDOW
+
+    def _write_metrics(self):
+        """Dumps the metrics, together with the cache counters, for a local scraper"""
+        for k, v in self.cache_stats.items():
+            self.metrics.set_gauge(f'cache_{k}', v)
+        try:
+            self.metrics.write(self.metrics_file)
+        except OSError:
+            logger.exception('Failed to write metrics to %s', self.metrics_file)
+
+    def _invalidate(self, element_name: str | None = None):
+        """
+        Marks the model outputs stale after a machine setting changed
+
+        Parameters
+        ----------
+        element_name : str | None
+            Element that changed. Tracking resumes from the checkpoint just upstream of it.
+            If None, the beam is re-tracked from the start of the segment.
+        """
+        self._dirty = True
+        self._stale_from = min(self._stale_from, self._section_of.get(element_name, 0))
+        # Only the fused map of the section holding the changed element is recomputed
+        if element_name is None:
+            self._fused_maps.clear()
+        else:
+            self._fused_maps.pop(self._section_of.get(element_name), None)
+
+    def _build_sections(self):
+        """
+        Splits the segment into sections that each start at a controllable element or at an element
+        that does not have a linear map (such as an aperture), so the rest of each section is linear
+        """
+        elements = list(self.sim_beamline.elements)
+        starts = [0] + [i for i, element in enumerate(elements) if i > 0 and
+                        (isinstance(element, (Quadrupole, TransverseDeflectingCavity, Screen))
+                         or not element.is_skippable)]
+        ends = starts[1:] + [len(elements)]
+
+        self._sections = [Segment(elements=elements[a:b]) for a, b in zip(starts, ends)]
+        self._section_rests = [Segment(elements=elements[a + 1:b]) if b - a > 1 else None
+                               for a, b in zip(starts, ends)]
+        self._optics_sections = [None] * len(self._sections)
+        self._section_maps = {}
+        self._fused_maps = {}
+        self._section_lengths = [sum(element.length.item() for element in elements[a:b]) for a, b in zip(starts, ends)]
+        self._element_s = np.cumsum([element.length.item() for element in elements])
+        self._fast_optics_key = None
+        self._build_bpm_index()
+        # The fast path merges the elements that a ParameterBeam can be tracked through
+        self._fast_plan = []
+        for element in elements:
+            if isinstance(element, self.LINEARIZED_ELEMENTS):
+                self._fast_plan.append(element)
+            elif self._fast_plan and isinstance(self._fast_plan[-1], list):
+                self._fast_plan[-1].append(element)
+            else:
+                self._fast_plan.append([element])
+        self._fast_plan = [step if isinstance(step, self.LINEARIZED_ELEMENTS) else Segment(elements=step)
+                           for step in self._fast_plan]
+        self._checkpoints = [None] * len(self._sections)
+        self._section_of = {}
+        for n, (a, b) in enumerate(zip(starts, ends)):
+            for element in elements[a:b]:
+                self._section_of.setdefault(element.name, n)
+        self._stale_from = 0
+
+    def _settings(self) -> list:
+        """Returns the machine setting vector: every quad k1, TCAV voltage and phase, and screen position"""
+        if self._elements is None:
+            self._build_index()
+        settings = []
+        for element in self._settable:
+            if isinstance(element, Quadrupole):
+                settings.append(element.k1.item())
+            elif isinstance(element, TransverseDeflectingCavity):
+                settings += [element.voltage.item(), element.phase.item()]
+            elif isinstance(element, Screen):
+                settings.append(float(element.is_active))
+        return settings
+
+    def _cache_context(self) -> str:
+        """Returns a digest of the lattice layout and the incoming beam, which the cached results also depend on"""
+        if self._context is None:
+            self._context = TrackingCache.make_context(self.sim_beamline, self.sim_beam)
+        return self._context
+
+    def _track(self, key: str) -> ParticleBeam:
+        """
+        Tracks the beam through the segment
+
+        Parameters
+        ----------
+        key : str
+            Cache key of the current settings
+
+        Returns
+        -------
+        ParticleBeam
+            Beam at the end of the segment
+        """
+        if self._sections is None:
+            self._build_sections()
+
+        # Everything upstream of the first changed section still holds, resume from its checkpoint
+        start = self._stale_from
+        beam = self._checkpoints[start] if start > 0 else self.sim_beam
+        with self.metrics.timer('track'):
+            for n in range(start, len(self._sections)):
+                self._checkpoints[n] = beam
+                # The linear elements of a section are applied as one fused map, an element without a map
+                # (such as a TCAV or an inserted screen) is tracked on its own
+                first = self._sections[n].elements[0]
+                if first.is_skippable:
+                    if self._optics_enabled:
+                        # The moments after the first element come from its map
+                        first_exit = first.track(self._optics_exit(n - 1) if n > 0 else beam.as_parameter_beam())
+                    beam = self._apply_fused_map(n, beam, self._section_lengths[n])
+                else:
+                    beam = first.track(beam)
+                    if self._optics_enabled:
+                        first_exit = beam.as_parameter_beam()
+                    if self._section_rests[n] is not None:
+                        beam = self._apply_fused_map(n, beam, self._section_lengths[n] - first.length.item())
+                # The linear rest of the section only needs the maps, see _section_optics
+                if self._optics_enabled:
+                    self._optics_sections[n] = self._section_optics(n, first_exit)
+
+        self._stale_from = len(self._sections)
+        self._tracked_key = key
+        self._exit_beam = beam
+        return beam
+
+    def exit_beam(self) -> ParticleBeam:
+        """Returns the beam at the end of the segment for the current settings, tracking it if needed"""
+        with self._lock:
+            self._simulate()
+            if self._tracked_key != self._result_key or self._exit_beam is None:
+                self._track(self._result_key)
+            return self._exit_beam
+
+    def set_exit_beam_callback(self, callable: Callable[[ParticleBeam], None]):
+        """
+        Sets the callback that hands the beam at the end of the segment over to a downstream area.
+        It is called now, and after every batch of puts that changed the beam.
+
+        Parameters
+        ----------
+        callable : Callable
+            Method to use, or none to clear
+        """
+        with self._lock:
+            self._exit_beam_callback = callable
+            self._handed_over_key = None
+            self._hand_over()
+
+    def _hand_over(self):
+        """Calls the exit beam callback if the settings or the incoming beam changed since it was last called"""
+        if self._exit_beam_callback is None:
+            return
+        key = TrackingCache.make_key(self._cache_context(), self._settings())
+        if key == self._handed_over_key:
+            return
+        try:
+            self._exit_beam_callback(self.exit_beam())
+        except Exception:
+            logger.exception('Failed to hand over the exit beam')
+        self._handed_over_key = key
+
+    def set_incoming_beam(self, beam: ParticleBeam):
+        """Queues the replacement of the incoming beam, such as by the exit beam of an upstream area"""
+        self._requests.put((self.INCOMING_BEAM, beam, None, time.perf_counter()))
+
+    def _set_incoming_beam(self, beam: ParticleBeam):
+        """Replaces the incoming beam, everything is re-tracked from the start of the segment"""
+        self._particle_beam = beam
+        self.sim_beam = None
+        self._initial_context = None
+        self._context = None
+        self._tracked_key = None
+        self._parameter_beam = None
+        self._fast_key = None
+        self._fast_optics_key = None
+        self._invalidate()
+
+    def _simulate(self) -> dict:
+        """
+        Returns the model outputs for the current settings. Tracks only if a setting changed
+        since the last evaluation and the new settings are not in the cache.
+
+        Returns
+        -------
+        dict
+            Result with 'moments' (beam moments at the end of the segment) and 'readings' (screen images)
+        """
+        if not self._dirty and self._result is not None:
+            return self._result
+
+        key = TrackingCache.make_key(self._cache_context(), self._settings())
+        result = self._cache.get(key)
+        if result is None or self._optics_enabled and 'optics' not in result:
+            beam = self._track(key)
+            result = {
+                'moments': {
+                    'emittance_x': beam.emittance_x.item(),
+                    'emittance_y': beam.emittance_y.item(),
+                    'mu_x': beam.mu_x.item(),
+                    'mu_y': beam.mu_y.item(),
+                    'sigma_x': beam.sigma_x.item(),
+                    'sigma_y': beam.sigma_y.item(),
+                },
+                'readings': {},
+            }
+            if self._optics_enabled:
+                result['optics'] = self._optics_table(self._optics_sections)
+            self._cache.put(key, result)
+
+        self._result, self._result_key = result, key
+        self._dirty = False
+        return result
+
+    def _simulate_fast(self) -> dict:
+        """
+        Returns the beam moments at the end of the segment for the current settings from a tracked ParameterBeam.
+        Screen readings are left as they were, so the particle images stay valid.
+
+        Returns
+        -------
+        dict
+            Beam moments, with the same keys as the 'moments' of _simulate
+        """
+        key = TrackingCache.make_key(self._cache_context(), self._settings())
+        if key == self._fast_key:
+            return self._fast_moments
+
+        if self._sections is None:
+            self._build_sections()
+        if self._parameter_beam is None:
+            self._parameter_beam = self.sim_beam.as_parameter_beam()
+
+        beam = self._parameter_beam
+        with self.metrics.timer('track_fast'), self._keep_read_beams():
+            for step in self._fast_plan:
+                if isinstance(step, self.LINEARIZED_ELEMENTS):
+                    beam = track_linearized(step, beam)
+                else:
+                    beam = step.track(beam)
+
+        self._fast_moments = {
+            'emittance_x': beam.emittance_x.item(),
+            'emittance_y': beam.emittance_y.item(),
+            'mu_x': beam.mu_x.item(),
+            'mu_y': beam.mu_y.item(),
+            'sigma_x': beam.sigma_x.item(),
+            'sigma_y': beam.sigma_y.item(),
+        }
+        self._fast_key = key
+        return self._fast_moments
+
+    def _moments(self) -> dict:
+        """Returns the beam moments at the end of the segment at the current fidelity"""
+        if self.fidelity == self.FIDELITY_FULL:
+            return self._simulate()['moments']
+        return self._simulate_fast()
+
+    @contextmanager
+    def _keep_read_beams(self):
+        """Restores the read beams of the screens afterwards, as tracking a ParameterBeam replaces them"""
+        screens = [(element, element.get_read_beam()) for element in self._settable if isinstance(element, Screen)]
+        try:
+            yield
+        finally:
+            for screen, read_beam in screens:
+                screen.set_read_beam(read_beam)
+
+    def _transfer_maps(self, n: int, energy: torch.Tensor, species) -> torch.Tensor:
+        """
+        Returns the transfer maps of section n from the exit of its first element to the exit of each following
+        element. These elements are not controllable, so the maps only change with the energy.
+
+        Parameters
+        ----------
+        n : int
+            Section index
+        energy : torch.Tensor
+            Reference energy at the exit of the first element
+        species : Species
+            Particle species of the beam
+
+        Returns
+        -------
+        torch.Tensor
+            Cumulative maps, shape (number of elements - 1, 7, 7)
+        """
+        key = (n, energy.item())
+        maps = self._section_maps.get(key)
+        if maps is None:
+            total = torch.eye(7, dtype=energy.dtype)
+            maps = []
+            for element in self._sections[n].elements[1:]:
+                total = element.first_order_transfer_map(energy, species) @ total
+                maps.append(total)
+            maps = torch.stack(maps) if maps else torch.empty((0, 7, 7), dtype=energy.dtype)
+            self._section_maps[key] = maps
+        return maps
+
+    def _fused_map(self, n: int, energy: torch.Tensor, species) -> torch.Tensor:
+        """
+        Returns the transfer map of the linear elements of section n composed into one: the whole section if its
+        first element has a map, else the rest of the section after it. The map is kept until a setting of the
+        section changes, see _invalidate, or the energy does.
+
+        Parameters
+        ----------
+        n : int
+            Section index
+        energy : torch.Tensor
+            Reference energy of the beam entering the linear elements
+        species : Species
+            Particle species of the beam
+
+        Returns
+        -------
+        torch.Tensor
+            Transfer map, shape (7, 7)
+        """
+        fused = self._fused_maps.get(n)
+        if fused is not None and fused[0] == energy.item():
+            return fused[1]
+
+        first = self._sections[n].elements[0]
+        maps = self._transfer_maps(n, energy, species)
+        tm = maps[-1] if len(maps) else torch.eye(7, dtype=energy.dtype)
+        if first.is_skippable:
+            tm = tm @ first.first_order_transfer_map(energy, species)
+        tm = tm.detach()
+        self._fused_maps[n] = (energy.item(), tm)
+        return tm
+
+    def _apply_fused_map(self, n: int, beam: ParticleBeam, length: float) -> ParticleBeam:
+        """Tracks the particles through the linear elements of section n with one product, see _fused_map"""
+        tm = self._fused_map(n, beam.energy, beam.species).to(beam.particles.dtype)
+        return ParticleBeam(particles=beam.particles @ tm.transpose(-2, -1), energy=beam.energy,
+                            particle_charges=beam.particle_charges,
+                            survival_probabilities=beam.survival_probabilities, s=beam.s + length,
+                            species=beam.species)
+
+    def _section_optics(self, n: int, first_exit: ParameterBeam) -> tuple:
+        """
+        Propagates the beam moments through the linear rest of section n in one batched product
+
+        Parameters
+        ----------
+        n : int
+            Section index
+        first_exit : ParameterBeam
+            Beam moments at the exit of the first element of the section
+
+        Returns
+        -------
+        tuple
+            (mu, cov, first_exit): centroids (k, 7) and covariance matrices (k, 7, 7) at the exit of each of the
+            k elements of the section, and the beam they were computed from
+        """
+        maps = self._transfer_maps(n, first_exit.energy, first_exit.species)
+        mu = torch.cat([first_exit.mu.unsqueeze(0), (maps @ first_exit.mu.unsqueeze(-1)).squeeze(-1)])
+        cov = torch.cat([first_exit.cov.unsqueeze(0), maps @ first_exit.cov @ maps.transpose(-2, -1)])
+        return mu.detach(), cov.detach(), first_exit
+
+    def _optics_exit(self, n: int) -> ParameterBeam:
+        """Returns the beam moments at the exit of section n"""
+        mu, cov, first_exit = self._optics_sections[n]
+        return ParameterBeam(mu[-1], cov[-1], first_exit.energy, total_charge=first_exit.total_charge,
+                             species=first_exit.species)
+
+    def _optics_table(self, sections: list) -> dict:
+        """
+        Computes the beam statistics at the exit of every element from the moments of each section
+
+        Parameters
+        ----------
+        sections : list
+            Result of _section_optics for every section
+
+        Returns
+        -------
+        dict
+            Arrays of s, mu_x/y, sigma_x/y, beta_x/y, alpha_x/y (m, rad) and charge (C), one point per element
+        """
+        mu = torch.cat([mu for mu, _, _ in sections]).cpu().numpy()
+        cov = torch.cat([cov for _, cov, _ in sections]).cpu().numpy()
+        charge = np.concatenate([np.full(len(mu), abs(first_exit.total_charge.item()))
+                                 for mu, _, first_exit in sections])
+        table = {'s': self._element_s + self._s_offset, 'charge': charge}
+        for plane, i in (('x', 0), ('y', 2)):
+            # Geometric emittance, as for the Twiss parameters of cheetah's beams
+            emittance = np.sqrt(np.maximum(cov[:, i, i] * cov[:, i + 1, i + 1] - cov[:, i, i + 1] ** 2, 0))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                table[f'beta_{plane}'] = cov[:, i, i] / emittance
+                table[f'alpha_{plane}'] = -cov[:, i, i + 1] / emittance
+            table[f'mu_{plane}'] = mu[:, i]
+            table[f'sigma_{plane}'] = np.sqrt(cov[:, i, i])
+        return table
+
+    def _simulate_fast_optics(self) -> dict:
+        """Returns the optics table for the current settings from a tracked ParameterBeam, see _optics_table"""
+        key = TrackingCache.make_key(self._cache_context(), self._settings())
+        if key == self._fast_optics_key:
+            return self._fast_optics
+
+        if self._sections is None:
+            self._build_sections()
+        if self._parameter_beam is None:
+            self._parameter_beam = self.sim_beam.as_parameter_beam()
+
+        sections = []
+        beam = self._parameter_beam
+        with self.metrics.timer('track_fast'), self._keep_read_beams():
+            for n, section in enumerate(self._sections):
+                first = section.elements[0]
+                first_exit = track_linearized(first, beam) if isinstance(first, self.LINEARIZED_ELEMENTS) \
+                    else first.track(beam)
+                mu, cov, _ = optics = self._section_optics(n, first_exit)
+                sections.append(optics)
+                beam = ParameterBeam(mu[-1], cov[-1], first_exit.energy, total_charge=first_exit.total_charge,
+                                     species=first_exit.species)
+
+        self._fast_optics = self._optics_table(sections)
+        self._fast_optics_key = key
+        return self._fast_optics
+
+    def _optics(self) -> dict | None:
+        """Returns the optics table at the current fidelity, None if no PV publishes it"""
+        if not self._optics_enabled:
+            return None
+        if self.fidelity == self.FIDELITY_FULL:
+            return self._simulate()['optics']
+        return self._simulate_fast_optics()
+
+    def _build_bpm_index(self):
+        """
+        Finds the element whose exit each BPM reads. A BPM that is not an element of the segment is placed by
+        its s position, with the offset between the s of the devices (sum_l_meters) and the s along the segment
+        taken from the devices that are elements. BPMs outside the segment are left out.
+        """
+        row_of = {}
+        for i, element in enumerate(self.sim_beamline.elements):
+            row_of.setdefault(element.name, i)
+        offsets = [device['metadata']['sum_l_meters'] - self._element_s[row_of[device['madname']]]
+                   for device in self.devices.values()
+                   if device['madname'] in row_of and device.get('metadata', {}).get('sum_l_meters') is not None]
+        self._s_offset = float(np.median(offsets)) if offsets else 0.0
+        self._bpm_rows = {}
+        for name, device in self.devices.items():
+            if device.get('metadata', {}).get('type') != 'BPM':
+                continue
+            if device['madname'] in row_of:
+                self._bpm_rows[name] = row_of[device['madname']]
+            elif device['metadata'].get('sum_l_meters') is not None:
+                s = device['metadata']['sum_l_meters'] - self._s_offset
+                if -1e-3 <= s <= self._element_s[-1] + 1e-3:
+                    self._bpm_rows[name] = int(np.argmin(np.abs(self._element_s - s)))
+        logger.debug('BPM elements: %s', self._bpm_rows)
+
+    def _bpm_row(self, control_name: str) -> int | None:
+        """Returns the element whose exit a BPM reads, None if the BPM is outside the segment"""
+        if self._sections is None:
+            self._build_sections()
+        return self._bpm_rows.get(control_name)
+
+    @property
+    def cache_stats(self) -> dict:
+        """Returns the tracking cache counters"""
+        return self._cache.stats
+
+    def _on_update(self, reason: str | None, value, done: Callable[[], None] | None = None):
+        """Queues a PVA put for the simulation worker, done is called once its effect is published"""
+        self._requests.put((reason, value, done, time.perf_counter()))
 
     def set_param(self, reason, value):
-        self.setParam(reason, value)
+        if reason in self.pvDB:
+            self.setParam(reason, value)
+        else:
+            # CA field PV that no client searched for yet, it is created with this value
+            self.server.set_field_value(reason, value)
         self.server.set_pv(reason, value)
 
     def set_defaults(self, enum_init_values):
@@ -361,20 +1720,51 @@ class SimDriver(Driver):
         screens = { element.name: element.is_active for element
                    in self.sim_beamline.elements if isinstance(element,Screen)
         }
-        pprint.pprint(screens)
+        logger.debug('Screen positions: %s', screens)
 
         for screen in screens: 
             name = self.madname_to_control(screen)
+            if name is None:
+                continue
             position = 1 if screens[screen] else 0
-            print(f"{name} : {position}")
+            logger.debug('%s : %s', name, position)
             pv = name + ":PNEUMATIC"
             self.set_param(pv , position)
-            self.move_screen(name, screens[screen])
+            self.move_screen(screen, position)
+
+    def set_defaults_for_roi(self):
+        """Sets the region of interest and image size of every screen to its sensor, the pvdb has one default size"""
+        for control_name, device in self.devices.items():
+            screen = self._element(device['madname'])
+            if not isinstance(screen, Screen):
+                continue
+            width, height = screen.effective_resolution
+            if f'{control_name}:MinX' in self.server.pva_pvs:
+                for field, value in zip(self.ROI_FIELDS, (0, width, 0, height, 1, 1)):
+                    self.set_param(f'{control_name}:{field}', value)
+            pvs = device['pvs']
+            if 'n_row' in pvs and 'n_col' in pvs:
+                self.set_param(pvs['n_row'], width)
+                self.set_param(pvs['n_col'], height)
 
     def madname_to_control(self,madname):
-        for name in self.devices:
-            if self.devices[name]["madname"] == madname:
-                return name
+        return self._control_of.get(madname)
+
+    def _build_index(self):
+        """Builds the madname -> element index of the simulation beamline"""
+        self._elements = {}
+        for element in self.sim_beamline.elements:
+            # Keep the first occurrence, like list.index would
+            self._elements.setdefault(element.name, element)
+        # Elements whose settings make up the cache key
+        self._settable = [element for element in self.sim_beamline.elements
+                          if isinstance(element, (Quadrupole, TransverseDeflectingCavity, Screen))]
+
+    def _element(self, madname: str):
+        """Returns the element of the simulation beamline with the given madname, or None if it is not in the segment"""
+        if self._elements is None:
+            self._build_index()
+        return self._elements.get(madname)
 
     @property
     def sim_beam(self) -> ParticleBeam:
@@ -402,13 +1792,16 @@ class SimDriver(Driver):
         """Return the beamline, initializing if necessary."""
         if not hasattr(self, "_sim_beamline") or hasattr(self,"_sim_beamline") and self._sim_beamline is None:
             if self._beamline:
-                self._sim_beamline = self._beamline
+                # Puts change the elements in place, the given segment stays pristine for reset_sim
+                self._sim_beamline = copy.deepcopy(self._beamline)
             elif self._lattice_file:
-                print(self._lattice_file)
+                logger.info('Loading lattice %s', self._lattice_file)
                 self._sim_beamline = Segment.from_lattice_json(self._lattice_file)
-                self._sim_beamline.track(self.sim_beam)
             else:
                 raise ValueError("Provide either a lattice file or a Segment instance.")
+            self._sections = None
+            self._elements = None
+            self._invalidate()
         return self._sim_beamline
     
     @sim_beamline.setter
@@ -430,176 +1823,730 @@ class SimDriver(Driver):
         return self.sim_beam.emittance_y.item()
 
     def get_madname(self, control_name):
-        if control_name in self.devices:
-            madname = self.devices[control_name]["madname"]
-            return madname
-        return None
+        return self._madname_of.get(control_name)
     
     def reset_sim(self):
         """Resets sim_beam and sim_beamline to original state"""
-        print('Resetting simulation')
+        logger.info('Resetting simulation')
         self.sim_beam = None
         self.sim_beamline = None
-
+        self._context = self._initial_context
+        self._tracked_key = None
+        self._sections = None
+        self._parameter_beam = None
+        self._fast_key = None
+        self._invalidate()
+        self._build_index()
 
     def set_quad_value(self, quad_name: str, quad_value: float) -> None:
         """ Takes quad ctrl name and the k1 strength if the quad is in beamline"""
-        names = [element.name for element in self.sim_beamline.elements]
-        if quad_name in names:
-            index_num = names.index(quad_name)
-            length = (self.sim_beamline.elements[index_num].length).item()
+        quad = self._element(quad_name)
+        if quad is not None:
+            length = quad.length.item()
             energy = self.sim_beam.energy.item()
             kmod = bdes_to_kmod(e_tot=energy, effective_length=length, bdes = quad_value)
-            self.sim_beamline.elements[index_num].k1 = torch.tensor(kmod)
-            print(f"""Quad in segment with name {quad_name}
-                   set to kmod {kmod} with quad value {quad_value}""")
+            quad.k1 = torch.tensor(kmod)
+            self._invalidate(quad_name)
+            logger.debug('Quad in segment with name %s set to kmod %s with quad value %s', quad_name, kmod, quad_value)
             
     def get_quad_value(self, quad_name: str)-> float:
         """Retrieve quadrupole strength from the simulation beamline."""
-        names = [element.name for element in self.sim_beamline.elements]
-        if quad_name in names:
-            index_num = names.index(quad_name)
-            kmod = self.sim_beamline.elements[index_num].k1.item()
-            length = self.sim_beamline.elements[index_num].length.item()
+        quad = self._element(quad_name)
+        if quad is not None:
+            kmod = quad.k1.item()
+            length = quad.length.item()
             energy = self.sim_beam.energy.item()
             quad_value = kmod_to_bdes(e_tot= energy, effective_length = length, k = kmod)
-            print(f"kmod is {kmod} with quad_value {quad_value}")
+            logger.debug('kmod is %s with quad_value %s', kmod, quad_value)
         else:
-            print(f"""Warning {quad_name} not in Segment""")
+            logger.debug('%s not in Segment', quad_name)
             quad_value = 0
         return quad_value
     
     def set_tcav_amplitude(self, tcav_name, megavolts_amplitude):
         """ Set transverse cavity strength of simulation beamline takes Mega Volts and sets in Volts"""
-        names = [element.name for element in self.sim_beamline.elements]
-        if tcav_name in names:
-            index_num = names.index(tcav_name)
-            self.sim_beamline.elements[index_num].voltage = torch.tensor(megavolts_amplitude*1e6)
-            print(f"""TCAV in segment with name {tcav_name}
-                   set to {megavolts_amplitude*1e6 } volts""")
+        tcav = self._element(tcav_name)
+        if tcav is not None:
+            tcav.voltage = torch.tensor(megavolts_amplitude*1e6)
+            self._invalidate(tcav_name)
+            logger.debug('TCAV in segment with name %s set to %s volts', tcav_name, megavolts_amplitude*1e6)
             
     def get_tcav_amplitude(self, tcav_name):
         """Retrieve transverse cavity strength (MV) from the simulation beamline."""
-        names = [element.name for element in self.sim_beamline.elements]
-        if tcav_name in names:
-            index_num = names.index(tcav_name)
-            voltage_amplitude = self.sim_beamline.elements[index_num].voltage.item()
+        tcav = self._element(tcav_name)
+        if tcav is not None:
+            voltage_amplitude = tcav.voltage.item()
             mega_voltage_amplitude = (voltage_amplitude/1e6)
-            print(f"Voltage is is {mega_voltage_amplitude}")
+            logger.debug('Voltage is %s', mega_voltage_amplitude)
         else:
-            print(f"""Warning {tcav_name} not in Segment""")
+            logger.debug('%s not in Segment', tcav_name)
             mega_voltage_amplitude = 0
         return mega_voltage_amplitude
 
     def set_tcav_phase(self, tcav_name, phase_in_degrees):
         """ Set the phase of simulation beamline transverse cavity"""
-        names = [element.name for element in self.sim_beamline.elements]
-        if tcav_name in names:
-            index_num = names.index(tcav_name)
+        tcav = self._element(tcav_name)
+        if tcav is not None:
             phase_in_radians = phase_in_degrees * math.pi/180
-            print(f'phase in radians {phase_in_radians}')
-            self.sim_beamline.elements[index_num].phase= torch.tensor(phase_in_radians)
-            print(f"""TCAV in segment with name {tcav_name}
-                   set to {phase_in_degrees } degrees""")
+            logger.debug('phase in radians %s', phase_in_radians)
+            tcav.phase= torch.tensor(phase_in_radians)
+            self._invalidate(tcav_name)
+            logger.debug('TCAV in segment with name %s set to %s degrees', tcav_name, phase_in_degrees)
             
     def get_tcav_phase(self, tcav_name):
         """Retrieve the phase of the transverse cavity in degrees from the simulation beamline."""
-        names = [element.name for element in self.sim_beamline.elements]
-        if tcav_name in names:
-            index_num = names.index(tcav_name)
-            phase_in_radians = self.sim_beamline.elements[index_num].phase.item()
+        tcav = self._element(tcav_name)
+        if tcav is not None:
+            phase_in_radians = tcav.phase.item()
             phase_in_degrees = phase_in_radians * 180 / math.pi
-            print(f"Phase in degrees is {phase_in_degrees}")
+            logger.debug('Phase in degrees is %s', phase_in_degrees)
         else:
-            print(f"""Warning {tcav_name} not in Segment""")
+            logger.debug('%s not in Segment', tcav_name)
             phase_in_degrees = 0.00
         return phase_in_degrees
 
-    def get_screen_distribution(self, screen_name: str)-> torch.Tensor:
-        """Retrieves image from simulation beamline and adds noise, has 
-        a bug that the first time is called is not addding noise"""
-        self.sim_beamline.track(self.sim_beam)
-        names = [element.name for element in self.sim_beamline.elements]
-        if screen_name in names:
-            index_num = names.index(screen_name)
-            image = self.sim_beamline.elements[index_num].reading
-            #noise_std = 0.2 * (np.max(image) + .0001)
-            #image += np.abs(np.random.normal(loc=0, scale= noise_std , size=image.shape))
-            return image
+    def run_scan(self, variable: str, setpoints, images: bool = False) -> dict:
+        """
+        Evaluates a scan of one input PV over all setpoints with a single batched track. The scanned
+        setting is given a batch dimension and the beam is tracked once from the checkpoint just upstream
+        of the scanned element. The machine settings are left unchanged.
+
+        Parameters
+        ----------
+        variable : str
+            PV to scan, a quad BCTRL or a TCAV AREQ/PREQ
+        setpoints : Sequence[float]
+            Values of the PV, in the PV's units
+        images : bool
+            Also return the screen image at every point
+
+        Returns
+        -------
+        dict
+            Per-point sigma_x/y, mu_x/y, emittance_x/y at the end of the segment, plus 'images' if requested
+        """
+        control_name, field = variable.rsplit(':', 1)
+        madname = self._madname_of.get(control_name)
+        element = self._element(madname)
+        if element is None:
+            raise ValueError(f'{variable} is not in the simulated segment')
+
+        setpoints = np.asarray(setpoints, dtype=float)
+        if 'QUAD' in control_name and field == 'BCTRL':
+            attr = 'k1'
+            values = bdes_to_kmod(e_tot=self.sim_beam.energy.item(), effective_length=element.length.item(), bdes=setpoints)
+        elif 'TCAV' in control_name and field == 'AREQ':
+            attr, values = 'voltage', setpoints * 1e6
+        elif 'TCAV' in control_name and field == 'PREQ':
+            attr, values = 'phase', setpoints * math.pi / 180
+        else:
+            raise ValueError(f'Scanning {variable} is not supported')
+
+        with self._lock:
+            # The checkpoints must hold the beam for the current settings
+            self._simulate()
+            if self._tracked_key != self._result_key:
+                self._track(self._result_key)
+
+            start = self._section_of[madname]
+            original = getattr(element, attr)
+            setattr(element, attr, torch.as_tensor(values, dtype=original.dtype))
+            try:
+                beam = self._checkpoints[start] if start > 0 else self.sim_beam
+                for section in self._sections[start:]:
+                    beam = section.track(beam)
+
+                result = {k: getattr(beam, k).detach().cpu().numpy()
+                          for k in ['sigma_x', 'sigma_y', 'mu_x', 'mu_y', 'emittance_x', 'emittance_y']}
+                if images:
+                    screen = self._element(self._madname_of[self.screen])
+                    stack = screen.reading.detach().cpu().numpy()
+                    # A screen upstream of the scanned element sees the same beam at every point
+                    result['images'] = np.broadcast_to(stack, (len(setpoints),) + stack.shape[-2:]).copy()
+            finally:
+                setattr(element, attr, original)
+                # Screens downstream now hold the batched beam, re-track them when a reading is needed
+                self._tracked_key = None
+                self._stale_from = min(self._stale_from, start)
+        return result
+
+    def _gradient_variables(self) -> list:
+        """
+        Returns the settings the gradients are taken with respect to, in the order of the segment
+
+        Returns
+        -------
+        list
+            (PV name, element, attribute, attribute per unit of the PV) for every quad BCTRL and TCAV AREQ/PREQ
+        """
+        if self._elements is None:
+            self._build_index()
+        variables = []
+        for element in self._settable:
+            control_name = self._control_of.get(element.name)
+            if control_name is None or self._elements[element.name] is not element:
+                continue
+            pvs = self.devices[control_name].get('pvs', {})
+            if isinstance(element, Quadrupole) and 'bctrl' in pvs:
+                # k1 is proportional to BCTRL
+                scale = bdes_to_kmod(e_tot=self.sim_beam.energy.item(), effective_length=element.length.item(),
+                                     bdes=1.0)
+                variables.append((pvs['bctrl'], element, 'k1', scale))
+            elif isinstance(element, TransverseDeflectingCavity):
+                if 'amp_set' in pvs:
+                    variables.append((pvs['amp_set'], element, 'voltage', 1e6))
+                if 'phase_set' in pvs:
+                    variables.append((pvs['phase_set'], element, 'phase', math.pi / 180))
+        return variables
+
+    def gradients(self) -> dict:
+        """
+        Returns the gradient of the beam moments at the end of the segment with respect to every quad BCTRL and
+        TCAV AREQ/PREQ. The settings are made leaf tensors, the beam is tracked once at the current fidelity and
+        all moments are differentiated in one batched backward pass. The machine settings are left unchanged.
+
+        Returns
+        -------
+        dict
+            Per moment (sigma_x/y, mu_x/y, emittance_x/y) an array of its derivative with respect to each
+            setting, in m per unit of the PV, in the order of _gradient_variables
+        """
+        key = TrackingCache.make_key(self._cache_context(), self._settings() + [self.fidelity])
+        if key == self._gradient_key:
+            return self._gradients
+
+        moments = list(dict.fromkeys(self.GRADIENT_OUTPUTS.values()))
+        with self._lock, self.metrics.timer('gradient'):
+            # The beam entering the tracked elements must be that of the current settings
+            if self.fidelity == self.FIDELITY_FULL:
+                self._simulate()
+                if self._tracked_key != self._result_key:
+                    self._track(self._result_key)
+            else:
+                self._simulate_fast()
+
+            variables = self._gradient_variables()
+            originals = [(element, attr, getattr(element, attr)) for _, element, attr, _ in variables]
+            inputs = []
+            try:
+                for _, element, attr, scale in variables:
+                    original = getattr(element, attr)
+                    value = torch.tensor(original.item() / scale, dtype=original.dtype, requires_grad=True)
+                    setattr(element, attr, value * scale)
+                    inputs.append(value)
+
+                with torch.enable_grad(), self._keep_read_beams():
+                    beam = self._track_differentiable(variables)
+                    outputs = torch.stack([getattr(beam, k) for k in moments])
+                    if inputs and outputs.requires_grad:
+                        grads = self._backward(outputs, inputs)
+                    else:
+                        grads = torch.zeros(len(moments), len(inputs), dtype=outputs.dtype)
+            finally:
+                for element, attr, original in originals:
+                    setattr(element, attr, original)
+
+        grads = grads.detach().cpu().numpy()
+        self._gradients = {k: grads[i] for i, k in enumerate(moments)}
+        self._gradient_key = key
+        return self._gradients
+
+    def _track_differentiable(self, variables: list):
+        """
+        Tracks the beam through the segment for gradients, from the checkpoint upstream of the first setting
+        at full fidelity, else as a ParameterBeam from the start of the segment
+        """
+        if self.fidelity != self.FIDELITY_FULL:
+            beam = self._parameter_beam
+            for step in self._fast_plan:
+                beam = track_linearized(step, beam) if isinstance(step, self.LINEARIZED_ELEMENTS) else step.track(beam)
+            return beam
+
+        start = min((self._section_of[element.name] for _, element, _, _ in variables), default=0)
+        beam = self._checkpoints[start] if start > 0 else self.sim_beam
+        for section in self._sections[start:]:
+            beam = section.track(beam)
+        return beam
+
+    @staticmethod
+    def _backward(outputs: torch.Tensor, inputs: list) -> torch.Tensor:
+        """Returns the Jacobian of outputs with respect to the scalar inputs, one batched vector-Jacobian product"""
+        eye = torch.eye(len(outputs), dtype=outputs.dtype, device=outputs.device)
+        try:
+            grads = torch.autograd.grad(outputs, inputs, grad_outputs=eye, is_grads_batched=True, allow_unused=True)
+            columns = [g if g is not None else torch.zeros_like(outputs) for g in grads]
+        except RuntimeError:
+            # Some operations have no batching rule, fall back to a backward pass per output
+            rows = [torch.autograd.grad(output, inputs, retain_graph=True, allow_unused=True) for output in outputs]
+            columns = [torch.stack([row[j] if row[j] is not None else outputs.new_zeros(()) for row in rows])
+                       for j in range(len(inputs))]
+        return torch.stack([c.reshape(len(outputs)) for c in columns], dim=1)
+
+    def _run_scan_from_pvs(self):
+        """Runs the scan described by the VIRT:SCAN PVs and stores its result for publication"""
+        variable = self.getParam('VIRT:SCAN:VARIABLE')
+        setpoints = self.getParam('VIRT:SCAN:SETPOINTS')
+        images = 'VIRT:SCAN:IMAGES' in self.server.pva_pvs and self.getParam('VIRT:SCAN:IMAGES:ENABLE') == 1
+        try:
+            self._scan_result = self.run_scan(variable, setpoints, images)
+            self.set_param('VIRT:SCAN:STATUS', 1)
+        except Exception as e:
+            logger.error('Scan of %s failed: %s', variable, e)
+            self._scan_result = {}
+            self.set_param('VIRT:SCAN:STATUS', 2)
+
+    def _frame_buffer(self, reason: str, shape: tuple, dtype) -> np.ndarray:
+        """
+        Returns the preallocated buffer to write the next frame of an image PV to. Two buffers are used in turn,
+        so the frame that was published last is never overwritten while a client may still be reading it.
+
+        Parameters
+        ----------
+        reason : str
+            Image PV name
+        shape : tuple
+            Shape of the frame
+        dtype : np.dtype
+            Type of the frame
+
+        Returns
+        -------
+        np.ndarray
+            Contiguous buffer for the frame
+        """
+        buffers = self._frame_buffers.get(reason)
+        if buffers is None or buffers[0].shape != shape or buffers[0].dtype != dtype:
+            buffers = [np.empty(shape, dtype=dtype) for _ in range(2)]
+            self._frame_buffers[reason] = buffers
+        # An unchanged frame is not published, see _update_outputs, so pick the buffer not holding the published one
+        if buffers[0] is self._snapshot.get(reason):
+            buffers.reverse()
+        return buffers[0]
+
+    def _start_stream(self, control_name: str):
+        """
+        Starts streaming a screen: a producer thread renders frames at the screen's FRAME_RATE into a ring buffer
+        and a publisher thread posts them, so neither the worker nor the CA/PVA threads render frames.
+
+        Parameters
+        ----------
+        control_name : str
+            Control name of the screen
+        """
+        pvs = self.devices[control_name]['pvs']
+        if pvs['image'] in self._streams:
+            return
+        stream = {
+            'control_name': control_name,
+            'madname': self._madname_of[control_name],
+            'image': pvs['image'],
+            'rate': pvs.get('ref_rate_vme', f'{control_name}:FRAME_RATE'),
+            'achieved_rate': pvs.get('ref_rate', f'{control_name}:ArrayRate_RBV'),
+            'ring': FrameRing(),
+            'stop': threading.Event(),
+            # Frames skipped because rendering fell behind the frame rate
+            'missed': 0,
+            # Beam position jitter, reproducible with the noise seed
+            'rng': np.random.default_rng(self.noise.seed),
+            # The producer renders outside _lock, so it draws from its own noise sequence
+            'noise': NoiseModel(**{param: getattr(self.noise, param) for param in NoiseModel.PARAMETERS}),
+            'noise_version': self._noise_version,
+        }
+        stream['threads'] = [
+            threading.Thread(target=self._produce_frames, args=(stream,), name=f'{control_name} producer', daemon=True),
+            threading.Thread(target=self._publish_frames, args=(stream,), name=f'{control_name} publisher', daemon=True),
+        ]
+        self._streams[pvs['image']] = stream
+        for thread in stream['threads']:
+            thread.start()
+        logger.info('Streaming %s', control_name)
+
+    def _stop_stream(self, control_name: str):
+        """Stops streaming a screen, if it is"""
+        stream = self._streams.pop(self.devices[control_name]['pvs']['image'], None)
+        if stream is None:
+            return
+        stream['stop'].set()
+        for thread in stream['threads']:
+            thread.join(timeout=5)
+        # The stream posted other frames since, the next rendered frame is posted whatever it holds
+        self._posted.pop(stream['image'], None)
+        self.set_param(stream['achieved_rate'], 0.0)
+        logger.info('Stopped streaming %s', control_name)
+
+    def _jitter(self, stream: dict) -> tuple:
+        """Draws the beam position jitter of the next frame of a stream, in whole pixels (rows, columns)"""
+        if 'VIRT:STREAM:JITTER:X' not in self.server.pva_pvs:
+            return (0, 0)
+        jitter = np.array([self.getParam('VIRT:STREAM:JITTER:Y'), self.getParam('VIRT:STREAM:JITTER:X')]) * 1e-6
+        if not jitter.any():
+            return (0, 0)
+        screen = self._element(stream['madname'])
+        roi = self.get_roi(stream['madname'])
+        binning = np.array([roi[5], roi[4]]) if roi else 1
+        pixel = screen.pixel_size.detach().cpu().numpy()[::-1] * binning
+        return tuple(np.rint(stream['rng'].normal(0, jitter / pixel)).astype(int))
+
+    def _produce_frames(self, stream: dict):
+        """Renders the frames of a stream on schedule, from the latest rendering of the screen"""
+        ring = stream['ring']
+        n_bits = self.server.pvdb[stream['image']].get('n_bits')
+        reading = None
+        unique_id = 0
+        next_time = time.monotonic()
+        while not stream['stop'].is_set():
+            rate = float(self.getParam(stream['rate']))
+            if rate <= 0:
+                stream['stop'].wait(0.1)
+                next_time = time.monotonic()
+                continue
+            period = 1 / rate
+
+            # While the worker holds the model, frames keep coming from the previous rendering.
+            # The fast fidelity renders no images, the stream then repeats the last one.
+            if reading is None or self.fidelity != self.FIDELITY_FAST:
+                if self._lock.acquire(timeout=0.1 if reading is None else 0):
+                    try:
+                        reading = self.get_screen_distribution(stream['madname'])
+                    except Exception:
+                        logger.exception('Failed to render %s', stream['image'])
+                    finally:
+                        self._lock.release()
+                if reading is None:
+                    continue
+
+            if stream['noise_version'] != self._noise_version:
+                stream['noise_version'] = self._noise_version
+                params = {param: getattr(self.noise, param) for param in NoiseModel.PARAMETERS}
+                # Only a new seed restarts the stream's noise sequence
+                if params['seed'] == stream['noise'].seed:
+                    del params['seed']
+                stream['noise'].configure(**params)
+
+            t = time.perf_counter()
+            index, frame = ring.acquire(reading.shape, image_dtype(n_bits) if n_bits else reading.dtype)
+            timestamp = time.time()
+            if n_bits:
+                gain = self._camera_gain(stream['control_name'], reading, n_bits)
+                quantize(reading, n_bits, gain, out=frame, noise=stream['noise'], shift=self._jitter(stream))
+            else:
+                np.copyto(frame, reading)
+            unique_id += 1
+            ring.commit(index, {'unique_id': unique_id, 'timestamp': timestamp})
+            self.metrics.observe('stream_render', time.perf_counter() - t)
+
+            # Frames whose time has already passed are skipped rather than rendered in a burst
+            next_time += period
+            now = time.monotonic()
+            if now > next_time:
+                missed = int((now - next_time) / period)
+                stream['missed'] += missed
+                next_time += missed * period
+            stream['stop'].wait(max(next_time - now, 0))
+
+    def _publish_frames(self, stream: dict):
+        """Posts the frames of a stream as they are rendered, and reports its achieved rate and drops"""
+        ring = stream['ring']
+        control_name = stream['control_name']
+        published = deque()
+        last_report = time.monotonic()
+        while not stream['stop'].is_set():
+            item = ring.pop(timeout=self.STREAM_REPORT_INTERVAL)
+            now = time.monotonic()
+            if item is not None:
+                index, frame, meta = item
+                try:
+                    with self.metrics.timer('stream_post'), self._post_lock:
+                        self.setParam(stream['image'], frame.ravel())
+                        self.server.set_pv(stream['image'], frame, timestamp=meta['timestamp'],
+                                           unique_id=meta['unique_id'])
+                        self.updatePV(stream['image'])
+                        if f'{control_name}:ArrayCounter_RBV' in self.server.pva_pvs:
+                            self.set_param(f'{control_name}:ArrayCounter_RBV', meta['unique_id'])
+                            self.updatePV(f'{control_name}:ArrayCounter_RBV')
+                except Exception:
+                    logger.exception('Failed to publish %s', stream['image'])
+                finally:
+                    ring.release(index)
+                published.append(now)
+
+            if now - last_report >= self.STREAM_REPORT_INTERVAL:
+                while published and published[0] < now - self.STREAM_RATE_WINDOW:
+                    published.popleft()
+                rate = (len(published) - 1) / (published[-1] - published[0]) if len(published) > 1 else 0.0
+                dropped = stream['missed'] + ring.dropped
+                with self._post_lock:
+                    self.set_param(stream['achieved_rate'], rate)
+                    self.updatePV(stream['achieved_rate'])
+                    if f'{control_name}:DroppedArrays_RBV' in self.server.pva_pvs:
+                        self.set_param(f'{control_name}:DroppedArrays_RBV', dropped)
+                        self.updatePV(f'{control_name}:DroppedArrays_RBV')
+                last_report = now
+
+    def get_roi(self, screen_name: str) -> tuple | None:
+        """
+        Returns the region of interest and binning of a screen's image
+
+        Parameters
+        ----------
+        screen_name : str
+            Madname of the screen
+
+        Returns
+        -------
+        tuple | None
+            (min_x, size_x, min_y, size_y, bin_x, bin_y) in pixels, or None for the full frame without binning
+        """
+        control_name = self._control_of.get(screen_name)
+        if f'{control_name}:MinX' not in self.server.pva_pvs:
+            return None
+        roi = tuple(int(self.getParam(f'{control_name}:{field}')) for field in self.ROI_FIELDS)
+        screen = self._element(screen_name)
+        if roi == (0, screen.effective_resolution[0], 0, screen.effective_resolution[1], 1, 1):
+            return None
+        return roi
+
+    def _set_roi(self, reason: str, value):
+        """Sets a region of interest or binning PV, clipped to the sensor, and updates the image size readbacks"""
+        control_name, field = reason.rsplit(':', 1)
+        screen = self._element(self._madname_of[control_name])
+        value = int(value)
+        if screen is not None:
+            width, height = screen.effective_resolution
+            roi = {f: int(self.getParam(f'{control_name}:{f}')) for f in self.ROI_FIELDS}
+            roi[field] = value
+            # Same clipping as areaDetector: the region stays on the sensor and holds at least one binned pixel
+            roi['MinX'] = min(max(roi['MinX'], 0), width - 1)
+            roi['MinY'] = min(max(roi['MinY'], 0), height - 1)
+            roi['BinX'] = min(max(roi['BinX'], 1), width)
+            roi['BinY'] = min(max(roi['BinY'], 1), height)
+            roi['SizeX'] = min(max(roi['SizeX'], roi['BinX']), width - roi['MinX'])
+            roi['SizeY'] = min(max(roi['SizeY'], roi['BinY']), height - roi['MinY'])
+            roi['BinX'] = min(roi['BinX'], roi['SizeX'])
+            roi['BinY'] = min(roi['BinY'], roi['SizeY'])
+            for f, v in roi.items():
+                self.set_param(f'{control_name}:{f}', v)
+            pvs = self.devices[control_name]['pvs']
+            self.set_param(pvs['n_row'], roi['SizeX'] // roi['BinX'])
+            self.set_param(pvs['n_col'], roi['SizeY'] // roi['BinY'])
+        else:
+            self.set_param(reason, value)
+
+    def _camera_gain(self, control_name: str, reading: np.ndarray, n_bits: int) -> float:
+        """
+        Returns the gain of a screen's camera in counts per unit of its reading, the charge on a pixel.
+        A gain of 0 is calibrated on the first frame with beam, so that it peaks at half of full scale, and
+        kept from then on: later frames compare with it, and a brighter beam saturates.
+
+        Parameters
+        ----------
+        control_name : str
+            Screen control name, whose {control_name}:Gain PV holds the gain
+        reading : np.ndarray
+            Reading about to be quantized
+        n_bits : int
+            Bit depth of the camera
+
+        Returns
+        -------
+        float
+            Counts per unit of the reading
+        """
+        name = f'{control_name}:Gain'
+        gain = float(self.getParam(name) or 0.0) if name in self.pvDB else self._gains.get(control_name, 0.0)
+        if gain <= 0:
+            peak = float(reading.max())
+            if peak <= 0:
+                return 0.0
+            gain = 0.5 * ((1 << n_bits) - 1) / peak
+            if name in self.pvDB:
+                self.set_param(name, gain)
+            else:
+                self._gains[control_name] = gain
+        return gain
+
+    def get_screen_distribution(self, screen_name: str)-> np.ndarray:
+        """Retrieves image from simulation beamline, without noise, which is added in camera counts.
+        Only the region of interest of the screen is rendered."""
+        result = self._simulate()
+        screen = self._element(screen_name)
+        if screen is not None:
+            roi = self.get_roi(screen_name)
+            name = screen_name if roi is None else f"{screen_name}:{'_'.join(map(str, roi))}"
+            if name not in result['readings']:
+                # Cache hits skip tracking, so the screen may still hold the reading of other settings
+                if self._tracked_key != self._result_key:
+                    self._track(self._result_key)
+                with self.metrics.timer('render'):
+                    reading = screen.reading if roi is None else render_roi(screen, *roi)
+                    result['readings'][name] = reading.detach().cpu().numpy()
+                self._cache.put(self._result_key, result)
+            return result['readings'][name]
         else: 
-            print(f' else in screen probably returning none')
+            logger.warning('%s not in Segment, no image', screen_name)
   
     def check_screen(self, screen_name):
-        names = [element.name for element in self.sim_beamline.elements]
-        if screen_name in names:
-            index_num = names.index(screen_name)
-            is_active_position = self.sim_beamline.elements[index_num].is_active
-            print(f"screen is in active position: {is_active_position}")
+        screen = self._element(screen_name)
+        if screen is not None:
+            is_active_position = screen.is_active
+            logger.debug('screen is in active position: %s', is_active_position)
             return 1 if is_active_position else 0
         else:
-            print(f"screen device not found in simulated accelerator")
-            return "OUT"
+            logger.debug('screen device not found in simulated accelerator')
+            return 0
         
-    def move_screen(self, screen_name: str, position:str) -> None:
-        """Moves the position of the associated screen"""
-        names = [element.name for element in self.sim_beamline.elements]
-        if screen_name in names:
-            index_num = names.index(screen_name)
-            is_active_position = position == "IN"
-            self.sim_beamline.elements[index_num].is_active = is_active_position
-            print(f"set screen to position: {self.sim_beamline.elements[index_num].is_active}")
+    def move_screen(self, screen_name: str, position) -> None:
+        """Moves the position of the associated screen, position is "IN"/"OUT" or the PNEUMATIC index"""
+        screen = self._element(screen_name)
+        if screen is not None:
+            is_active_position = position == "IN" if isinstance(position, str) else bool(int(position))
+            screen.is_active = is_active_position
+            # A screen that is out no longer sees the beam, rather than keeping the last reading
+            if not is_active_position:
+                screen.set_read_beam(None)
+            self._invalidate(screen_name)
+            logger.debug('set screen to position: %s', screen.is_active)
     
 
     def read(self, reason):
-        #TODO: need logic for which screen is in and out, maybe if self.screen is out and other screen is in change
-        # self.screen
+        value = self._read(reason)
+        if self.server.recorder:
+            self.server.record(GET, reason, value)
+        return value
 
+    def _read(self, reason):
         # For non-simulated PVs, read the value directly
         if reason.rfind('.') != -1:
             return self.getParam(reason)
 
-        print(f' in read with {reason}')
-        if 'Image:ArrayData' in reason and reason.rsplit(':',2)[0] == self.screen:
-            print('reading screen')
-            madname = self.devices[self.screen]["madname"]
+        # Streamed images are answered with the last published frame
+        if reason in self._streams:
+            return self.getParam(reason)
+
+        # The CA thread never waits for the model: a stale image or gradient is answered from the snapshot and
+        # refreshed by the worker. The batches of the puts that follow refresh it before the puts complete.
+        if 'Image:ArrayData' in reason or reason in self.GRADIENT_OUTPUTS:
+            self._reads[reason] = time.monotonic()
+            self._request_image(reason)
+
+        # Derived PVs are answered from the last published snapshot, never by running the simulation
+        value = self._snapshot.get(reason)
+        if value is None:
+            return self.getParam(reason)
+
+        # CA waveforms are flat, hand pcaspy a view rather than a copy
+        if isinstance(value, np.ndarray):
+            return value.ravel()
+        return value
+
+    def _evaluate(self, reason):
+        """Computes the current value of a derived PV from the model"""
+        logger.debug('evaluating %s', reason)
+        if 'Image:ArrayData' in reason and self._element(self._madname_of.get(reason.rsplit(':',2)[0])) is not None:
+            madname = self._madname_of[reason.rsplit(':',2)[0]]
             image_data = self.get_screen_distribution(screen_name = madname)
-            value = image_data.flatten().tolist()
+            n_bits = self.server.pvdb[reason].get('n_bits')
+            if n_bits:
+                # Camera counts with noise, quantized straight into the next frame buffer
+                value = self._frame_buffer(reason, image_data.shape, image_dtype(n_bits))
+                gain = self._camera_gain(reason.rsplit(':', 2)[0], image_data, n_bits)
+                quantize(image_data, n_bits, gain, out=value, noise=self.noise)
+            else:
+                value = self._frame_buffer(reason, image_data.shape, image_data.dtype)
+                np.copyto(value, image_data)
         elif 'PNEUMATIC' in reason:
-            madname = self.devices[self.screen]["madname"]           
+            madname = self._madname_of[reason.rsplit(':',1)[0]]
             value = self.check_screen(madname)
-            print(value)
         elif 'QUAD' in reason and 'BCTRL' in reason or 'BACT' in reason:
             quad_name = reason.rsplit(':',1)[0]
-            madname = self.devices[quad_name]["madname"]
+            madname = self._madname_of[quad_name]
             value = self.get_quad_value(madname)
         #can concat tcav stuff into just getter setters for both amp and phase or keep them separate
         elif 'TCAV' in reason and 'AREQ' in reason:
-            print('reading areq')
             tcav_name = reason.rsplit(':',1)[0]
-            madname = self.devices[tcav_name]["madname"]
+            madname = self._madname_of[tcav_name]
             value = self.get_tcav_amplitude(madname)
         elif 'TCAV' in reason and 'PREQ' in reason:
-            print('reading preq')
             tcav_name = reason.rsplit(':',1)[0]
-            madname = self.devices[tcav_name]["madname"]
+            madname = self._madname_of[tcav_name]
             value = self.get_tcav_phase(madname)
         elif 'VIRT:BEAM:EMITTANCES' == reason:
-            value = [self.sim_beam.emittance_x,self.sim_beam.emittance_y]
+            moments = self._moments()
+            value = [moments['emittance_x'], moments['emittance_y']]
         elif 'VIRT:BEAM:MU:XY' == reason:
-            value = [self.sim_beam.mu_x,self.sim_beam.mu_y]
+            moments = self._moments()
+            value = [moments['mu_x'], moments['mu_y']]
         elif 'VIRT:BEAM:SIGMA:XY' == reason:
-            value = [self.sim_beam.sigma_x,self.sim_beam.sigma_y]
+            moments = self._moments()
+            value = [moments['sigma_x'], moments['sigma_y']]
+        elif reason.startswith('BPMS:'):
+            control_name, field = reason.rsplit(':', 1)
+            row = self._bpm_row(control_name)
+            optics = self._optics()
+            if row is None or optics is None:
+                value = self.getParam(reason)
+            elif field == 'TMIT':
+                value = optics['charge'][row] / ELEMENTARY_CHARGE
+            else:
+                # Readbacks in mm
+                value = optics[f'mu_{field.lower()}'][row] * 1e3
+        elif reason in self.OPTICS_OUTPUTS:
+            optics = self._optics()
+            value = optics[self.OPTICS_OUTPUTS[reason]] if optics is not None else self.getParam(reason)
+        elif reason in self.GRADIENT_OUTPUTS:
+            value = self.gradients()[self.GRADIENT_OUTPUTS[reason]]
+        elif 'VIRT:GRAD:VARIABLES' == reason:
+            value = ' '.join(name for name, _, _, _ in self._gradient_variables())
+        elif reason.startswith('VIRT:CACHE:'):
+            value = self.cache_stats[reason.rsplit(':', 1)[1].lower()]
+        elif reason.startswith('VIRT:PERF:'):
+            value = self._perf_value(reason)
+        elif reason in self.SCAN_OUTPUTS:
+            value = self._scan_result.get(self.SCAN_OUTPUTS[reason])
+            if value is None:
+                value = self.getParam(reason)
+            elif value.ndim == 3:
+                # Stack of 2D grayscale frames, NTNDArray cannot infer that on its own
+                value = value.view(ntndarray)
+                value.attrib = {'ColorMode': 0}
+            else:
+                value = value.tolist()
         else:
             value = self.getParam(reason)
-
-        # Post PVA changes
-        self.server.set_pv(reason, value)
         return value
 
+    def _perf_value(self, reason):
+        """Returns the value of a VIRT:PERF PV from the metrics, timings are in ms"""
+        fields = reason.split(':')[2:]
+        if len(fields) == 1:
+            # Gauges such as VIRT:PERF:QUEUE_DEPTH
+            return int(self.metrics.gauge(fields[0].lower()))
+        stage, stat = fields
+        summary = self.metrics.histogram(self.PERF_STAGES[stage])
+        if stat == 'COUNT':
+            return summary['count']
+        return summary[stat.lower()] * 1e3
+
     def write(self, reason, value):
+        if self.server.recorder:
+            self.server.record(PUT, reason, value)
+        # Asynchronous CA puts complete once the worker has published their effect
+        self._requests.put((reason, value, lambda: self.callbackPV(reason), time.perf_counter()))
+        return True
+
+    def _apply(self, reason, value):
+        """Applies a put to the model state, without refreshing any derived PV"""
+        # Field PVs such as .HOPR are plain parameters, not model inputs
+        if '.' in reason:
+            self.set_param(reason, value)
+            name, field = reason.rsplit('.', 1)
+            if field in ('MDEL', 'ADEL'):
+                self._deadbands.setdefault(name, [0.0, 0.0])[field == 'ADEL'] = float(value)
+            return
+
         if 'QUAD' in reason and 'BCTRL' in reason:
             quad_name = reason.rsplit(':',1)[0]
-            madname = self.devices[quad_name]["madname"]
+            madname = self._madname_of[quad_name]
             self.set_quad_value(madname,value)
         elif 'QUAD' in reason and 'BACT' in reason:
             pass
@@ -607,22 +2554,56 @@ class SimDriver(Driver):
             self.set_param(reason,value)
         elif 'PNEUMATIC' in reason:
             screen = reason.rsplit(':',1)[0]
-            madname = self.devices[screen]["madname"]
-            position = self.move_screen(madname)
+            madname = self._madname_of[screen]
+            self.move_screen(madname, value)
+        elif 'OTRS' in reason and reason.rsplit(':', 1)[1] in self.ROI_FIELDS:
+            self._set_roi(reason, value)
+        elif 'OTRS' in reason and reason.endswith(':Image:Compressor'):
+            self.set_param(reason, value)
+            image = self.devices[reason.rsplit(':', 2)[0]]['pvs']['image']
+            self.server.set_codec(image, CODECS[self.server.pvdb[reason]['enums'][int(value)]])
+            # Re-post the same frame with the new codec
+            self._posted.pop(image, None)
+        elif 'OTRS' in reason and reason.endswith(':Acquire'):
+            self.set_param(reason, value)
+            control_name = reason.rsplit(':', 1)[0]
+            if int(value):
+                self._start_stream(control_name)
+            else:
+                self._stop_stream(control_name)
+        elif 'OTRS' in reason and reason.endswith(':FRAME_RATE'):
+            self.set_param(reason, max(float(value), 0.0))
+        elif 'OTRS' in reason and reason.endswith(':Gain'):
+            self.set_param(reason, max(float(value), 0.0))
         elif 'OTRS' in reason and 'PNEUMATIC' not in reason:
-            print(f"""Write to OTRS pvs is disabled,
-                  failed to write to {reason}""")
+            logger.warning('Write to OTRS pvs is disabled, failed to write to %s', reason)
         elif 'TCAV' in reason and 'AREQ' in reason:
             tcav_name = reason.rsplit(':',1)[0]
-            madname = self.devices[tcav_name]["madname"]
+            madname = self._madname_of[tcav_name]
             self.set_tcav_amplitude(madname,value)
         elif 'TCAV' in reason and 'PREQ' in reason:
             tcav_name = reason.rsplit(':',1)[0]
-            madname = self.devices[tcav_name]["madname"]
+            madname = self._madname_of[tcav_name]
             self.set_tcav_phase(madname,value)
         elif 'VIRT:BEAM:RESET_SIM' == reason:
             self.reset_sim()
-        self._update_all_outputs()
+        elif self.INCOMING_BEAM == reason:
+            self._set_incoming_beam(value)
+        elif 'VIRT:SIM:FIDELITY' == reason:
+            self.set_param(reason, value)
+            self.fidelity = int(value)
+        elif reason.startswith('VIRT:NOISE:'):
+            self.set_param(reason, value)
+            self.noise.configure(**{self.NOISE_FIELDS[reason.rsplit(':', 1)[1]]: value})
+            self._noise_version += 1
+        elif reason.startswith('VIRT:STREAM:'):
+            self.set_param(reason, value)
+        elif 'VIRT:SCAN:START' == reason:
+            self.set_param(reason, value)
+            if value:
+                self._run_scan_from_pvs()
+        elif reason.startswith('VIRT:SCAN:'):
+            self.set_param(reason, value)
 
 
 #TODO: add functionality to pop screens in and out
\ No newline at end of file
@@ -0,0 +1,522 @@
+"""
+Benchmarks the simulated servers end to end and per stage, and writes the results to a JSON file.
+
+Each configuration's server script is started on loopback in a subprocess and measured from PVA and CA
+clients (startup, put -> updated image latency, PV read throughput, image transfer). The tracking and
+image serialization stages are measured in process, through SimDriver and on the published image.
+
+    $ python benchmark.py --output results.json
+    $ python benchmark.py --config DIAG0 --baseline results.json
+
+With --baseline, metrics more than --tolerance slower than the baseline are reported and the exit
+code is non-zero.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from cheetah.accelerator import Segment
+from cheetah.particles import ParticleBeam
+from p4p.client.thread import Context
+
+from beamdriver import ImageNT, SimDriver, SimServer
+from utils.codec import available_codecs, compress, quantize, CODECS
+from utils.load_yaml import load_relevant_controls
+from utils.noise import NoiseModel
+from utils.pvdb import create_pvdb, create_optics_pvdb
+
+# Server configurations, 'shape' is the screen's (n_row, n_col) as in the script's screen_defaults
+CONFIGS = {
+    'DL1': {
+        'script': 'simulated_server.py',
+        'yaml': 'yaml_configs/DL1.yaml',
+        'lattice': 'lattices/lcls_cu_segment_otr2.json',
+        'screen': 'OTRS:IN20:571',
+        'shape': (1392, 1040),
+    },
+    'DIAG0': {
+        'script': 'simulated_server_diag0.py',
+        'yaml': 'yaml_configs/DIAG0.yaml',
+        'lattice': 'lattices/diag0.json',
+        'screen': 'OTRS:DIAG0:420',
+        'shape': (1944, 1472),
+    },
+}
+
+# Metrics where a larger value is better, everything else is a time or a size
+HIGHER_IS_BETTER = ('reads_per_s',)
+
+
+def _percentiles(samples) -> dict:
+    samples = np.asarray(samples, dtype=float)
+    return {
+        'p50': float(np.percentile(samples, 50)),
+        'p90': float(np.percentile(samples, 90)),
+        'max': float(samples.max()),
+        'n': int(samples.size),
+    }
+
+
+def _scan_quad(config: dict) -> str:
+    """Returns the BCTRL PV of the first quad of the configuration that is in the lattice"""
+    names = {element.name for element in Segment.from_lattice_json(config['lattice']).elements}
+    for control_name, info in load_relevant_controls(config['yaml']).items():
+        if 'QUAD' in control_name and info['madname'] in names:
+            return info['pvs']['bctrl']
+    raise ValueError(f"No quad of {config['yaml']} is in {config['lattice']}")
+
+
+def _timed(f) -> float:
+    t = time.perf_counter()
+    f()
+    return time.perf_counter() - t
+
+
+def bench_tracking(config: dict, particle_counts, repeats: int = 3) -> dict:
+    """
+    Measures SimDriver's tracking against the number of particles: a track of the whole segment, a track after
+    a put to a quad, which resumes from the quad's section and reuses the fused maps of the other sections,
+    and a return to settings tracked before, which the tracking cache answers.
+    The beam is generated from Twiss parameters so every configuration uses the same distribution.
+
+    Parameters
+    ----------
+    config : dict
+        Entry of CONFIGS
+    particle_counts : Sequence[int]
+        Numbers of particles to track
+    repeats : int
+        Tracks per particle count, the fastest is reported
+
+    Returns
+    -------
+    dict
+        Number of particles -> best time in seconds of each kind of track
+    """
+    devices = load_relevant_controls(config['yaml'])
+    n_row, n_col = config['shape']
+    pvdb = create_pvdb(devices, n_row=n_row, n_col=n_col)
+    # The servers publish the optics, which changes how the sections are tracked
+    pvdb.update(create_optics_pvdb())
+    bctrl = _scan_quad(config)
+    madname = next(info['madname'] for info in devices.values() if info['pvs'].get('bctrl') == bctrl)
+
+    results = {}
+    for i, n in enumerate(particle_counts):
+        beam = ParticleBeam.from_twiss(
+            beta_x=torch.tensor(9.34), alpha_x=torch.tensor(-1.6946), emittance_x=torch.tensor(1e-7),
+            beta_y=torch.tensor(9.34), alpha_y=torch.tensor(-1.6946), emittance_y=torch.tensor(1e-7),
+            energy=torch.tensor(90e6), num_particles=int(n), total_charge=torch.tensor(1e-9),
+        )
+        # Each driver gets its own copy of the PVs, without a CA server
+        server = SimServer(pvdb, prefix=f'BENCH:{config["script"]}:{i}:', ca=False)
+        driver = SimDriver(server=server, screen=config['screen'], devices=devices, particle_beam=beam,
+                           lattice_file=config['lattice'])
+        times = {'full_s': [], 'quad_s': [], 'cached_s': []}
+        with driver._lock:
+            for r in range(repeats):
+                # Settings not tracked before, so the cache misses
+                driver.set_quad_value(madname, 0.1 * (r + 1))
+                driver._invalidate()
+                times['full_s'].append(_timed(driver._simulate))
+                driver.set_quad_value(madname, -0.1 * (r + 1))
+                times['quad_s'].append(_timed(driver._simulate))
+                driver.set_quad_value(madname, 0.1 * (r + 1))
+                times['cached_s'].append(_timed(driver._simulate))
+        results[str(n)] = {k: min(v) for k, v in times.items()}
+    return results
+
+
+def bench_serialization(config: dict, repeats: int = 5) -> dict:
+    """
+    Measures how long it takes to quantize a screen image to 12 bit counts, with and without camera noise,
+    to wrap the counts for publication over PVA and CA as the server does, and to compress them with each
+    available codec
+
+    Parameters
+    ----------
+    config : dict
+        Entry of CONFIGS
+    repeats : int
+        Number of repetitions, the fastest is reported
+
+    Returns
+    -------
+    dict
+        Times in seconds and payload sizes in bytes
+    """
+    # A round beam spot rather than noise, so that compression ratios are representative
+    # The published frame is (n_col, n_row), one row per pixel along Y
+    rows, cols = np.indices(config['shape'][::-1])
+    image = np.exp(-((rows - rows.mean()) ** 2 + (cols - cols.mean()) ** 2) / (2 * 50.0 ** 2))
+    nt = ImageNT()
+    noise = NoiseModel(shot=1.0, background=20.0, dark=5.0, hot_pixels=1e-5, enabled=True)
+    # The gain the server calibrates on a first frame like this one, peaking at half of full scale
+    gain = 0.5 * 4095 / image.max()
+    times = {'pva_wrap_s': [], 'ca_copy_s': [], 'quantize_s': [], 'quantize_noise_s': []}
+    for _ in range(repeats):
+        t = time.perf_counter()
+        counts = quantize(image, 12, gain)
+        times['quantize_s'].append(time.perf_counter() - t)
+        t = time.perf_counter()
+        quantize(image, 12, gain, noise=noise)
+        times['quantize_noise_s'].append(time.perf_counter() - t)
+        # The published value is the frame of camera counts
+        t = time.perf_counter()
+        nt.wrap(counts)
+        times['pva_wrap_s'].append(time.perf_counter() - t)
+        # pcaspy copies the flattened array on setParam
+        t = time.perf_counter()
+        np.array(counts.ravel())
+        times['ca_copy_s'].append(time.perf_counter() - t)
+
+    results = {k: min(v) for k, v in times.items()}
+    results.update(nbytes=int(image.nbytes), quantized_nbytes=int(counts.nbytes))
+    for name in available_codecs()[1:]:
+        t = time.perf_counter()
+        data = compress(counts, CODECS[name])
+        results[f'{name.lower()}_s'] = time.perf_counter() - t
+        results[f'{name.lower()}_nbytes'] = len(data)
+    return results
+
+
+class _LiveServer:
+    """Server script running in a subprocess on loopback, with a PVA client connected to it"""
+
+    def __init__(self, config: dict, port: int, log: str, ca_port: int | None = None):
+        """
+        Parameters
+        ----------
+        config : dict
+            Entry of CONFIGS
+        port : int
+            PVA server port, the next one is the PVA broadcast port
+        log : str
+            File the server's output is written to
+        ca_port : int | None
+            CA server port, port - 11 by default, so that neither collides with a server already running
+        """
+        ca_port = ca_port or port - 11
+        self.env = dict(os.environ,
+                        EPICS_CA_ADDR_LIST='127.0.0.1', EPICS_CA_AUTO_ADDR_LIST='NO',
+                        EPICS_CA_MAX_ARRAY_BYTES='80000000',
+                        EPICS_CAS_SERVER_PORT=str(ca_port), EPICS_CA_SERVER_PORT=str(ca_port),
+                        EPICS_CAS_INTF_ADDR_LIST='127.0.0.1',
+                        EPICS_PVA_SERVER_PORT=str(port), EPICS_PVA_BROADCAST_PORT=str(port + 1),
+                        EPICS_PVA_ADDR_LIST='127.0.0.1', EPICS_PVA_AUTO_ADDR_LIST='NO')
+        self.script = config['script']
+        self.log = log
+        self.proc = None
+        self.ctx = None
+
+    def start(self, probe: str, timeout: float) -> float:
+        """Starts the server and returns the time until the probe PV can be read"""
+        t = time.perf_counter()
+        with open(self.log, 'w') as log:
+            self.proc = subprocess.Popen([sys.executable, self.script], env=self.env,
+                                         stdout=log, stderr=subprocess.STDOUT)
+        self.ctx = Context('pva', useenv=False, conf={
+            'EPICS_PVA_ADDR_LIST': '127.0.0.1',
+            'EPICS_PVA_AUTO_ADDR_LIST': 'NO',
+            'EPICS_PVA_BROADCAST_PORT': self.env['EPICS_PVA_BROADCAST_PORT'],
+            'EPICS_PVA_SERVER_PORT': self.env['EPICS_PVA_SERVER_PORT'],
+        })
+        while True:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f'{self.script} exited with code {self.proc.returncode}, see {self.log}')
+            if time.perf_counter() - t > timeout:
+                raise TimeoutError(f'{self.script} did not serve {probe} within {timeout} s')
+            try:
+                self.ctx.get(probe, timeout=1.0)
+                return time.perf_counter() - t
+            except TimeoutError:
+                pass
+
+    def stop(self):
+        if self.ctx:
+            self.ctx.close()
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+
+
+def bench_put_to_image(ctx: Context, quad: str, image: str, values, timeout: float) -> dict:
+    """
+    Measures the time from a put to a quad until the updated image is delivered to a monitor
+
+    Parameters
+    ----------
+    ctx : Context
+        Client context
+    quad : str
+        BCTRL PV to put to
+    image : str
+        Image PV to monitor
+    values : Sequence[float]
+        Values to put, repeated values measure the cached path
+    timeout : float
+        Time to wait for each update, in seconds
+
+    Returns
+    -------
+    dict
+        Latency percentiles in seconds
+    """
+    updated = threading.Event()
+    sub = ctx.monitor(image, lambda value: updated.set())
+    try:
+        # Skip the initial update
+        updated.wait(timeout)
+        latencies = []
+        for value in values:
+            updated.clear()
+            t = time.perf_counter()
+            ctx.put(quad, value, timeout=timeout)
+            if not updated.wait(timeout):
+                raise TimeoutError(f'No update of {image} within {timeout} s after a put to {quad}')
+            latencies.append(time.perf_counter() - t)
+    finally:
+        sub.close()
+    return _percentiles(latencies)
+
+
+def bench_put_to_image_ca(quad: str, image: str, values, timeout: float) -> dict:
+    """
+    Measures the time from a CA put to a quad, as caput does, until the updated image is delivered to a CA monitor.
+    The CA client is configured from the environment, see _LiveServer.env.
+
+    Parameters
+    ----------
+    quad : str
+        BCTRL PV to put to
+    image : str
+        Image PV to monitor
+    values : Sequence[float]
+        Values to put
+    timeout : float
+        Time to wait for each update, in seconds
+
+    Returns
+    -------
+    dict
+        Latency percentiles in seconds
+    """
+    # pyepics configures its CA context from the environment once, when it is first used
+    import epics
+
+    updated = threading.Event()
+    image_pv = epics.PV(image, auto_monitor=True, callback=lambda **kws: updated.set())
+    quad_pv = epics.PV(quad)
+    try:
+        if not image_pv.wait_for_connection(timeout) or not quad_pv.wait_for_connection(timeout):
+            raise TimeoutError(f'Could not connect to {image} and {quad} over CA')
+        # Skip the initial update
+        updated.wait(timeout)
+        latencies = []
+        for value in values:
+            updated.clear()
+            t = time.perf_counter()
+            quad_pv.put(value, wait=True, timeout=timeout)
+            if not updated.wait(timeout):
+                raise TimeoutError(f'No CA update of {image} within {timeout} s after a put to {quad}')
+            latencies.append(time.perf_counter() - t)
+    finally:
+        image_pv.disconnect()
+        quad_pv.disconnect()
+    return _percentiles(latencies)
+
+
+def bench_reads(ctx: Context, pvs, duration: float) -> dict:
+    """
+    Measures PV read throughput by reading the PVs back to back
+
+    Parameters
+    ----------
+    ctx : Context
+        Client context
+    pvs : Sequence[str]
+        PVs to read, in turn
+    duration : float
+        Duration of the measurement, in seconds
+
+    Returns
+    -------
+    dict
+        Reads per second and latency percentiles in seconds
+    """
+    latencies = []
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for pv in pvs:
+            t = time.perf_counter()
+            ctx.get(pv)
+            latencies.append(time.perf_counter() - t)
+    result = _percentiles(latencies)
+    result['reads_per_s'] = len(latencies) / (time.perf_counter() - start)
+    return result
+
+
+def bench_image_get(ctx: Context, image: str, repeats: int = 3) -> dict:
+    """Measures how long a client takes to get the image, and how large it is"""
+    times = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        value = ctx.get(image, timeout=60)
+        times.append(time.perf_counter() - t)
+    return {'get_s': min(times), 'nbytes': int(np.asarray(value).nbytes)}
+
+
+@contextmanager
+def _environ(variables: dict):
+    """Sets environment variables of this process for the duration of the block, restoring them afterwards"""
+    saved = {k: os.environ.get(k) for k in variables}
+    os.environ.update(variables)
+    try:
+        yield
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+
+def run_config(name: str, args) -> dict:
+    """Runs every benchmark of one configuration. A failing stage is recorded instead of aborting the run."""
+    config = CONFIGS[name]
+    results = {}
+    print(f'[{name}] tracking')
+    try:
+        results['tracking_s'] = bench_tracking(config, args.particles)
+    except Exception as e:
+        results['tracking_s'] = {'error': str(e)}
+
+    print(f'[{name}] serialization')
+    results['serialization'] = bench_serialization(config)
+
+    if args.no_server:
+        return results
+
+    image = f"{config['screen']}:Image:ArrayData"
+    server = _LiveServer(config, args.port, f'benchmark-{name}.log', args.ca_port)
+    try:
+        print(f'[{name}] startup')
+        results['startup_s'] = server.start(image, args.startup_timeout)
+        quad = _scan_quad(config)
+        values = np.linspace(-1.0, 1.0, args.puts)
+        print(f'[{name}] put -> image')
+        results['put_to_image_s'] = bench_put_to_image(server.ctx, quad, image, values, args.put_timeout)
+        # Same values again, now served from the tracking cache
+        results['put_to_image_cached_s'] = bench_put_to_image(server.ctx, quad, image, values, args.put_timeout)
+        print(f'[{name}] caput -> image')
+        # Halfway between the values put before, so the tracking is measured rather than the cache
+        step = values[1] - values[0] if len(values) > 1 else 1.0
+        # Only the CA client reads these. pyepics keeps the context it created, every configuration uses the same ports.
+        with _environ({k: v for k, v in server.env.items() if k.startswith('EPICS_CA_')}):
+            results['caput_to_image_s'] = bench_put_to_image_ca(quad, image, values + step / 2, args.put_timeout)
+        print(f'[{name}] reads')
+        results['reads'] = bench_reads(server.ctx, [quad, quad.replace('BCTRL', 'BACT'), 'VIRT:BEAM:EMITTANCES'],
+                                       args.read_duration)
+        results['image_get'] = bench_image_get(server.ctx, image)
+    except Exception as e:
+        results['error'] = str(e)
+    finally:
+        server.stop()
+    return results
+
+
+def _flatten(results: dict, prefix: str = '') -> dict:
+    flat = {}
+    for k, v in results.items():
+        if isinstance(v, dict):
+            flat.update(_flatten(v, f'{prefix}{k}.'))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool) and k != 'n':
+            flat[f'{prefix}{k}'] = v
+    return flat
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Lists the metrics that regressed by more than the tolerance relative to a baseline
+
+    Parameters
+    ----------
+    results : dict
+        Results of this run
+    baseline : dict
+        Results of an earlier run
+    tolerance : float
+        Allowed relative slowdown, e.g. 0.2 for 20 %
+
+    Returns
+    -------
+    list
+        Descriptions of the regressions
+    """
+    new, old = _flatten(results['configs']), _flatten(baseline['configs'])
+    regressions = []
+    for k in sorted(new.keys() & old.keys()):
+        if old[k] == 0:
+            continue
+        ratio = new[k] / old[k]
+        if k.endswith(HIGHER_IS_BETTER):
+            ratio = 1 / ratio if ratio else float('inf')
+        if ratio > 1 + tolerance:
+            regressions.append(f'{k}: {old[k]:.4g} -> {new[k]:.4g}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', nargs='+', choices=list(CONFIGS), default=list(CONFIGS))
+    parser.add_argument('--output', default='benchmark.json', help='File to write the results to')
+    parser.add_argument('--baseline', help='Results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative slowdown')
+    parser.add_argument('--particles', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--puts', type=int, default=3, help='Number of puts for the latency measurement')
+    parser.add_argument('--read-duration', type=float, default=5.0)
+    parser.add_argument('--port', type=int, default=15075, help='PVA server port of the benchmarked servers')
+    parser.add_argument('--ca-port', type=int, default=15064, help='CA server port of the benchmarked servers')
+    parser.add_argument('--startup-timeout', type=float, default=600.0)
+    parser.add_argument('--put-timeout', type=float, default=600.0)
+    parser.add_argument('--no-server', action='store_true', help='Only run the in-process benchmarks')
+    args = parser.parse_args()
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    results = {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'configs': {name: run_config(name, args) for name in args.config},
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for r in regressions:
+            print(f'Regression: {r}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,428 @@
+"""
+Serves several areas from one CA/PVA server, each simulated by its own SimDriver in a separate process.
+
+The router process owns the CA and PVA servers. It forwards puts, reads of images and the clients of
+images and gradients to the shard simulating the PV's area, and publishes whatever the shards post back.
+Every area keeps its device PV names, the VIRT PVs of area X are served as VIRT:X:... .
+
+An area whose config names an 'upstream' area is fed by it: the upstream shard writes its exit beam to a
+BeamHandoff after every change, and the downstream shard tracks it as its incoming beam.
+"""
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from typing import Any, Callable, Dict
+
+import numpy as np
+import torch
+from cheetah.accelerator import Segment
+from cheetah.particles import ParticleBeam
+from pcaspy import Driver
+
+from beamdriver import SimDriver, SimServer
+from utils.cache import TrackingCache
+from utils.handoff import BeamHandoff
+from utils.load_yaml import load_relevant_controls
+from utils.pvdb import create_pvdb, create_scan_pvdb, create_perf_pvdb, create_noise_pvdb, create_stream_pvdb, \
+    create_optics_pvdb, create_gradient_pvdb
+from utils.snapshot import read_snapshot, write_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks of the upstream area's handoff for a new beam
+HANDOFF_POLL_INTERVAL = 0.05
+
+# Seconds between checks of the CA monitors of the images and gradients, which are forwarded to the shards
+INTEREST_POLL_INTERVAL = 0.2
+
+# Seconds a CA read of an image or gradient waits for the shard to refresh it
+READ_TIMEOUT = 5.0
+
+
+def front_name(area: str, name: str) -> str:
+    """Returns the name a PV of an area is served under by the router"""
+    if name.startswith('VIRT:'):
+        return f'VIRT:{area}:{name[5:]}'
+    return name
+
+
+def load_area(area: dict) -> dict:
+    """
+    Returns the snapshot of an area, compiling it first if it is missing or stale
+
+    Parameters
+    ----------
+    area : dict
+        Area config: 'yaml', 'lattice', 'snapshot', 'screen_defaults', and the incoming beam as keyword arguments
+        of either ParticleBeam.from_openpmd_file ('openpmd_beam') or ParticleBeam.from_twiss ('twiss_beam')
+
+    Returns
+    -------
+    dict
+        See read_snapshot
+    """
+    sources = [area['yaml'], area['lattice'], __file__]
+    if 'openpmd_beam' in area:
+        sources.append(area['openpmd_beam']['path'])
+    snapshot = read_snapshot(area['snapshot'], sources=sources)
+    if snapshot is not None:
+        return snapshot
+
+    logger.info('Compiling %s', area['snapshot'])
+    devices = load_relevant_controls(area['yaml'])
+    pvdb = create_pvdb(devices, **area.get('screen_defaults', {}))
+    pvdb.update({
+        'VIRT:BEAM:EMITTANCES': {'type': 'float', 'count': 2},
+        'VIRT:BEAM:MU:XY': {'type': 'float', 'count': 2},
+        'VIRT:BEAM:SIGMA:XY': {'type': 'float', 'count': 2},
+        'VIRT:BEAM:RESET_SIM': {'value': 0},
+        'VIRT:SIM:FIDELITY': {'type': 'enum', 'enums': ['Fast', 'Full', 'Adaptive']},
+        'VIRT:CACHE:HITS': {'type': 'int'},
+        'VIRT:CACHE:MISSES': {'type': 'int'},
+        'VIRT:CACHE:EVICTIONS': {'type': 'int'},
+    })
+    pvdb.update(create_scan_pvdb())
+    pvdb.update(create_perf_pvdb())
+    pvdb.update(create_noise_pvdb())
+    pvdb.update(create_stream_pvdb())
+    pvdb.update(create_optics_pvdb())
+    pvdb.update(create_gradient_pvdb())
+    if 'openpmd_beam' in area:
+        beam = ParticleBeam.from_openpmd_file(**area['openpmd_beam'])
+        beam.particle_charges = torch.tensor(1.0)
+    else:
+        beam = ParticleBeam.from_twiss(**area['twiss_beam'])
+    beamline = Segment.from_lattice_json(area['lattice'])
+    write_snapshot(area['snapshot'], devices, pvdb, beamline, beam, TrackingCache.make_context(beamline, beam))
+    return read_snapshot(area['snapshot'])
+
+
+class ShardServer(SimServer):
+    """
+    SimServer of an area simulated in a shard process. It serves nothing itself: posts and codec changes
+    are sent to the router, which publishes them.
+    """
+
+    def __init__(self, pvdb: dict, conn):
+        """
+        Parameters
+        ----------
+        pvdb : dict
+            PV database of the area
+        conn : multiprocessing.connection.Connection
+            Pipe to the router
+        """
+        self._conn = conn
+        self._send_lock = threading.Lock()
+        super().__init__(pvdb, ca=False)
+
+    def send(self, *message):
+        """Sends a message to the router, from any thread"""
+        with self._send_lock:
+            self._conn.send(message)
+
+    def set_pv(self, name: str, value, timestamp: float | None = None, unique_id: int | None = None):
+        self.send('post', name, value, timestamp, unique_id)
+
+    def set_codec(self, name: str, codec: str):
+        self.send('codec', name, codec)
+
+    def run(self):
+        raise RuntimeError('A shard is served by the router')
+
+
+def _follow_upstream(driver: SimDriver, name: str, stop: threading.Event):
+    """Feeds the beams the upstream area writes to the handoff to the driver as its incoming beam"""
+    handoff = None
+    sequence = 0
+    while not stop.wait(HANDOFF_POLL_INTERVAL):
+        if handoff is None:
+            handoff = BeamHandoff.attach(name)
+            if handoff is None:
+                continue
+        item = handoff.read(since=sequence)
+        if item is not None:
+            sequence, beam = item
+            logger.info('New incoming beam from %s', name)
+            driver.set_incoming_beam(beam)
+    if handoff is not None:
+        handoff.close()
+
+
+def run_shard(name: str, area: dict, conn, handoff: str | None, upstream: str | None):
+    """
+    Simulates an area, the target of a shard process
+
+    Parameters
+    ----------
+    name : str
+        Area name
+    area : dict
+        Area config, see load_area
+    conn : multiprocessing.connection.Connection
+        Pipe to the router
+    handoff : str | None
+        Shared memory block to write the exit beam to, if a downstream area is fed by this one
+    upstream : str | None
+        Shared memory block of the upstream area's exit beam, if this area is fed by one
+    """
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s %(levelname)s {name} %(name)s: %(message)s')
+    snapshot = load_area(area)
+    conn.send(('pvdb', snapshot['pvdb']))
+
+    server = ShardServer(snapshot['pvdb'], conn)
+    driver = SimDriver(
+        server=server,
+        screen=area['screen'],
+        devices=snapshot['devices'],
+        particle_beam=snapshot['beam'],
+        beamline=snapshot['beamline'],
+        cache_context=snapshot['context'],
+        metrics_file=area.get('metrics_file'),
+        # Areas share the directory given by SIM_CACHE_DIR, their contexts keep the keys apart
+        cache_dir=area.get('cache_dir', os.environ.get('SIM_CACHE_DIR') or None),
+    )
+
+    writer = None
+    if handoff:
+        writer = BeamHandoff(handoff, capacity=snapshot['beam'].particles.shape[-2])
+        driver.set_exit_beam_callback(writer.write)
+    stop = threading.Event()
+    if upstream:
+        threading.Thread(target=_follow_upstream, args=(driver, upstream, stop), name=f'{name} upstream',
+                         daemon=True).start()
+    server.send('ready')
+
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            match message:
+                case ('put', reason, value, put_id):
+                    driver._on_update(reason, value, lambda put_id=put_id: server.send('done', put_id))
+                case ('watch', reason, watched):
+                    server._on_watch(reason, watched)
+                case ('read', reason, read_id):
+                    driver.refresh(reason, lambda read_id=read_id: server.send('done', read_id))
+                case ('stop',):
+                    break
+    finally:
+        stop.set()
+        if writer is not None:
+            writer.close()
+            writer.unlink()
+
+
+class RouterDriver(Driver):
+    """Driver of the router: forwards puts to the shards and publishes their posts"""
+
+    def __init__(self, server: SimServer, routes: Dict[str, tuple], conns: Dict[str, Any]):
+        """
+        Parameters
+        ----------
+        server : SimServer
+            Server of every area's PVs
+        routes : Dict[str, tuple]
+            Served PV name -> (area, PV name in the area)
+        conns : Dict[str, Connection]
+            Area -> pipe to its shard
+        """
+        super().__init__()
+        self.server = server
+        self._routes = routes
+        self._conns = conns
+        self._send_lock = threading.Lock()
+        # Puts and reads forwarded to a shard -> function completing them
+        self._pending: Dict[int, Callable[[], None]] = {}
+        self._put_ids = itertools.count()
+        # Images and gradients, whose clients decide what the shards compute -> whether the shard was told of any
+        self._interest = {reason: False for reason, (_, name) in routes.items() if self._on_demand(reason, name)}
+        self._interest_lock = threading.Lock()
+
+        self.server.set_update_callback(self._on_put)
+        self.server.set_watch_callback(self._on_watch)
+        for area, conn in conns.items():
+            threading.Thread(target=self._receive, args=(area, conn), name=f'{area} receiver', daemon=True).start()
+        threading.Thread(target=self._poll_interest, name='interest', daemon=True).start()
+
+    @staticmethod
+    def _on_demand(reason: str, name: str) -> bool:
+        """Returns whether a PV is only refreshed while it has clients or once read"""
+        return 'Image:ArrayData' in reason or name in SimDriver.GRADIENT_OUTPUTS
+
+    def _route(self, reason: str) -> tuple | None:
+        """Returns the area of a served PV and its name there, a field of a routed PV is routed with it"""
+        route = self._routes.get(reason)
+        if route is None and '.' in reason:
+            base, field = reason.rsplit('.', 1)
+            route = self._routes.get(base)
+            if route is not None and field != 'VAL':
+                route = (route[0], f'{route[1]}.{field}')
+        return route
+
+    def _send(self, area: str, *message):
+        with self._send_lock:
+            self._conns[area].send(message)
+
+    def _forward_put(self, reason: str, value, done: Callable[[], None] | None):
+        route = self._route(reason)
+        if route is None:
+            logger.warning('No area serves %s', reason)
+            if done:
+                done()
+            return
+        put_id = next(self._put_ids)
+        if done:
+            self._pending[put_id] = done
+        area, name = route
+        # pcaspy and p4p hand over their own array types
+        if isinstance(value, np.ndarray):
+            value = np.array(value)
+        self._send(area, 'put', name, value, put_id)
+
+    def _on_put(self, reason: str, value, done: Callable[[], None]):
+        self._forward_put(reason, value, done)
+
+    def _on_watch(self, reason: str, watched: bool):
+        route = self._route(reason)
+        if route is None:
+            return
+        if reason in self._interest:
+            self._forward_interest(reason)
+        else:
+            self._send(route[0], 'watch', route[1], watched)
+
+    def _forward_interest(self, reason: str):
+        """Tells the shard whether a PV has PVA clients or CA monitors, when that changed"""
+        with self._interest_lock:
+            watched = self.server.is_watched(reason)
+            if watched != self._interest[reason]:
+                self._interest[reason] = watched
+                area, name = self._routes[reason]
+                self._send(area, 'watch', name, watched)
+
+    def _poll_interest(self):
+        """Forwards the CA monitors of images and gradients, which pcaspy reports to nobody"""
+        while True:
+            for reason in self._interest:
+                try:
+                    self._forward_interest(reason)
+                except Exception:
+                    logger.exception('Failed to forward the interest in %s', reason)
+            time.sleep(INTEREST_POLL_INTERVAL)
+
+    def write(self, reason, value):
+        self._forward_put(reason, value, lambda: self.callbackPV(reason))
+        return True
+
+    def read(self, reason):
+        # A shard refreshes a stale image or gradient once it is read. The read waits for its post, which
+        # arrives before the reply, so a read after a put sees the put's effect.
+        if reason in self._interest:
+            area, name = self._routes[reason]
+            read_id = next(self._put_ids)
+            refreshed = threading.Event()
+            self._pending[read_id] = refreshed.set
+            self._send(area, 'read', name, read_id)
+            if not refreshed.wait(READ_TIMEOUT):
+                self._pending.pop(read_id, None)
+                logger.warning('%s was not refreshed within %s s, reading the last value', reason, READ_TIMEOUT)
+        return self.getParam(reason)
+
+    def _receive(self, area: str, conn):
+        """Publishes what a shard posts, until its pipe closes"""
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                logger.error('Shard of %s exited', area)
+                return
+            try:
+                match message:
+                    case ('post', name, value, timestamp, unique_id):
+                        self._publish(front_name(area, name), value, timestamp, unique_id)
+                    case ('codec', name, codec):
+                        self.server.set_codec(front_name(area, name), codec)
+                    case ('done', put_id):
+                        done = self._pending.pop(put_id, None)
+                        if done:
+                            done()
+                    case ('ready',):
+                        logger.info('Shard of %s is ready', area)
+            except Exception:
+                logger.exception('Failed to handle %s from %s', message[0], area)
+
+    def _publish(self, reason: str, value, timestamp: float | None, unique_id: int | None):
+        if reason in self.pvDB:
+            self.setParam(reason, value.ravel() if isinstance(value, np.ndarray) else value)
+        else:
+            self.server.set_field_value(reason, value)
+        self.server.set_pv(reason, value, timestamp=timestamp, unique_id=unique_id)
+        if reason in self.pvDB:
+            self.updatePV(reason)
+
+
+def serve(areas: Dict[str, dict], start_timeout: float = 600.0):
+    """
+    Starts a shard process for every area and serves all of their PVs
+
+    Parameters
+    ----------
+    areas : Dict[str, dict]
+        Area name -> config, see load_area. 'upstream' names the area whose exit beam is the incoming beam.
+    start_timeout : float
+        Time to wait for each shard to be ready, in seconds
+    """
+    # Forking would copy torch's and pcaspy's threads and locks
+    context = multiprocessing.get_context('spawn')
+    handoffs = {name: f'linac_sim_{os.getpid()}_{name}' for name in areas
+                if any(area.get('upstream') == name for area in areas.values())}
+
+    processes, conns = {}, {}
+    for name, area in areas.items():
+        conn, child = context.Pipe()
+        upstream = area.get('upstream')
+        processes[name] = context.Process(target=run_shard, name=f'{name} shard', daemon=True,
+                                          args=(name, area, child, handoffs.get(name), handoffs.get(upstream)))
+        processes[name].start()
+        conns[name] = conn
+
+    try:
+        # The router serves the union of the areas' PV databases
+        pvdb, routes = {}, {}
+        for name, conn in conns.items():
+            if not conn.poll(start_timeout):
+                raise TimeoutError(f'Shard of {name} did not start within {start_timeout} s')
+            _, area_pvdb = conn.recv()
+            for k, v in area_pvdb.items():
+                served = front_name(name, k)
+                if served in routes:
+                    raise ValueError(f'{k} is served by both {routes[served][0]} and {name}')
+                pvdb[served] = v
+                routes[served] = (name, k)
+
+        server = SimServer(pvdb)
+        driver = RouterDriver(server, routes, conns)
+        logger.info('Serving %d PVs of %s', len(pvdb), ', '.join(areas))
+        server.run()
+    finally:
+        for conn in conns.values():
+            try:
+                conn.send(('stop',))
+            except OSError:
+                pass
+        for process in processes.values():
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        # Blocks of shards that did not exit cleanly
+        for name in handoffs.values():
+            handoff = BeamHandoff.attach(name)
+            if handoff is not None:
+                handoff.close()
+                handoff.unlink()
@@ -0,0 +1,153 @@
+"""
+Replays the puts and gets recorded by a server started with SIM_RECORD=<log> against a local server, and reports
+the latency of each kind of request and the gets whose value differs from the recording.
+
+    $ SIM_RECORD=badger.simlog python simulated_server.py
+    $ python replay.py badger.simlog --config DL1 --speed 0 --output replay.json
+
+Requests are replayed in order over PVA, at the recorded pace divided by --speed, 0 replays as fast as possible.
+With --config the configuration's server script is started on loopback, as by benchmark.py, otherwise the
+server found through the EPICS environment is used.
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+from p4p.client.thread import Context
+
+from benchmark import CONFIGS, _LiveServer, _percentiles
+from utils.recorder import GET, PUT, read_log, summarize
+
+
+def matches(recorded, value, rtol: float, atol: float) -> bool:
+    """Returns whether a replayed get returned the recorded value, numbers within the tolerances"""
+    value = summarize(value)
+    if isinstance(recorded, tuple) or isinstance(value, tuple):
+        return recorded == value
+    try:
+        expected, actual = np.asarray(recorded, dtype=float).ravel(), np.asarray(value, dtype=float).ravel()
+    except (TypeError, ValueError):
+        return recorded == value
+    return expected.shape == actual.shape and np.allclose(actual, expected, rtol=rtol, atol=atol, equal_nan=True)
+
+
+def replay(ctx: Context, records, speed: float, prefix: str = '', timeout: float = 60.0,
+           rtol: float = 1e-6, atol: float = 0.0) -> dict:
+    """
+    Replays recorded requests
+
+    Parameters
+    ----------
+    ctx : Context
+        Client context
+    records : Iterable[tuple]
+        Records of read_log
+    speed : float
+        Replay speed relative to the recording, 0 for as fast as possible
+    prefix : str
+        Prefix of the replayed PV names
+    timeout : float
+        Time to wait for each request, in seconds
+    rtol, atol : float
+        Tolerances of the comparison of numeric values
+
+    Returns
+    -------
+    dict
+        Latency percentiles in seconds per kind of request, mismatching gets, and the number of requests
+        that failed or could not be replayed
+    """
+    latencies = {PUT: [], GET: []}
+    mismatches, errors, skipped = [], [], 0
+    start, first = time.perf_counter(), None
+    for t, kind, name, value in records:
+        if first is None:
+            first = t
+        if speed > 0:
+            delay = start + (t - first) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        if kind == PUT and isinstance(value, tuple):
+            # Only a digest of a large array was recorded
+            skipped += 1
+            continue
+        try:
+            begin = time.perf_counter()
+            if kind == PUT:
+                ctx.put(prefix + name, value, timeout=timeout)
+            else:
+                result = ctx.get(prefix + name, timeout=timeout)
+            latencies[kind].append(time.perf_counter() - begin)
+        except Exception as e:
+            errors.append(f'{name}: {e}')
+            continue
+        if kind == GET and not matches(value, result, rtol, atol):
+            mismatches.append(name)
+
+    return {
+        'put_s': _percentiles(latencies[PUT]) if latencies[PUT] else {},
+        'get_s': _percentiles(latencies[GET]) if latencies[GET] else {},
+        'duration_s': time.perf_counter() - start,
+        'mismatches': len(mismatches),
+        'mismatched_pvs': sorted(set(mismatches)),
+        'errors': errors,
+        'skipped': skipped,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('log', help='Recording written by a server started with SIM_RECORD')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed, 0 for as fast as possible')
+    parser.add_argument('--config', choices=list(CONFIGS), help='Start this configuration\'s server on loopback')
+    parser.add_argument('--prefix', default='', help='Prefix of the replayed PV names')
+    parser.add_argument('--port', type=int, default=15075, help='PVA server port of a started server')
+    parser.add_argument('--startup-timeout', type=float, default=600.0)
+    parser.add_argument('--timeout', type=float, default=60.0, help='Time to wait for each request')
+    parser.add_argument('--rtol', type=float, default=1e-6, help='Relative tolerance of numeric values')
+    parser.add_argument('--atol', type=float, default=0.0, help='Absolute tolerance of numeric values')
+    parser.add_argument('--output', help='File to write the report to')
+    args = parser.parse_args()
+
+    records = list(read_log(args.log))
+    if not records:
+        sys.exit(f'{args.log} holds no requests')
+
+    server = ctx = None
+    try:
+        if args.config:
+            server = _LiveServer(CONFIGS[args.config], args.port, f'replay-{args.config}.log')
+            server.start(args.prefix + records[0][2], args.startup_timeout)
+            ctx = server.ctx
+        else:
+            ctx = Context('pva')
+        report = replay(ctx, records, args.speed, args.prefix, args.timeout, args.rtol, args.atol)
+    finally:
+        if server:
+            server.stop()
+        elif ctx:
+            ctx.close()
+
+    report['log'] = args.log
+    report['requests'] = len(records)
+    for kind in ('put_s', 'get_s'):
+        if report[kind]:
+            s = report[kind]
+            print(f"{kind[:3]}: n={s['n']} p50={s['p50'] * 1e3:.2f} ms p90={s['p90'] * 1e3:.2f} ms "
+                  f"max={s['max'] * 1e3:.2f} ms")
+    print(f"{report['mismatches']} mismatching gets, {len(report['errors'])} errors, "
+          f"{report['skipped']} puts skipped, {report['duration_s']:.1f} s")
+    for name in report['mismatched_pvs']:
+        print(f'Mismatch: {name}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if report['mismatches'] or report['errors']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
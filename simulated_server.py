@@ -2,32 +2,71 @@ from cheetah.particles import ParticleBeam
 from beamdriver import SimDriver, SimServer
 from cheetah.accelerator import Segment 
 import torch
+from utils.cache import TrackingCache
 from utils.load_yaml import load_relevant_controls
-from utils.pvdb import create_pvdb
-import pprint 
+from utils.pvdb import create_pvdb, create_scan_pvdb, create_perf_pvdb, create_noise_pvdb, create_stream_pvdb, \
+    create_optics_pvdb, create_gradient_pvdb
+from utils.recorder import Recorder
+from utils.snapshot import read_snapshot, write_snapshot
+import logging
+import os
+import sys
 #design_incoming = ParticleBeam.from_openpmd_file(path='impact_inj_output_YAG03.h5', energy = torch.tensor(125e6),dtype=torch.float32)
 #lcls_lattice = Segment.from_lattice_json("lcls_cu_segment_otr2.json")
 design_incoming_beam = {'path': 'h5/impact_inj_output_YAG03.h5',
                          'energy': torch.tensor(125e6),
                          'dtype':torch.float32}
 lcls_lattice = 'lattices/lcls_cu_segment_otr2.json'
-devices = load_relevant_controls('yaml_configs/DL1.yaml')
+yaml_config = 'yaml_configs/DL1.yaml'
+# Compiled devices, PV database, lattice and beam, rebuilt whenever one of its sources changes
+snapshot_file = 'snapshots/DL1.snap'
 screen_name = 'OTRS:IN20:571'
 screen_defaults = {'n_row': 1392, 'n_col': 1040, 'resolution': 4.65, 'pneumatic': 'OUT' }
-PVDB = create_pvdb(devices, **screen_defaults)
-custom_pvs = {'VIRT:BEAM:EMITTANCES': {'type':'float', 'count': 2},
-              'VIRT:BEAM:RESET_SIM': {'value': 0}   
-}
-PVDB.update(custom_pvs)
-pprint.pprint(PVDB)
-server = SimServer(PVDB)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+snapshot = read_snapshot(snapshot_file, sources=[yaml_config, lcls_lattice, design_incoming_beam['path'], __file__])
+# start.sh asks whether the snapshot is usable, and only extracts the particle distribution if it is not
+if '--check-snapshot' in sys.argv:
+    sys.exit(0 if snapshot is not None else 1)
+if snapshot is None:
+    logging.info('Compiling %s', snapshot_file)
+    devices = load_relevant_controls(yaml_config)
+    PVDB = create_pvdb(devices, **screen_defaults)
+    custom_pvs = {'VIRT:BEAM:EMITTANCES': {'type':'float', 'count': 2},
+                  'VIRT:BEAM:RESET_SIM': {'value': 0},
+                  'VIRT:SIM:FIDELITY': {'type': 'enum', 'enums': ['Fast', 'Full', 'Adaptive']},
+                  'VIRT:CACHE:HITS': {'type': 'int'},
+                  'VIRT:CACHE:MISSES': {'type': 'int'},
+                  'VIRT:CACHE:EVICTIONS': {'type': 'int'},
+    }
+    PVDB.update(custom_pvs)
+    PVDB.update(create_scan_pvdb())
+    PVDB.update(create_perf_pvdb())
+    PVDB.update(create_noise_pvdb())
+    PVDB.update(create_stream_pvdb())
+    PVDB.update(create_optics_pvdb())
+    PVDB.update(create_gradient_pvdb())
+    beam = ParticleBeam.from_openpmd_file(**design_incoming_beam)
+    beam.particle_charges = torch.tensor(1.0)
+    beamline = Segment.from_lattice_json(lcls_lattice)
+    write_snapshot(snapshot_file, devices, PVDB, beamline, beam, TrackingCache.make_context(beamline, beam))
+    snapshot = read_snapshot(snapshot_file)
+devices, PVDB = snapshot['devices'], snapshot['pvdb']
+# Record the requests of clients for replay.py, to the file given by SIM_RECORD
+recorder = Recorder(os.environ['SIM_RECORD']) if os.environ.get('SIM_RECORD') else None
+server = SimServer(PVDB, recorder=recorder)
 driver = SimDriver(
     server=server,
     screen=screen_name,
     devices=devices,
-    design_incoming_beam=design_incoming_beam,
-    lattice_file=lcls_lattice
+    particle_beam=snapshot['beam'],
+    beamline=snapshot['beamline'],
+    cache_context=snapshot['context'],
+    # Dump the timings for a local scraper to the file given by SIM_METRICS
+    metrics_file=os.environ.get('SIM_METRICS') or None,
+    # Keep the tracking results across restarts in the directory given by SIM_CACHE_DIR
+    cache_dir=os.environ.get('SIM_CACHE_DIR') or None,
 )
 
-print('Starting simulated server')
+logging.info('Starting simulated server')
 server.run()
@@ -2,46 +2,80 @@ from cheetah.particles import ParticleBeam
 from beamdriver import SimDriver, SimServer
 from cheetah.accelerator import Segment 
 import torch
+from utils.cache import TrackingCache
 from utils.load_yaml import load_relevant_controls
-from utils.pvdb import create_pvdb
-import pprint
-
-incoming_beam = ParticleBeam.from_twiss(
-    beta_x=torch.tensor(9.34),
-    alpha_x=torch.tensor(-1.6946),
-    emittance_x=torch.tensor(1e-7),
-    beta_y=torch.tensor(9.34),
-    alpha_y=torch.tensor(-1.6946),
-    emittance_y=torch.tensor(1e-7),
-    energy=torch.tensor(90e6),
-    num_particles=100000,
-    total_charge=torch.tensor(1e-9)
-)
+from utils.pvdb import create_pvdb, create_scan_pvdb, create_perf_pvdb, create_noise_pvdb, create_stream_pvdb, \
+    create_optics_pvdb, create_gradient_pvdb
+from utils.recorder import Recorder
+from utils.snapshot import read_snapshot, write_snapshot
+import logging
+import os
 
 #diag0_lattice = Segment.from_lattice_json("lattices/diag0_reconstruction.json")
 #print(diag0_lattice)
-devices = load_relevant_controls('yaml_configs/DIAG0.yaml')
+diag0_lattice = "lattices/diag0.json" # check that lattice file is actually real..
+yaml_config = 'yaml_configs/DIAG0.yaml'
+# Compiled devices, PV database, lattice and beam, rebuilt whenever one of its sources changes
+snapshot_file = 'snapshots/DIAG0.snap'
 screen_name = 'OTRS:DIAG0:420'
 #TODO: fix some type of bug were defaults are not getting set from passable dictionary.... 
 screen_defaults = {'n_row': 1944, 'n_col': 1472, 'resolution': 23.33 }
 tcav_defaults = {}
-PVDB = create_pvdb(devices, **screen_defaults)
-custom_pvs = {'VIRT:BEAM:EMITTANCES': {'type':'float', 'count': 2},
-            'VIRT:BEAM:MU:XY': {'type':'float', 'count': 2},
-            'VIRT:BEAM:SIGMA:XY': {'type':'float', 'count': 2},      
-            'VIRT:BEAM:RESET_SIM': {'value': 0},
-}
-PVDB.update(custom_pvs)
-pprint.pprint(PVDB)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+snapshot = read_snapshot(snapshot_file, sources=[yaml_config, diag0_lattice, __file__])
+if snapshot is None:
+    logging.info('Compiling %s', snapshot_file)
+    incoming_beam = ParticleBeam.from_twiss(
+        beta_x=torch.tensor(9.34),
+        alpha_x=torch.tensor(-1.6946),
+        emittance_x=torch.tensor(1e-7),
+        beta_y=torch.tensor(9.34),
+        alpha_y=torch.tensor(-1.6946),
+        emittance_y=torch.tensor(1e-7),
+        energy=torch.tensor(90e6),
+        num_particles=100000,
+        total_charge=torch.tensor(1e-9)
+    )
+    devices = load_relevant_controls(yaml_config)
+    PVDB = create_pvdb(devices, **screen_defaults)
+    custom_pvs = {'VIRT:BEAM:EMITTANCES': {'type':'float', 'count': 2},
+                'VIRT:BEAM:MU:XY': {'type':'float', 'count': 2},
+                'VIRT:BEAM:SIGMA:XY': {'type':'float', 'count': 2},      
+                'VIRT:BEAM:RESET_SIM': {'value': 0},
+                'VIRT:SIM:FIDELITY': {'type': 'enum', 'enums': ['Fast', 'Full', 'Adaptive']},
+                'VIRT:CACHE:HITS': {'type': 'int'},
+                'VIRT:CACHE:MISSES': {'type': 'int'},
+                'VIRT:CACHE:EVICTIONS': {'type': 'int'},
+    }
+    PVDB.update(custom_pvs)
+    PVDB.update(create_scan_pvdb())
+    PVDB.update(create_perf_pvdb())
+    PVDB.update(create_noise_pvdb())
+    PVDB.update(create_stream_pvdb())
+    PVDB.update(create_optics_pvdb())
+    PVDB.update(create_gradient_pvdb())
+    beamline = Segment.from_lattice_json(diag0_lattice)
+    write_snapshot(snapshot_file, devices, PVDB, beamline, incoming_beam,
+                   TrackingCache.make_context(beamline, incoming_beam))
+    snapshot = read_snapshot(snapshot_file)
+devices, PVDB = snapshot['devices'], snapshot['pvdb']
 
-server = SimServer(PVDB)
+# Record the requests of clients for replay.py, to the file given by SIM_RECORD
+recorder = Recorder(os.environ['SIM_RECORD']) if os.environ.get('SIM_RECORD') else None
+server = SimServer(PVDB, recorder=recorder)
 driver = SimDriver(
     server=server,
     screen=screen_name,
     devices=devices,
-    particle_beam=incoming_beam,
-    lattice_file="lattices/diag0.json" # check that lattice file is actually real..
+    particle_beam=snapshot['beam'],
+    beamline=snapshot['beamline'],
+    cache_context=snapshot['context'],
+    # Dump the timings for a local scraper to the file given by SIM_METRICS
+    metrics_file=os.environ.get('SIM_METRICS') or None,
+    # Keep the tracking results across restarts in the directory given by SIM_CACHE_DIR
+    cache_dir=os.environ.get('SIM_CACHE_DIR') or None,
 )
 
-print('Starting simulated server')
+logging.info('Starting simulated server')
 server.run()
\ No newline at end of file
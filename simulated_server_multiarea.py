@@ -0,0 +1,37 @@
+import logging
+
+import torch
+
+from multiarea import serve
+
+# Area name -> config, see multiarea.load_area. An area with an 'upstream' entry is fed the exit beam of that area.
+areas = {
+    'DL1': {
+        'yaml': 'yaml_configs/DL1.yaml',
+        'lattice': 'lattices/lcls_cu_segment_otr2.json',
+        'snapshot': 'snapshots/multiarea_DL1.snap',
+        'screen': 'OTRS:IN20:571',
+        'screen_defaults': {'n_row': 1392, 'n_col': 1040, 'resolution': 4.65, 'pneumatic': 'OUT'},
+        'openpmd_beam': {'path': 'h5/impact_inj_output_YAG03.h5',
+                         'energy': torch.tensor(125e6),
+                         'dtype': torch.float32},
+    },
+    'DIAG0': {
+        'yaml': 'yaml_configs/DIAG0.yaml',
+        'lattice': 'lattices/diag0.json',
+        'snapshot': 'snapshots/multiarea_DIAG0.snap',
+        'screen': 'OTRS:DIAG0:420',
+        'screen_defaults': {'n_row': 1944, 'n_col': 1472, 'resolution': 23.33},
+        'twiss_beam': {'beta_x': torch.tensor(9.34), 'alpha_x': torch.tensor(-1.6946),
+                       'emittance_x': torch.tensor(1e-7),
+                       'beta_y': torch.tensor(9.34), 'alpha_y': torch.tensor(-1.6946),
+                       'emittance_y': torch.tensor(1e-7),
+                       'energy': torch.tensor(90e6), 'num_particles': 100000,
+                       'total_charge': torch.tensor(1e-9)},
+    },
+}
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    logging.info('Starting simulated multi-area server')
+    serve(areas)
@@ -0,0 +1,89 @@
+"""
+Runs isolated copies of an area's simulated server on one host, one per user.
+
+Every tenant is a process with its own SimDriver, serving the area's PVs under the prefix '<tenant>:' on its own
+CA and PVA ports. The area's snapshot is compiled once and every tenant memory-maps it copy-on-write, so the
+incoming particle distribution is held once in the page cache rather than once per tenant.
+
+    $ python simulated_server_tenants.py --area DIAG0 --tenants alice bob
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+
+from beamdriver import SimDriver, SimServer
+from multiarea import load_area
+from simulated_server_multiarea import areas
+from utils.snapshot import read_snapshot
+
+
+def run_tenant(tenant: str, area: dict, ca_port: int, pva_port: int):
+    """
+    Serves one tenant, the target of a tenant process
+
+    Parameters
+    ----------
+    tenant : str
+        Tenant name, the PV prefix is '<tenant>:'
+    area : dict
+        Area config, see multiarea.load_area
+    ca_port, pva_port : int
+        CA and PVA server ports of the tenant, its PVA UDP search port is the next one
+    """
+    # Read by the CA and PVA servers when they start
+    os.environ.update(EPICS_CAS_SERVER_PORT=str(ca_port),
+                      EPICS_PVA_SERVER_PORT=str(pva_port), EPICS_PVA_BROADCAST_PORT=str(pva_port + 1))
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s %(levelname)s {tenant} %(name)s: %(message)s')
+
+    snapshot = read_snapshot(area['snapshot'])
+    server = SimServer(snapshot['pvdb'], prefix=f'{tenant}:')
+    driver = SimDriver(
+        server=server,
+        screen=area['screen'],
+        devices=snapshot['devices'],
+        particle_beam=snapshot['beam'],
+        beamline=snapshot['beamline'],
+        cache_context=snapshot['context'],
+        cache_size_mb=area.get('cache_size_mb', 64),
+        # Tenants share the directory given by SIM_CACHE_DIR, their results are the same for the same settings
+        cache_dir=os.environ.get('SIM_CACHE_DIR') or None,
+    )
+    logging.info('Serving %s on CA port %d and PVA port %d', tenant, ca_port, pva_port)
+    server.run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--area', choices=list(areas), default='DIAG0')
+    parser.add_argument('--tenants', nargs='+', required=True, help='Tenant names, used as PV prefixes')
+    parser.add_argument('--ca-port', type=int, default=5064, help='CA server port of the first tenant')
+    parser.add_argument('--pva-port', type=int, default=5075, help='PVA server port of the first tenant')
+    parser.add_argument('--port-stride', type=int, default=10, help='Port offset between consecutive tenants')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    area = areas[args.area]
+    # Compile before starting the tenants, so they all map the same file
+    load_area(area)
+
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for i, tenant in enumerate(args.tenants):
+        ca_port, pva_port = args.ca_port + i * args.port_stride, args.pva_port + i * args.port_stride
+        process = context.Process(target=run_tenant, args=(tenant, area, ca_port, pva_port), name=tenant)
+        process.start()
+        processes.append(process)
+        print(f'{tenant}: prefix {tenant}: '
+              f'EPICS_CA_ADDR_LIST=127.0.0.1:{ca_port} EPICS_PVA_NAME_SERVERS=127.0.0.1:{pva_port}')
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    main()
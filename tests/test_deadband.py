@@ -0,0 +1,86 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('torch')
+pytest.importorskip('cheetah')
+pytest.importorskip('pcaspy')
+pytest.importorskip('p4p')
+
+from beamdriver import SimDriver, SimServer
+
+
+class DriverState:
+    """The part of a SimDriver that deciding on posts uses"""
+
+    def __init__(self, deadbands=None):
+        self._deadbands = deadbands or {}
+        self._posted = {}
+        self.params = {}
+
+    def set_param(self, reason, value):
+        self.params[reason] = value
+
+    def changed(self, reason, value):
+        return SimDriver._changed(self, reason, value)
+
+    def apply(self, reason, value):
+        SimDriver._apply(self, reason, value)
+
+
+def test_deadband_fields_are_served():
+    server = SimServer({'TEST:DEADBAND:A': {'type': 'float', 'value': 0.0, 'mdel': 0.5, 'adel': 2.0},
+                        'TEST:DEADBAND:E': {'type': 'enum', 'enums': ['Off', 'On']}}, ca=False)
+    assert server._pva_fields['TEST:DEADBAND:A.MDEL']['value'] == 0.5
+    assert server._pva_fields['TEST:DEADBAND:A.ADEL']['value'] == 2.0
+    assert server._ca_fields['TEST:DEADBAND:A.MDEL']['value'] == 0.5
+    assert 'TEST:DEADBAND:E.MDEL' not in server._pva_fields
+
+
+def test_unchanged_value_is_not_posted():
+    state = DriverState()
+    assert state.changed('A', 1.0)
+    assert not state.changed('A', 1.0)
+    assert state.changed('A', 1.5)
+    assert state.changed('A', [1.5, 2.0])
+
+
+def test_monitor_deadband_suppresses_posts():
+    state = DriverState()
+    state.apply('A.MDEL', 0.5)
+    state.apply('A.ADEL', 0.5)
+    assert state.params['A.MDEL'] == 0.5
+    assert state.changed('A', 1.0)
+    assert not state.changed('A', 1.2)
+    assert not state.changed('A', 1.45)
+    # Measured from the last posted value, not the last value
+    assert state.changed('A', 1.6)
+    assert not state.changed('A', 1.9)
+
+
+def test_archive_deadband_posts_on_its_own():
+    state = DriverState({'A': [1.0, 0.1]})
+    assert state.changed('A', 0.0)
+    assert state.changed('A', 0.2)
+    assert not state.changed('A', 0.25)
+
+
+def test_negative_deadband_posts_every_value():
+    state = DriverState({'A': [-1.0, 0.0]})
+    assert state.changed('A', 1.0)
+    assert state.changed('A', 1.0)
+
+
+def test_waveform_posts_when_any_element_moves():
+    state = DriverState({'W': [0.5, 0.5]})
+    assert state.changed('W', [0.0, 0.0])
+    assert not state.changed('W', [0.1, 0.4])
+    assert state.changed('W', [0.1, 0.6])
+
+
+def test_images_are_compared_by_content():
+    state = DriverState()
+    frame = np.zeros((4, 3), dtype=np.uint16)
+    assert state.changed('IMG', frame)
+    assert not state.changed('IMG', frame.copy())
+    frame[1, 2] = 7
+    assert state.changed('IMG', frame)
@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+pytest.importorskip('cheetah')
+pytest.importorskip('pcaspy')
+pytest.importorskip('p4p')
+
+from cheetah.accelerator import Screen
+from cheetah.particles import ParticleBeam
+
+from beamdriver import render_roi
+
+
+def read_screen(method: str) -> Screen:
+    screen = Screen(resolution=(64, 48), pixel_size=torch.tensor([1e-4, 1e-4]), method=method, is_active=True)
+    beam = ParticleBeam.from_parameters(num_particles=10000, sigma_x=torch.tensor(1e-3),
+                                        sigma_y=torch.tensor(8e-4), energy=torch.tensor(90e6))
+    screen.track(beam)
+    return screen
+
+
+@pytest.mark.parametrize('method', ['histogram', 'cloud-in-cell'])
+def test_roi_is_a_crop_of_the_full_frame(method):
+    screen = read_screen(method)
+    full = screen.reading
+    roi = render_roi(screen, 10, 30, 5, 20)
+    torch.testing.assert_close(roi, full[5:25, 10:40])
+
+
+@pytest.mark.parametrize('method', ['histogram', 'cloud-in-cell'])
+def test_binned_roi_sums_the_pixels(method):
+    screen = read_screen(method)
+    full = screen.reading
+    roi = render_roi(screen, 10, 30, 5, 20, bin_x=3, bin_y=2)
+    torch.testing.assert_close(roi, full[5:25, 10:40].unflatten(0, (10, 2)).sum(1).unflatten(1, (10, 3)).sum(2))
+
+
+def test_unknown_method_raises():
+    screen = read_screen('histogram')
+    screen.method = 'other'
+    with pytest.raises(ValueError):
+        render_roi(screen, 0, 8, 0, 8)
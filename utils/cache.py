@@ -0,0 +1,273 @@
+import atexit
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import cheetah
+import numpy as np
+import torch
+
+
+class TrackingCache:
+    """
+    Bounded LRU cache of tracking results, keyed on a hash of the machine setting vector.
+
+    A result is a dict with a 'moments' dict (name -> float), a 'readings' dict
+    (screen name -> numpy image) and optionally an 'optics' dict (name -> numpy array).
+    The in-memory tier is limited by the total size of the stored arrays. An optional
+    on-disk tier keeps results across server restarts. Results are written to it when
+    they are evicted from memory, in batches and at exit, not on every put.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 2**20, cache_dir: str | None = None,
+                 max_disk_bytes: int = 4 * 2**30, save_batch: int = 32):
+        """
+        Parameters
+        ----------
+        max_bytes : int
+            Memory limit of the in-memory tier, in bytes
+        cache_dir : str | None
+            Directory of the on-disk tier, or None to disable it
+        max_disk_bytes : int
+            Size limit of the on-disk tier, in bytes
+        save_batch : int
+            Number of unsaved results that triggers writing them to the on-disk tier
+        """
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.save_batch = save_batch
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._sizes: dict[str, int] = {}
+        self._nbytes = 0
+        # Keys stored in memory since they were last written to disk
+        self._unsaved: set[str] = set()
+        # Files of the on-disk tier, least recently used first, with their sizes
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            # The directory is listed once, then the index and the running total are kept up to date
+            files = []
+            for f in os.listdir(cache_dir):
+                if f.endswith('.npz'):
+                    st = os.stat(os.path.join(cache_dir, f))
+                    files.append((st.st_mtime, st.st_size, f[:-len('.npz')]))
+            for _, size, key in sorted(files):
+                self._disk[key] = size
+                self._disk_bytes += size
+            atexit.register(self.flush)
+
+    @staticmethod
+    def make_key(context: str, settings) -> str:
+        """
+        Hashes a setting vector into a cache key
+
+        Parameters
+        ----------
+        context : str
+            Digest of everything the results depend on besides the settings (lattice, incoming beam)
+        settings : Sequence[float]
+            Machine setting vector
+
+        Returns
+        -------
+        str
+            Hex digest identifying the settings
+        """
+        h = hashlib.sha1(context.encode())
+        h.update(np.asarray(settings, dtype=np.float64).tobytes())
+        return h.hexdigest()
+
+    @staticmethod
+    def make_context(segment, beam) -> str:
+        """
+        Digests the lattice layout, the screens' resolution, pixel size and binning, the incoming beam and the
+        versions of cheetah and torch, which the cached results also depend on
+
+        Parameters
+        ----------
+        segment : Segment
+            Simulated lattice
+        beam : ParticleBeam
+            Incoming beam
+
+        Returns
+        -------
+        str
+            Hex digest passed to make_key
+        """
+        # Results on disk were tracked by the code of these versions
+        h = hashlib.sha1(f'cheetah {cheetah.__version__} torch {torch.__version__}'.encode())
+        for element in segment.elements:
+            h.update(f'{element.name}:{type(element).__name__}:{element.length.item()}'.encode())
+            if type(element).__name__ == 'Screen':
+                pixel_size = element.pixel_size.detach().cpu().numpy().tolist()
+                h.update(f'{tuple(element.resolution)}:{pixel_size}:{element.binning}'.encode())
+        h.update(beam.particles.detach().cpu().numpy().tobytes())
+        h.update(str(beam.energy.item()).encode())
+        return h.hexdigest()
+
+    @property
+    def stats(self) -> dict:
+        """Returns the hit, miss and eviction counters together with the current size"""
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'nbytes': self._nbytes,
+            'disk_entries': len(self._disk),
+            'disk_nbytes': self._disk_bytes,
+        }
+
+    def get(self, key: str) -> dict | None:
+        """
+        Looks up a result, falling back to the on-disk tier
+
+        Parameters
+        ----------
+        key : str
+            Key returned by make_key
+
+        Returns
+        -------
+        dict | None
+            The cached result, or None on a miss
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        result = self._load(key)
+        if result is None:
+            self.misses += 1
+            return None
+
+        self.disk_hits += 1
+        self._store(key, result, saved=True)
+        return result
+
+    def put(self, key: str, result: dict):
+        """
+        Stores a result, evicting the least recently used entries if over the memory limit.
+        Storing an existing key again updates its size, e.g. after a reading was added to it.
+        Evicted results and, once save_batch results are unsaved, every unsaved result are written to disk.
+
+        Parameters
+        ----------
+        key : str
+            Key returned by make_key
+        result : dict
+            Result with 'moments' and 'readings'
+        """
+        evicted = self._store(key, result)
+        if not self.cache_dir:
+            return
+        with self._lock:
+            if len(self._unsaved) >= self.save_batch:
+                evicted += [(k, self._entries[k]) for k in self._unsaved]
+                self._unsaved.clear()
+        for k, r in evicted:
+            self._save(k, r)
+
+    def flush(self):
+        """Writes every result not saved yet to the on-disk tier"""
+        if not self.cache_dir:
+            return
+        with self._lock:
+            unsaved = [(k, self._entries[k]) for k in self._unsaved]
+            self._unsaved.clear()
+        for k, r in unsaved:
+            self._save(k, r)
+
+    def clear(self):
+        """Drops every in-memory entry, writing the unsaved ones to disk first"""
+        self.flush()
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._nbytes = 0
+
+    @staticmethod
+    def _size(result: dict) -> int:
+        size = sum(r.nbytes for r in result['readings'].values()) + 64 * len(result['moments'])
+        return size + sum(np.asarray(v).nbytes for v in result.get('optics', {}).values())
+
+    def _store(self, key: str, result: dict, saved: bool = False) -> list:
+        """Stores a result in memory and returns the evicted results that still have to be written to disk"""
+        size = self._size(result)
+        evicted = []
+        with self._lock:
+            self._nbytes += size - self._sizes.get(key, 0)
+            self._entries[key] = result
+            self._sizes[key] = size
+            self._entries.move_to_end(key)
+            if not saved:
+                self._unsaved.add(key)
+            # Never evict the entry that was just stored
+            while self._nbytes > self.max_bytes and len(self._entries) > 1:
+                old, old_result = self._entries.popitem(last=False)
+                self._nbytes -= self._sizes.pop(old)
+                self.evictions += 1
+                if old in self._unsaved:
+                    self._unsaved.discard(old)
+                    evicted.append((old, old_result))
+        return evicted
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def _load(self, key: str) -> dict | None:
+        if not self.cache_dir or not os.path.exists(self._path(key)):
+            return None
+        try:
+            with np.load(self._path(key)) as f:
+                result = {'moments': {}, 'readings': {}}
+                for k in f.files:
+                    kind, name = k.split('/', 1)
+                    result.setdefault(kind, {})[name] = f[k].item() if kind == 'moments' else f[k]
+            # Keeps the least recently used order across restarts
+            os.utime(self._path(key))
+            with self._disk_lock:
+                if key in self._disk:
+                    self._disk.move_to_end(key)
+            return result
+        except Exception:
+            return None
+
+    def _save(self, key: str, result: dict):
+        arrays = {f'moments/{k}': np.asarray(v) for k, v in result['moments'].items()}
+        arrays.update({f'readings/{k}': v for k, v in result['readings'].items()})
+        arrays.update({f'optics/{k}': np.asarray(v) for k, v in result.get('optics', {}).items()})
+        tmp = self._path(key) + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        size = os.path.getsize(tmp)
+        os.replace(tmp, self._path(key))
+        with self._disk_lock:
+            self._disk_bytes += size - self._disk.pop(key, 0)
+            self._disk[key] = size
+            self._trim_disk()
+
+    def _trim_disk(self):
+        """Removes the least recently used files once the on-disk tier is over its limit, keeping the newest one"""
+        while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+            key, size = self._disk.popitem(last=False)
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            self._disk_bytes -= size
+            self.evictions += 1
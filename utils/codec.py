@@ -0,0 +1,166 @@
+import zlib
+
+import numpy as np
+
+# Optional compressors, the corresponding codecs are only offered when they are installed
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+try:
+    import bitshuffle
+except ImportError:
+    bitshuffle = None
+
+# Compressor enum choices -> NTNDArray codec.name, as used by areaDetector's NDPluginCodec where it has one
+CODECS = {
+    'None': '',
+    'LZ4': 'lz4',
+    'Zlib': 'zlib',
+    'BSLZ4': 'bslz4',
+}
+
+# Fast rather than small, frames are compressed on every publication
+ZLIB_LEVEL = 1
+
+# pvData ScalarType of the uncompressed array, sent as codec.parameters
+SCALAR_TYPES = {
+    np.dtype(np.int8): 1,
+    np.dtype(np.int16): 2,
+    np.dtype(np.int32): 3,
+    np.dtype(np.int64): 4,
+    np.dtype(np.uint8): 5,
+    np.dtype(np.uint16): 6,
+    np.dtype(np.uint32): 7,
+    np.dtype(np.uint64): 8,
+    np.dtype(np.float32): 9,
+    np.dtype(np.float64): 10,
+}
+
+
+def available_codecs() -> list:
+    """Returns the Compressor choices whose compressor is installed, 'None' first"""
+    available = {'None': True, 'LZ4': lz4 is not None, 'Zlib': True,
+                 'BSLZ4': lz4 is not None and bitshuffle is not None}
+    return [k for k in CODECS if available[k]]
+
+
+def image_dtype(n_bits: int) -> np.dtype:
+    """Returns the smallest unsigned integer type holding n_bits, as a camera would deliver"""
+    return np.dtype(np.uint8) if n_bits <= 8 else np.dtype(np.uint16)
+
+
+def quantize(image: np.ndarray, n_bits: int, gain: float, out: np.ndarray | None = None, noise=None,
+             shift: tuple = (0, 0)) -> np.ndarray:
+    """
+    Converts a simulated reading to camera counts with a fixed gain, as a camera would: the same charge on a pixel
+    gives the same counts in every frame, and counts beyond the range of the camera saturate at 2**n_bits - 1.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        Floating point reading
+    n_bits : int
+        Bit depth of the camera, at most 16
+    gain : float
+        Counts per unit of the reading
+    out : np.ndarray | None
+        Array of image_dtype(n_bits) to write the counts to
+    noise : NoiseModel | None
+        Noise added to the counts before they are rounded
+    shift : tuple
+        Offset of the image in whole pixels (rows, columns), such as from shot-to-shot beam position jitter
+
+    Returns
+    -------
+    np.ndarray
+        Counts as image_dtype(n_bits)
+    """
+    if out is None:
+        out = np.empty(image.shape, dtype=image_dtype(n_bits))
+    full_scale = (1 << n_bits) - 1
+    # Round to nearest, in a float32 temporary to halve the memory traffic
+    if any(shift):
+        scaled = np.zeros(image.shape, dtype=np.float32)
+        dst, src = zip(*(_shifted_slices(n, d) for n, d in zip(image.shape, shift)))
+        np.multiply(image[src], gain, out=scaled[dst])
+    else:
+        scaled = np.multiply(image, gain, dtype=np.float32)
+    if noise is not None:
+        noise.apply(scaled, full_scale)
+    np.add(scaled, 0.5, out=scaled)
+    np.clip(scaled, 0, full_scale, out=scaled)
+    np.copyto(out, scaled, casting='unsafe')
+    return out
+
+
+def _shifted_slices(n: int, offset: int) -> tuple[slice, slice]:
+    """Returns the destination and source slices moving an axis of length n by offset, dropping what falls off"""
+    offset = int(offset)
+    if abs(offset) >= n:
+        return slice(0, 0), slice(0, 0)
+    if offset >= 0:
+        return slice(offset, n), slice(0, n - offset)
+    return slice(0, n + offset), slice(-offset, n)
+
+
+def compress(array: np.ndarray, codec: str) -> bytes:
+    """
+    Compresses an array for the NTNDArray value field
+
+    Parameters
+    ----------
+    array : np.ndarray
+        Contiguous array to compress
+    codec : str
+        NTNDArray codec name, one of the values of CODECS
+
+    Returns
+    -------
+    bytes
+        Compressed data
+    """
+    match codec:
+        case 'lz4':
+            return lz4.block.compress(array.tobytes(), store_size=False)
+        case 'zlib':
+            return zlib.compress(array.tobytes(), ZLIB_LEVEL)
+        case 'bslz4':
+            return bitshuffle.compress_lz4(np.ascontiguousarray(array).ravel()).tobytes()
+        case _:
+            raise ValueError(f'Unsupported codec "{codec}"')
+
+
+def decompress(data, codec: str, dtype, count: int) -> np.ndarray:
+    """
+    Decompresses the value field of an NTNDArray, for clients and tests
+
+    Parameters
+    ----------
+    data : bytes-like
+        Compressed data
+    codec : str
+        NTNDArray codec name
+    dtype : np.dtype
+        Type of the uncompressed array
+    count : int
+        Number of elements of the uncompressed array
+
+    Returns
+    -------
+    np.ndarray
+        Flat uncompressed array
+    """
+    dtype = np.dtype(dtype)
+    data = bytes(data)
+    match codec:
+        case 'lz4':
+            raw = lz4.block.decompress(data, uncompressed_size=count * dtype.itemsize)
+        case 'zlib':
+            raw = zlib.decompress(data)
+        case 'bslz4':
+            return bitshuffle.decompress_lz4(np.frombuffer(data, dtype=np.uint8), (count,), dtype)
+        case _:
+            raise ValueError(f'Unsupported codec "{codec}"')
+    return np.frombuffer(raw, dtype=dtype, count=count)
@@ -0,0 +1,107 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+import torch
+from cheetah.particles import ParticleBeam
+
+
+class BeamHandoff:
+    """
+    Beam at the exit of an area, handed to the area it feeds through shared memory.
+
+    The block holds a header and, per particle, its 7 coordinates, charge and survival probability as float32.
+    The writer makes the sequence number odd while it writes and even once done, a reader copies the beam
+    and keeps it only if the sequence number did not change meanwhile.
+    """
+
+    # float64 header slots
+    SEQUENCE, CAPACITY, NUM_PARTICLES, ENERGY, S = range(5)
+    HEADER = 8
+    # float32 values per particle: coordinates, charge, survival probability
+    PARTICLE_SIZE = 9
+
+    def __init__(self, name: str, capacity: int | None = None):
+        """
+        Parameters
+        ----------
+        name : str
+            Name of the shared memory block
+        capacity : int | None
+            Maximum number of particles. Given by the writer, which creates the block, a reader attaches to it.
+        """
+        if capacity is not None:
+            size = 8 * self.HEADER + 4 * self.PARTICLE_SIZE * capacity
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self._header = np.ndarray((self.HEADER,), dtype=np.float64, buffer=self._shm.buf)
+        if capacity is not None:
+            self._header[:] = 0
+            self._header[self.CAPACITY] = capacity
+        self.capacity = int(self._header[self.CAPACITY])
+        self._data = np.ndarray((self.capacity, self.PARTICLE_SIZE), dtype=np.float32,
+                                buffer=self._shm.buf, offset=8 * self.HEADER)
+
+    @classmethod
+    def attach(cls, name: str) -> 'BeamHandoff | None':
+        """Attaches to the block of a writer, None if it was not created yet"""
+        try:
+            return cls(name)
+        except FileNotFoundError:
+            return None
+
+    @property
+    def sequence(self) -> int:
+        """Number of the last beam written, times two"""
+        return int(self._header[self.SEQUENCE])
+
+    def write(self, beam: ParticleBeam):
+        """Publishes a beam to the readers"""
+        n = beam.particles.shape[-2]
+        if beam.particles.dim() != 2 or n > self.capacity:
+            raise ValueError(f'Cannot hand over a beam of shape {tuple(beam.particles.shape)}, '
+                             f'at most ({self.capacity}, 7)')
+        self._header[self.SEQUENCE] += 1
+        self._data[:n, :7] = beam.particles.detach().cpu().numpy()
+        self._data[:n, 7] = np.broadcast_to(beam.particle_charges.detach().cpu().numpy(), (n,))
+        self._data[:n, 8] = np.broadcast_to(beam.survival_probabilities.detach().cpu().numpy(), (n,))
+        self._header[self.NUM_PARTICLES] = n
+        self._header[self.ENERGY] = beam.energy.item()
+        self._header[self.S] = beam.s.item()
+        self._header[self.SEQUENCE] += 1
+
+    def read(self, since: int = 0) -> tuple[int, ParticleBeam] | None:
+        """
+        Copies the last beam written
+
+        Parameters
+        ----------
+        since : int
+            Sequence number of the beam the reader already has
+
+        Returns
+        -------
+        tuple[int, ParticleBeam] | None
+            Sequence number and beam, or None if no newer beam is complete
+        """
+        sequence = self.sequence
+        if sequence == since or sequence == 0 or sequence % 2:
+            return None
+        n = int(self._header[self.NUM_PARTICLES])
+        data = self._data[:n].copy()
+        energy, s = self._header[self.ENERGY], self._header[self.S]
+        if self.sequence != sequence:
+            return None
+        data = torch.from_numpy(data)
+        beam = ParticleBeam(particles=data[:, :7].contiguous(), energy=torch.tensor(energy, dtype=data.dtype),
+                            particle_charges=data[:, 7].contiguous(),
+                            survival_probabilities=data[:, 8].contiguous(), s=torch.tensor(s, dtype=data.dtype))
+        return sequence, beam
+
+    def close(self):
+        self._header = self._data = None
+        self._shm.close()
+
+    def unlink(self):
+        """Removes the block, done by the writer once no process needs it"""
+        self._shm.unlink()
@@ -21,6 +21,15 @@ def load_relevant_controls(yaml_file):
             relevant_controls[control_name]['metadata'] = info['metadata']
             relevant_controls[control_name]['madname'] = name.lower()
     
+    # Process bpms, a trailing '?' marks a name that is not certain
+    for name, info in data.get('bpms', {}).items():
+        if info['metadata']['type'] == 'BPM':
+            control_name = info['controls_information']['control_name']
+            relevant_controls[control_name] = {}
+            relevant_controls[control_name]['pvs'] = info['controls_information']['PVs']
+            relevant_controls[control_name]['metadata'] = info['metadata']
+            relevant_controls[control_name]['madname'] = name.lower().rstrip('?')
+
     # Process tcav
     for name, info in data.get('tcavs', {}).items():
         if info['metadata']['type'] == 'LCAV':
@@ -31,4 +40,3 @@ def load_relevant_controls(yaml_file):
             relevant_controls[control_name]['madname'] = name.lower() 
     return relevant_controls
 
-#TODO: multiarea
\ No newline at end of file
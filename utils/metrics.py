@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class RollingHistogram:
+    """
+    Keeps the most recent samples of a measurement, so that percentiles reflect current behaviour
+    rather than the whole lifetime of the server.
+    """
+
+    def __init__(self, window: int = 1024):
+        """
+        Parameters
+        ----------
+        window : int
+            Number of most recent samples to keep
+        """
+        self._samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self._samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def summary(self) -> dict:
+        """
+        Returns
+        -------
+        dict
+            count and sum over the lifetime, mean/p50/p90/p99/max over the window
+        """
+        result = {'count': self.count, 'sum': self.total}
+        if self._samples:
+            samples = np.fromiter(self._samples, dtype=float, count=len(self._samples))
+            p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+            result.update(mean=float(samples.mean()), p50=float(p50), p90=float(p90), p99=float(p99),
+                          max=float(samples.max()))
+        else:
+            result.update(mean=0.0, p50=0.0, p90=0.0, p99=0.0, max=0.0)
+        return result
+
+
+class Metrics:
+    """
+    Registry of rolling histograms (durations in seconds) and gauges (last value) for the simulator
+    hot paths. Recording a sample only appends to a deque, the statistics are computed when read.
+    """
+
+    def __init__(self, window: int = 1024):
+        """
+        Parameters
+        ----------
+        window : int
+            Number of samples kept by each histogram
+        """
+        self.window = window
+        self._histograms: dict[str, RollingHistogram] = {}
+        self._gauges: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float):
+        """Adds a sample to the named histogram, creating it if needed"""
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = RollingHistogram(self.window)
+            histogram.observe(value)
+
+    def set_gauge(self, name: str, value: float):
+        self._gauges[name] = value
+
+    @contextmanager
+    def timer(self, name: str):
+        """Times the enclosed block into the named histogram"""
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t)
+
+    def histogram(self, name: str) -> dict:
+        """Returns the summary of the named histogram, all zero if nothing was recorded yet"""
+        with self._lock:
+            histogram = self._histograms.get(name)
+            return histogram.summary() if histogram else RollingHistogram(1).summary()
+
+    def gauge(self, name: str) -> float:
+        return self._gauges.get(name, 0.0)
+
+    def dump(self, prefix: str = 'linac_sim') -> str:
+        """
+        Formats every metric in the Prometheus text exposition format
+
+        Parameters
+        ----------
+        prefix : str
+            Prefix of the metric names
+
+        Returns
+        -------
+        str
+            One line per value
+        """
+        lines = []
+        with self._lock:
+            histograms = {name: h.summary() for name, h in self._histograms.items()}
+        for name, s in sorted(histograms.items()):
+            metric = f'{prefix}_{name}_seconds'
+            lines.append(f'# TYPE {metric} summary')
+            for q, quantile in (('p50', '0.5'), ('p90', '0.9'), ('p99', '0.99')):
+                lines.append(f'{metric}{{quantile="{quantile}"}} {s[q]:.6g}')
+            lines.append(f'{metric}_sum {s["sum"]:.6g}')
+            lines.append(f'{metric}_count {s["count"]}')
+        for name, value in sorted(self._gauges.items()):
+            lines.append(f'# TYPE {prefix}_{name} gauge')
+            lines.append(f'{prefix}_{name} {value:.6g}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str, prefix: str = 'linac_sim'):
+        """Writes the dump to a file, replacing it atomically so a scraper never sees a partial file"""
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.dump(prefix))
+        os.replace(tmp, path)
@@ -0,0 +1,121 @@
+import numpy as np
+
+
+class NoiseModel:
+    """
+    Camera noise added to screen images in counts: shot noise, a constant background, dark current
+    and hot pixels. Gaussian samples are drawn once into a bank, and each frame takes slices of it at
+    random offsets, so a full frame of noise costs a few vectorized operations instead of millions of
+    fresh RNG draws. For a given seed the sequence of frames is reproducible.
+    """
+
+    # Noise parameters that can be set through configure, see __init__
+    PARAMETERS = ('enabled', 'seed', 'shot', 'background', 'dark', 'hot_pixels')
+
+    def __init__(self, seed: int = 0, shot: float = 0.0, background: float = 0.0, dark: float = 0.0,
+                 hot_pixels: float = 0.0, enabled: bool = False, bank_size: int = 2**22):
+        """
+        Parameters
+        ----------
+        seed : int
+            Seed of the noise bank, the frame offsets and the hot pixel positions
+        shot : float
+            Counts per photoelectron, the shot noise of a pixel with s counts has a standard deviation of
+            sqrt(shot * s). 0 disables shot noise.
+        background : float
+            Constant offset in counts
+        dark : float
+            Standard deviation of the dark current and readout noise in counts
+        hot_pixels : float
+            Fraction of pixels stuck at full scale
+        enabled : bool
+            Whether apply adds any noise
+        bank_size : int
+            Minimum number of samples in the noise bank, it grows to twice the largest frame
+        """
+        self.shot = shot
+        self.background = background
+        self.dark = dark
+        self.hot_pixels = hot_pixels
+        self.enabled = enabled
+        self.bank_size = bank_size
+        self._bank = None
+        self._hot = {}
+        self.reseed(seed)
+
+    def reseed(self, seed: int):
+        """Restarts the noise sequence from a seed, the frames that follow are the same for the same seed"""
+        self.seed = int(seed)
+        self._rng = np.random.default_rng(self.seed)
+        self._bank = None
+        self._hot = {}
+
+    def configure(self, **params):
+        """
+        Sets noise parameters by name, a new seed restarts the noise sequence
+
+        Parameters
+        ----------
+        **params
+            Any of PARAMETERS
+        """
+        for name, value in params.items():
+            if name not in self.PARAMETERS:
+                raise ValueError(f'Unknown noise parameter "{name}"')
+            if name == 'seed':
+                self.reseed(value)
+            elif name == 'enabled':
+                self.enabled = bool(value)
+            else:
+                if name == 'hot_pixels':
+                    self._hot = {}
+                setattr(self, name, float(value))
+
+    def _samples(self, shape: tuple) -> np.ndarray:
+        """Returns a view of standard normal samples with the given shape, from a random offset into the bank"""
+        n = int(np.prod(shape))
+        if self._bank is None or len(self._bank) < 2 * n:
+            self._bank = self._rng.standard_normal(max(self.bank_size, 2 * n), dtype=np.float32)
+        offset = self._rng.integers(0, len(self._bank) - n + 1)
+        return self._bank[offset:offset + n].reshape(shape)
+
+    def _hot_pixels(self, shape: tuple) -> np.ndarray:
+        """Returns the flat indices of the hot pixels of a frame shape, fixed for a seed like on a real sensor"""
+        hot = self._hot.get(shape)
+        if hot is None:
+            n = int(np.prod(shape))
+            rng = np.random.default_rng([self.seed, n])
+            hot = self._hot[shape] = rng.choice(n, size=int(round(self.hot_pixels * n)), replace=False)
+        return hot
+
+    def apply(self, counts: np.ndarray, full_scale: float) -> np.ndarray:
+        """
+        Adds noise to a frame in place
+
+        Parameters
+        ----------
+        counts : np.ndarray
+            Contiguous float32 frame in counts
+        full_scale : float
+            Largest count of the camera, the value of hot pixels
+
+        Returns
+        -------
+        np.ndarray
+            counts
+        """
+        if not self.enabled:
+            return counts
+        if self.shot > 0:
+            sigma = np.maximum(counts, 0)
+            sigma *= self.shot
+            np.sqrt(sigma, out=sigma)
+            sigma *= self._samples(counts.shape)
+            counts += sigma
+        if self.dark > 0:
+            counts += self.dark * self._samples(counts.shape)
+        if self.background:
+            counts += self.background
+        if self.hot_pixels > 0:
+            counts.reshape(-1)[self._hot_pixels(counts.shape)] = full_scale
+        return counts
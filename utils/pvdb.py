@@ -1,5 +1,7 @@
 
 import pprint
+import numpy as np
+from utils.codec import available_codecs
 
 def create_pvdb(device: dict, **default_params) -> dict:
     pvdb = {}
@@ -13,7 +15,7 @@ def create_pvdb(device: dict, **default_params) -> dict:
         if 'QUAD' in key:
             quad_params = {
                 get_pv('bact'): {'type': 'float', 'value': 0.0, 'prec': 5, 'hopr': 20, 'lopr': -20, 'drvh': 20, 'drvl': -20},
-                get_pv('bctrl'): {'type': 'float', 'value': 0.0, 'prec': 5, 'hopr': 20, 'lopr': -20, 'drvh': 20, 'drvl': -20},
+                get_pv('bctrl'): {'type': 'float', 'value': 0.0, 'prec': 5, 'hopr': 20, 'lopr': -20, 'drvh': 20, 'drvl': -20, 'asyn': True},
                 get_pv('bmax'): {'type': 'float', 'value': 20.0, 'prec': 5},
                 get_pv('bmin'): {'type': 'float', 'value': -20.0, 'prec': 5},
                 get_pv('bdes'): {'type': 'float', 'value': 0.0, 'prec': 5, 'hopr': 20, 'lopr': -20, 'drvh': 20, 'drvl': -20},
@@ -28,7 +30,7 @@ def create_pvdb(device: dict, **default_params) -> dict:
             new_pvs = {}
             for k, v in quad_params.items():
                 for parm, val in v.items():
-                    if parm in ['type', 'value']:
+                    if parm in ['type', 'value', 'asyn']:
                         continue
                     new_pvs[f'{k}.{parm.upper()}'] = {'type': 'float', 'value': val}
             quad_params.update(new_pvs)
@@ -38,12 +40,15 @@ def create_pvdb(device: dict, **default_params) -> dict:
         elif 'OTRS' in key:
             n_row = default_params.get('n_row', 1944)
             n_col = default_params.get('n_col',1472)
+            n_bits = default_params.get('n_bits', 12)
             screen_params = {
                 get_pv('image'): {
-                    'type': 'float',
+                    # Smallest CA type holding the camera counts, pcaspy's 'char' is unsigned and 'short' signed
+                    'type': 'char' if n_bits <= 8 else 'short' if n_bits <= 15 else 'int',
                     'count': n_row * n_col,
                     'n_row': n_row,
                     'n_col': n_col,
+                    'n_bits': n_bits,
                 },
                 get_pv('n_row'): {
                     'type': 'int',
@@ -59,12 +64,49 @@ def create_pvdb(device: dict, **default_params) -> dict:
                 },
                 get_pv('pneumatic'): {
                     'type': 'enum',
-                    'enums': ['OUT', 'IN']
-                }
+                    'enums': ['OUT', 'IN'],
+                    'asyn': True
+                },
+                # Region of interest and binning of the rendered image, in pixels as for areaDetector.
+                # ArraySize0 (n_row) is along X and ArraySize1 (n_col) along Y.
+                f'{key}:MinX': {'type': 'int', 'value': 0},
+                f'{key}:SizeX': {'type': 'int', 'value': n_row},
+                f'{key}:MinY': {'type': 'int', 'value': 0},
+                f'{key}:SizeY': {'type': 'int', 'value': n_col},
+                f'{key}:BinX': {'type': 'int', 'value': 1},
+                f'{key}:BinY': {'type': 'int', 'value': 1},
+                # Camera gain in counts per unit of the reading (charge on a pixel, in the beam's charge units).
+                # 0 calibrates it on the first frame with beam, so that the frame peaks at half of full scale.
+                f'{key}:Gain': {'type': 'float', 'value': default_params.get('gain', 0.0)},
+                # Compression of the image over PVA, for clients that decode the NTNDArray codec
+                f'{key}:Image:Compressor': {'type': 'enum', 'enums': available_codecs()},
             }
+            if 'n_bits' in pvs:
+                screen_params[pvs['n_bits']] = {'type': 'int', 'value': n_bits}
+            # Free-running acquisition, as for an areaDetector camera: requested and achieved frame rate in Hz,
+            # unique id of the last frame and number of frames dropped
+            screen_params.update({
+                f'{key}:Acquire': {'type': 'enum', 'enums': ['Done', 'Acquire']},
+                pvs.get('ref_rate_vme', f'{key}:FRAME_RATE'): {
+                    'type': 'float', 'value': default_params.get('frame_rate', 10.0), 'prec': 2, 'unit': 'Hz'},
+                pvs.get('ref_rate', f'{key}:ArrayRate_RBV'): {'type': 'float', 'value': 0.0, 'prec': 2, 'unit': 'Hz'},
+                f'{key}:ArrayCounter_RBV': {'type': 'int', 'value': 0},
+                f'{key}:DroppedArrays_RBV': {'type': 'int', 'value': 0},
+            })
         # need to change screen class...... pneumatic is an enum not a thingy 
             pvdb.update(screen_params)
         
+        elif 'BPMS' in key:
+            # Position readbacks in mm and charge in number of electrons, as for the real BPMs
+            bpm_params = {}
+            if 'x' in pvs:
+                bpm_params[pvs['x']] = {'type': 'float', 'value': 0.0, 'prec': 4, 'unit': 'mm'}
+            if 'y' in pvs:
+                bpm_params[pvs['y']] = {'type': 'float', 'value': 0.0, 'prec': 4, 'unit': 'mm'}
+            if 'tmit' in pvs:
+                bpm_params[pvs['tmit']] = {'type': 'float', 'value': 0.0, 'prec': 0, 'unit': 'Nel'}
+            pvdb.update(bpm_params)
+
         elif 'TCAV' in key:
             tcav_params = {
             get_pv('amp_fbenb'): {
@@ -90,10 +132,12 @@ def create_pvdb(device: dict, **default_params) -> dict:
             get_pv('amp_set'): {
                 'value': 0.0,
                 'prec': 5,
+                'asyn': True,
             },
             get_pv('phase_set'): {
                 'value': 0.0,
                 'prec': 5,
+                'asyn': True,
             },
             get_pv('mode_config'): {
                 'type': 'enum',
@@ -105,4 +149,140 @@ def create_pvdb(device: dict, **default_params) -> dict:
     return pvdb
 #TODO: make defaults more robust
 #TODO: ensure matching defaults are also passed to beamline.py correctly
-#TODO: setup multiarea create_pvdb
\ No newline at end of file
+
+def create_scan_pvdb(max_points: int = 64, image_shape: tuple | None = None, max_image_points: int = 0) -> dict:
+    """
+    Creates the PVs of the virtual scan device served by SimDriver
+
+    Parameters
+    ----------
+    max_points : int
+        Maximum number of setpoints in a scan
+    image_shape : tuple | None
+        (n_row, n_col) of the screen, needed to serve a stack of images
+    max_image_points : int
+        Maximum number of images in the stack, 0 disables the image stack PV
+
+    Returns
+    -------
+    dict
+        PV database of the scan device
+    """
+    pvdb = {
+        'VIRT:SCAN:VARIABLE': {'type': 'string', 'value': ''},
+        'VIRT:SCAN:SETPOINTS': {'type': 'float', 'count': max_points},
+        'VIRT:SCAN:START': {'type': 'int', 'value': 0},
+        'VIRT:SCAN:STATUS': {'type': 'enum', 'enums': ['Idle', 'Done', 'Error']},
+    }
+    for output in ['SIGMA:X', 'SIGMA:Y', 'MU:X', 'MU:Y', 'EMIT:X', 'EMIT:Y']:
+        pvdb[f'VIRT:SCAN:{output}'] = {'type': 'float', 'count': max_points}
+
+    if image_shape and max_image_points > 0:
+        n_row, n_col = image_shape
+        count = max_image_points * n_row * n_col
+        pvdb['VIRT:SCAN:IMAGES'] = {
+            'type': 'float',
+            'count': count,
+            'n_row': n_row,
+            'n_col': n_col,
+            # Avoid a Python list of zeros as pcaspy's initial value
+            'value': np.zeros(count, dtype=np.float32),
+        }
+        pvdb['VIRT:SCAN:IMAGES:ENABLE'] = {'type': 'enum', 'enums': ['Disable', 'Enable']}
+    return pvdb
+
+def create_perf_pvdb(stages=('TRACK', 'RENDER', 'POST', 'PUT')) -> dict:
+    """
+    Creates the PVs publishing SimDriver's hot path timings
+
+    Parameters
+    ----------
+    stages : Sequence[str]
+        Timed stages, each gets MEAN/P50/P99/MAX (in ms) and COUNT PVs
+
+    Returns
+    -------
+    dict
+        PV database of the performance PVs
+    """
+    pvdb = {}
+    for stage in stages:
+        for stat in ['MEAN', 'P50', 'P99', 'MAX']:
+            pvdb[f'VIRT:PERF:{stage}:{stat}'] = {'type': 'float', 'value': 0.0, 'prec': 3, 'unit': 'ms'}
+        pvdb[f'VIRT:PERF:{stage}:COUNT'] = {'type': 'int', 'value': 0}
+    pvdb['VIRT:PERF:QUEUE_DEPTH'] = {'type': 'int', 'value': 0}
+    pvdb['VIRT:PERF:BATCH_SIZE'] = {'type': 'int', 'value': 0}
+    return pvdb
+
+def create_noise_pvdb() -> dict:
+    """
+    Creates the PVs of the camera noise model applied to the screen images, all in counts
+
+    Returns
+    -------
+    dict
+        PV database of the noise PVs
+    """
+    return {
+        'VIRT:NOISE:ENABLE': {'type': 'enum', 'enums': ['Disable', 'Enable']},
+        'VIRT:NOISE:SEED': {'type': 'int', 'value': 0},
+        'VIRT:NOISE:SHOT': {'type': 'float', 'value': 0.0, 'prec': 3, 'unit': 'counts/e'},
+        'VIRT:NOISE:BACKGROUND': {'type': 'float', 'value': 0.0, 'prec': 1, 'unit': 'counts'},
+        'VIRT:NOISE:DARK': {'type': 'float', 'value': 0.0, 'prec': 1, 'unit': 'counts'},
+        'VIRT:NOISE:HOT_PIXELS': {'type': 'float', 'value': 0.0, 'prec': 6},
+    }
+
+def create_stream_pvdb() -> dict:
+    """
+    Creates the PVs of the shot-to-shot jitter applied to streamed screen images
+
+    Returns
+    -------
+    dict
+        PV database of the jitter PVs, rms beam position jitter in um
+    """
+    return {
+        'VIRT:STREAM:JITTER:X': {'type': 'float', 'value': 0.0, 'prec': 1, 'unit': 'um'},
+        'VIRT:STREAM:JITTER:Y': {'type': 'float', 'value': 0.0, 'prec': 1, 'unit': 'um'},
+    }
+
+def create_optics_pvdb(max_points: int = 1024) -> dict:
+    """
+    Creates the waveform PVs of the beam along the segment, one point at the exit of every element
+
+    Parameters
+    ----------
+    max_points : int
+        Maximum number of elements in the segment
+
+    Returns
+    -------
+    dict
+        PV database of the optics PVs, s, centroids, sizes and beta functions in m
+    """
+    pvdb = {}
+    for output in ['S', 'MU:X', 'MU:Y', 'SIGMA:X', 'SIGMA:Y', 'BETA:X', 'BETA:Y', 'ALPHA:X', 'ALPHA:Y']:
+        pvdb[f'VIRT:OPTICS:{output}'] = {'type': 'float', 'count': max_points}
+    return pvdb
+
+def create_gradient_pvdb(max_points: int = 64, max_names: int = 4096) -> dict:
+    """
+    Creates the waveform PVs of the gradient of the beam at the end of the segment with respect to the settings
+
+    Parameters
+    ----------
+    max_points : int
+        Maximum number of quad BCTRL and TCAV AREQ/PREQ PVs in the segment
+    max_names : int
+        Maximum length of VIRT:GRAD:VARIABLES
+
+    Returns
+    -------
+    dict
+        PV database of the gradient PVs. VIRT:GRAD:VARIABLES holds the space-separated names of the PVs the
+        gradients are taken with respect to, in order, each gradient is in m per unit of those PVs.
+    """
+    pvdb = {'VIRT:GRAD:VARIABLES': {'type': 'char', 'count': max_names, 'value': ''}}
+    for output in ['SIGMA:X', 'SIGMA:Y', 'MU:X', 'MU:Y', 'EMIT:X', 'EMIT:Y']:
+        pvdb[f'VIRT:GRAD:{output}'] = {'type': 'float', 'count': max_points}
+    return pvdb
@@ -0,0 +1,111 @@
+import hashlib
+import os
+import pickle
+import struct
+import threading
+import time
+
+import numpy as np
+
+MAGIC = b'SIMLOG1\n'
+# Per record: time (s since the epoch), kind, length of the name, length of the pickled value
+RECORD = struct.Struct('<dBHI')
+PUT, GET = 0, 1
+
+# Arrays larger than this are recorded as a digest, enough to tell whether a replay returned the same
+MAX_ARRAY_SIZE = 64
+
+
+def summarize(value):
+    """
+    Returns what is recorded of a value: the value itself, or a digest of a large array such as an image
+
+    Parameters
+    ----------
+    value : Any
+        Value put or read
+
+    Returns
+    -------
+    Any
+        Scalar, string, small array, or ('sha1', size, hex digest)
+    """
+    if isinstance(value, (list, tuple, np.ndarray)):
+        array = np.asarray(value)
+        if array.size > MAX_ARRAY_SIZE:
+            return 'sha1', int(array.size), hashlib.sha1(np.ascontiguousarray(array).tobytes()).hexdigest()
+        return np.array(array)
+    return value
+
+
+class Recorder:
+    """
+    Append-only log of the puts and gets clients make, for replay.py. Each record is a fixed size header
+    followed by the PV name and the pickled value, so recording costs one write per request.
+    """
+
+    def __init__(self, path: str):
+        """
+        Parameters
+        ----------
+        path : str
+            Log file, appended to if it exists
+        """
+        self.path = path
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'ab')
+        self._lock = threading.Lock()
+        if new:
+            self._file.write(MAGIC)
+
+    def record(self, kind: int, name: str, value=None):
+        """
+        Appends a request to the log
+
+        Parameters
+        ----------
+        kind : int
+            PUT or GET
+        name : str
+            PV name
+        value : Any
+            Value put, or value returned by the get
+        """
+        name = name.encode()
+        data = pickle.dumps(summarize(value), protocol=pickle.HIGHEST_PROTOCOL)
+        record = RECORD.pack(time.time(), kind, len(name), len(data)) + name + data
+        with self._lock:
+            self._file.write(record)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_log(path: str):
+    """
+    Iterates over the records of a log, stopping at a truncated last record
+
+    Parameters
+    ----------
+    path : str
+        Log written by Recorder
+
+    Yields
+    ------
+    tuple
+        (time, kind, name, value)
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a recording')
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            t, kind, name_length, value_length = RECORD.unpack(header)
+            name, data = f.read(name_length), f.read(value_length)
+            if len(data) < value_length:
+                return
+            yield t, kind, name.decode(), pickle.loads(data)
@@ -0,0 +1,148 @@
+import os
+import pickle
+import struct
+
+import cheetah
+import numpy as np
+import torch
+from cheetah.particles import ParticleBeam
+
+from utils.codec import available_codecs
+
+# File layout: MAGIC, header length (uint64), pickled header, then the arrays, each aligned to ALIGNMENT bytes
+MAGIC = b'SIMSNAP1'
+ALIGNMENT = 64
+
+# Per-particle arrays of the beam, written raw and memory-mapped on load rather than unpickled
+BEAM_ARRAYS = ('particles', 'particle_charges', 'survival_probabilities')
+
+# Modules that build or interpret the snapshot's contents, a snapshot older than any of them is stale
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = tuple(os.path.join(_ROOT, module) for module in
+                ('beamdriver.py', 'utils/pvdb.py', 'utils/load_yaml.py', 'utils/cache.py', 'utils/codec.py',
+                 'utils/snapshot.py'))
+
+
+def write_snapshot(path: str, devices: dict, pvdb: dict, beamline, beam: ParticleBeam, context: str | None = None):
+    """
+    Writes everything a server needs before it can serve its first PV to a single file: the parsed devices,
+    the PV database, the lattice and the incoming beam. The file is replaced atomically.
+
+    Parameters
+    ----------
+    path : str
+        Snapshot file
+    devices : dict
+        Result of load_relevant_controls
+    pvdb : dict
+        PV database passed to SimServer, numpy values are stored as arrays
+    beamline : Segment
+        Lattice, before anything was tracked through it so no screen holds a read beam
+    beam : ParticleBeam
+        Incoming beam
+    context : str | None
+        Digest of the lattice and beam for the tracking cache, see TrackingCache.make_context
+    """
+    arrays = {}
+    pvdb = {k: dict(v) for k, v in pvdb.items()}
+    for name, desc in pvdb.items():
+        if isinstance(desc.get('value'), np.ndarray):
+            arrays[f'pvdb/{name}'] = desc.pop('value')
+
+    beam_fields = {'energy': beam.energy, 's': beam.s, 'species': beam.species}
+    for field in BEAM_ARRAYS:
+        value = getattr(beam, field).detach()
+        if value.dim() > 0:
+            arrays[f'beam/{field}'] = value.cpu().numpy()
+        else:
+            beam_fields[field] = value
+
+    # Lay the arrays out after the header, their offsets are relative to the end of the header
+    layout, offset = {}, 0
+    for name, array in arrays.items():
+        array = arrays[name] = np.ascontiguousarray(array)
+        layout[name] = (offset, array.dtype.str, array.shape)
+        offset = _aligned(offset + array.nbytes)
+
+    header = pickle.dumps({
+        'devices': devices,
+        'pvdb': pvdb,
+        'beamline': beamline,
+        'beam': beam_fields,
+        'context': context,
+        # The lattice and beam are pickled cheetah objects, only read back with the same version
+        'cheetah': cheetah.__version__,
+        # The Compressor enums of the PV database offer the codecs installed at compile time
+        'codecs': available_codecs(),
+        'arrays': layout,
+    }, protocol=pickle.HIGHEST_PROTOCOL)
+    start = _aligned(len(MAGIC) + 8 + len(header))
+
+    tmp = f'{path}.tmp'
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for name, array in arrays.items():
+            f.seek(start + layout[name][0])
+            f.write(array.tobytes())
+        f.truncate(start + offset)
+    os.replace(tmp, path)
+
+
+def read_snapshot(path: str, sources=()) -> dict | None:
+    """
+    Reads a snapshot written by write_snapshot. The beam's particles are memory-mapped copy-on-write,
+    so they are only paged in as tracking touches them and the file is never modified.
+
+    Parameters
+    ----------
+    path : str
+        Snapshot file
+    sources : Sequence[str]
+        Files the snapshot was compiled from (yaml, lattice, particle distribution). The snapshot is stale if
+        any of them or of MODULES is newer, or if it was written with another version of cheetah or another set
+        of installed codecs.
+        A missing source does not make it stale.
+
+    Returns
+    -------
+    dict | None
+        'devices', 'pvdb', 'beamline', 'beam' (ParticleBeam) and 'context', or None if the snapshot does not exist,
+        is stale or is not a snapshot
+    """
+    if not os.path.exists(path):
+        return None
+    mtime = os.path.getmtime(path)
+    if any(os.path.exists(source) and os.path.getmtime(source) > mtime for source in (*sources, *MODULES)):
+        return None
+
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return None
+        length, = struct.unpack('<Q', f.read(8))
+        try:
+            snapshot = pickle.loads(f.read(length))
+        except Exception:
+            # Classes of another cheetah version may not unpickle at all
+            return None
+    if snapshot.get('cheetah') != cheetah.__version__ or snapshot.get('codecs') != available_codecs():
+        return None
+    start = _aligned(len(MAGIC) + 8 + length)
+
+    arrays = {}
+    for name, (offset, dtype, shape) in snapshot.pop('arrays').items():
+        arrays[name] = np.memmap(path, dtype=np.dtype(dtype), mode='c', offset=start + offset, shape=shape) \
+            if np.prod(shape) > 0 else np.empty(shape, dtype=dtype)
+        if name.startswith('pvdb/'):
+            snapshot['pvdb'][name.split('/', 1)[1]]['value'] = arrays[name]
+
+    fields = snapshot['beam']
+    for field in BEAM_ARRAYS:
+        if f'beam/{field}' in arrays:
+            fields[field] = torch.from_numpy(arrays[f'beam/{field}'])
+    snapshot['beam'] = ParticleBeam(**fields)
+    return snapshot
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
@@ -0,0 +1,85 @@
+import threading
+from collections import deque
+
+import numpy as np
+
+
+class FrameRing:
+    """
+    Fixed set of preallocated frame slots passed from a producer thread to a consumer thread.
+    The producer writes a frame into a free slot and commits it, the consumer pops committed frames
+    in order and releases their slots once published. When the consumer falls behind and no slot
+    is free, the oldest committed frame is dropped, so the latest frames always get through.
+    """
+
+    def __init__(self, capacity: int = 4):
+        """
+        Parameters
+        ----------
+        capacity : int
+            Number of slots, at least 2 so the producer can write while the consumer publishes
+        """
+        self.capacity = max(capacity, 2)
+        self._slots = [None] * self.capacity
+        self._free = deque(range(self.capacity))
+        self._ready = deque()
+        self._cond = threading.Condition()
+        self.dropped = 0
+
+    def acquire(self, shape: tuple, dtype) -> tuple[int, np.ndarray]:
+        """
+        Returns a slot to write the next frame to, dropping the oldest committed frame if none is free
+
+        Parameters
+        ----------
+        shape : tuple
+            Shape of the frame
+        dtype : np.dtype
+            Type of the frame
+
+        Returns
+        -------
+        tuple[int, np.ndarray]
+            Slot index and its buffer
+        """
+        with self._cond:
+            if self._free:
+                index = self._free.popleft()
+            else:
+                index, _ = self._ready.popleft()
+                self.dropped += 1
+        buffer = self._slots[index]
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = self._slots[index] = np.empty(shape, dtype=dtype)
+        return index, buffer
+
+    def commit(self, index: int, meta: dict):
+        """Hands a written slot to the consumer, with metadata such as its unique id and timestamp"""
+        with self._cond:
+            self._ready.append((index, meta))
+            self._cond.notify()
+
+    def pop(self, timeout: float | None = None) -> tuple[int, np.ndarray, dict] | None:
+        """
+        Waits for the oldest committed frame
+
+        Parameters
+        ----------
+        timeout : float | None
+            Seconds to wait, None waits forever
+
+        Returns
+        -------
+        tuple[int, np.ndarray, dict] | None
+            Slot index, frame and metadata, or None on timeout. The slot must be released once published.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._ready, timeout):
+                return None
+            index, meta = self._ready.popleft()
+        return index, self._slots[index], meta
+
+    def release(self, index: int):
+        """Returns a published slot to the producer"""
+        with self._cond:
+            self._free.append(index)